@@ -15,22 +15,219 @@ or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
 for more details.
 """
 
+import base64
+import bisect
 import datetime
+import hashlib
 import math
 import os
 import stat
+import zlib
+from collections import deque
+from concurrent import futures
 from threading import Lock
 
+try:
+    import numpy
+except ImportError:
+    # optional: it's required only by content-defined chunking
+    numpy = None
+
 # chunk size is fixed and equal for all the file
 CHUNK_SIZE = 1048576  # 1 MB
 
+# digest published for each chunk of a file, used to verify the received chunks
+HASH_ALGORITHM = "sha256"
+
+# number of workers hashing chunks in parallel (hashlib releases the GIL on large buffers)
+HASH_WORKERS = min(8, os.cpu_count() or 2)
+
+# maximum number of chunks of a file queued for hashing at the same time
+HASH_PENDING = 2 * HASH_WORKERS
+
+# pool of workers computing and verifying the digests of the chunks
+hashWorkers = futures.ThreadPoolExecutor(max_workers=HASH_WORKERS)
+
+# content-defined chunking (optional): chunk boundaries are placed where a Gear rolling hash
+# of the last 32 bytes matches a mask, so they move together with the content when data are inserted
+# or removed and the following chunks keep their digests. Otherwise chunks have the fixed CHUNK_SIZE.
+# It requires numpy (a rolling hash computed byte by byte in Python runs at a few MB/s):
+# if numpy is not available files are split in fixed size chunks even when it's enabled
+CONTENT_DEFINED_CHUNKING = False
+
+# minimum, average and maximum size of content-defined chunks:
+# chunks are never bigger than CHUNK_SIZE, so buffers sized for fixed chunks are always enough
+CDC_MIN_SIZE = 131072
+CDC_AVG_SIZE = 524288
+CDC_MAX_SIZE = CHUNK_SIZE
+
+# normalized chunking: a boundary is accepted with a stricter mask before the average size
+# and with a looser mask after it, so chunk sizes gather around the average.
+# Masks use the high bits of the hash, that depend on all the bytes of the window
+CDC_STRICT_MASK = ((1 << 21) - 1) << 11
+CDC_LOOSE_MASK = ((1 << 17) - 1) << 15
+
+# bytes of a file read and scanned at once while looking for chunk boundaries:
+# small buffers keep the hash computation in the CPU cache
+CDC_BUFFER_SIZE = 262144
+
+# Gear table: a pseudo-random 32 bit value for each byte value, derived from a fixed seed
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little") for i in range(0, 256)]
+GEAR_WINDOW = 32
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+# rsync-style delta transfer: the local version of a file is split in blocks whose size
+# grows with the square root of the file size, within these bounds (bytes)
+DELTA_MIN_BLOCK_SIZE = 2048
+DELTA_MAX_BLOCK_SIZE = 65536
+
+# bytes of the strong digest of a block sent in the signatures: weak checksum collisions are
+# filtered by the strong digest, the rebuilt chunks are verified against their full digest anyway
+DELTA_STRONG_SIZE = 8
+
+# modulus of the Adler-32 checksum, used as weak rolling checksum of the blocks
+ADLER_MOD = 65521
+
+
+class ChunkBitfield:
+    """
+    Compact set of chunkIDs backed by a bytearray.
+    Bit i (LSB first) of byte i // 8 is set if chunk i belongs to the set,
+    so membership test and insertion are O(1) and the number of chunks is kept updated.
+    """
+
+    def __init__(self, size, bits=None):
+        """
+        Initialize the bitfield.
+        :param size: number of chunks of the file
+        :param bits: bytes-like object used as initial content (optional)
+        """
+        self.size = size
+        nrBytes = (size + 7) // 8
+        if bits is None:
+            self.bits = bytearray(nrBytes)
+            self.count = 0
+        else:
+            self.bits = bytearray(bits[:nrBytes])
+            self.bits.extend(bytes(nrBytes - len(self.bits)))
+            if size % 8 != 0 and nrBytes > 0:
+                # ignore bits beyond the last chunk
+                self.bits[-1] &= (1 << (size % 8)) - 1
+            self.count = popcount(self.bits)
+
+    def __contains__(self, chunkID):
+        return 0 <= chunkID < self.size and (self.bits[chunkID >> 3] >> (chunkID & 7)) & 1 == 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        Iterate over the chunks in the set, in increasing order.
+        """
+        for byteIndex, byte in enumerate(self.bits):
+            if byte:
+                base = byteIndex << 3
+                for bit in range(0, 8):
+                    if byte & (1 << bit):
+                        yield base + bit
+
+    def add(self, chunkID):
+        """
+        Add a chunk to the set.
+        :param chunkID: id of the chunk
+        :return: void
+        """
+        mask = 1 << (chunkID & 7)
+        if not self.bits[chunkID >> 3] & mask:
+            self.bits[chunkID >> 3] |= mask
+            self.count += 1
+
+    def discard(self, chunkID):
+        """
+        Remove a chunk from the set (if present).
+        :param chunkID: id of the chunk
+        :return: void
+        """
+        mask = 1 << (chunkID & 7)
+        if self.bits[chunkID >> 3] & mask:
+            self.bits[chunkID >> 3] &= ~mask & 0xFF
+            self.count -= 1
+
+    def setAll(self):
+        """
+        Add all the chunks of the file to the set.
+        :return: void
+        """
+        self.bits = bytearray(b"\xff" * len(self.bits))
+        if self.size % 8 != 0:
+            self.bits[-1] = (1 << (self.size % 8)) - 1
+        self.count = self.size
+
+    def missing(self):
+        """
+        Iterate over the chunks not in the set, in increasing order.
+        Complete bytes are skipped without testing the single bits.
+        """
+        for byteIndex, byte in enumerate(self.bits):
+            if byte != 0xFF:
+                base = byteIndex << 3
+                for bit in range(0, min(8, self.size - base)):
+                    if not byte & (1 << bit):
+                        yield base + bit
+
+    def difference(self, other):
+        """
+        Return the chunks that are in the set but not in the other one.
+        :param other: ChunkBitfield object of the same size
+        :return: ChunkBitfield object
+        """
+        a = int.from_bytes(self.bits, "little")
+        b = int.from_bytes(other.bits, "little")
+        return ChunkBitfield(self.size, (a & ~b).to_bytes(len(self.bits), "little"))
+
+    def toList(self):
+        """
+        :return: list of the chunkIDs in the set
+        """
+        return list(self)
+
+    def encode(self):
+        """
+        Compact string representation used on the wire: "<size> <base64 bitmap>".
+        :return: string
+        """
+        return "{} {}".format(self.size, base64.b64encode(bytes(self.bits)).decode("ascii"))
+
+    @staticmethod
+    def decode(string):
+        """
+        Build a bitfield from its wire representation.
+        :param string: string returned by encode()
+        :return: ChunkBitfield object
+        """
+        fields = string.split()
+        size = int(fields[0])
+        bits = base64.b64decode(fields[1]) if len(fields) > 1 else b""
+        return ChunkBitfield(size, bits)
+
+
+def popcount(bits):
+    """
+    Count the bits set in a bytes-like object.
+    :param bits: bytes-like object
+    :return: number of bits equal to 1
+    """
+    return bin(int.from_bytes(bits, "little")).count("1")
+
 
 class File:
     """
     Class used to represent a sync file.
     """
 
-    def __init__(self, groupName, treePath, filename, filepath, filesize, timestamp, status, previousChunks):
+    def __init__(self, groupName, treePath, filename, filepath, filesize, timestamp, status, previousChunks,
+                 chunksHashes=None, chunksSizes=None):
 
         # main properties (retrieved and stored in the session file)
         self.groupName = groupName
@@ -41,12 +238,16 @@ class File:
         self.timestamp = int(timestamp)  # version of the file
         self.status = status  # status can be 'S' (synchronized) or 'D' (download, requires synchronization)
         self.previousChunks = previousChunks  # list of chunks already collected of the file after a partial sync process
+        self.chunksHashes = chunksHashes  # list of the hex digests of the chunks (None if unknown)
+        self.chunksSizes = chunksSizes  # list of the sizes of content-defined chunks (None for fixed size chunks)
+        self.merkleTree = None  # MerkleTree built over chunksHashes, computed when required
+        self.reusableChunks = list()  # (chunkID, offset in the local version) of the chunks that didn't change
 
         # properties used for the file-sharing
         self.lastChunkSize = 0  # size of the last chunk, can be different from CHUNK_SIZE
         self.chunksNumber = 0  # number of chunks that compose the file
-        self.missingChunks = None  # list of chunks not retrieved yet
-        self.availableChunks = None  # list of chunks already retrieved
+        self.chunksOffsets = None  # offsets of content-defined chunks (None for fixed size chunks)
+        self.availableChunks = None  # ChunkBitfield of chunks already retrieved
         self.progress = 0  # synchronization progress: 0% (syncStart) -> 100% (syncComplete)
 
         self.syncLock = Lock()  # internal lock of the File object: used to synchronize threads acting on the file
@@ -78,6 +279,9 @@ class File:
                 if newTimestamp > self.timestamp:
                     self.filesize = newFilesize
                     self.timestamp = newTimestamp
+                    # digests and chunks of the previous version
+                    self.chunksHashes = None
+                    self.chunksSizes = None
             except OSError:
                 print("File not found")
             self.syncLock.release()
@@ -93,13 +297,117 @@ class File:
             # empty file
             self.progress = 100
 
-    def initSync(self):
+    def getMerkleTree(self):
         """
-        Initialize properties useful to download and upload chunks of the file.
+        Return the Merkle tree built over the digests of the chunks.
+        :return: MerkleTree object or None if the digests are unknown
+        """
+        if self.chunksHashes is None:
+            return None
+        if self.merkleTree is None or self.merkleTree.leaves is not self.chunksHashes:
+            try:
+                self.merkleTree = MerkleTree(self.chunksHashes)
+            except (TypeError, ValueError):
+                # invalid digests
+                return None
+        return self.merkleTree
+
+    def getMerkleRoot(self):
+        """
+        Return the root of the Merkle tree, that identifies the content of the file.
+        :return: hex digest or None if the digests are unknown
+        """
+        merkleTree = self.getMerkleTree()
+        if merkleTree is None:
+            return None
+        return merkleTree.getRoot()
+
+    def updateVersion(self, fileInfo):
+        """
+        Record a new version of the file, announced by another peer or by the tracker.
+        The Merkle trees of the local and of the new version are compared:
+        if the content is the same only the timestamp is updated, otherwise the chunks
+        that didn't change are recorded in order to copy them from the local file instead of downloading them.
+        Must be called holding the syncLock.
+        :param fileInfo: dictionary (treePath, filesize, timestamp, chunksHashes, merkleRoot, chunksSizes)
+        :return: True if the new version has to be synchronized, False otherwise
+        """
+
+        reusableChunks = list()
+        localTree = self.getMerkleTree()
+
+        if self.status == "S" and localTree is not None:
+            if fileInfo.get("merkleRoot") is not None and fileInfo["merkleRoot"] == localTree.getRoot() \
+                    and int(fileInfo["filesize"]) == self.filesize:
+                # same content: only the version changes
+                self.timestamp = int(fileInfo["timestamp"])
+                try:
+                    os.utime(self.filepath, (self.timestamp, self.timestamp))
+                except OSError:
+                    pass
+                return False
+
+            localOffsets = getChunksOffsets(self.filesize, self.chunksSizes)
+            newHashes = fileInfo.get("chunksHashes")
+
+            if newHashes is not None and localOffsets is not None and len(localOffsets) == len(self.chunksHashes):
+                try:
+                    if self.chunksSizes is None and fileInfo.get("chunksSizes") is None:
+                        # fixed size chunks: unchanged chunks are at the same position in both versions
+                        newTree = MerkleTree(newHashes)
+                        changedChunks = set(localTree.getChangedChunks(newTree))
+                        reusableChunks = [(i, localOffsets[i]) for i in range(0, len(newHashes))
+                                          if i not in changedChunks]
+                    else:
+                        # content-defined chunks: unchanged chunks may have moved, they're found by digest
+                        localChunks = dict(zip(self.chunksHashes, localOffsets))
+                        reusableChunks = [(i, localChunks[newHashes[i]]) for i in range(0, len(newHashes))
+                                          if newHashes[i] in localChunks]
+                except (TypeError, ValueError):
+                    # invalid digests
+                    reusableChunks = list()
+
+        self.filesize = int(fileInfo["filesize"])
+        self.timestamp = int(fileInfo["timestamp"])
+        self.chunksHashes = fileInfo.get("chunksHashes")
+        self.chunksSizes = fileInfo.get("chunksSizes")
+        self.status = "D"
+        self.previousChunks = list()
+        self.reusableChunks = reusableChunks
+        # no chunk of the new version is available until initSync() loads the chunks map of the part file
+        self.initChunks()
+        self.availableChunks = ChunkBitfield(self.chunksNumber)
+        self.setProgress()
+        return True
+
+    def getChunkHash(self, chunkID):
+        """
+        Return the expected digest of a chunk.
+        :param chunkID: number of the chunk
+        :return: hex digest or None if the digests of the file are unknown
+        """
+        if self.chunksHashes is None or len(self.chunksHashes) != self.chunksNumber:
+            return None
+        return self.chunksHashes[chunkID]
+
+    def initChunks(self):
+        """
+        Calculate chunks number, offsets and last chunk size, from the table of the sizes
+        of content-defined chunks or from CHUNK_SIZE.
+        An invalid table is discarded: the chunks will not match their digests.
         :return: void
         """
 
-        if self.filesize == 0:
+        self.chunksOffsets = None
+        if self.chunksSizes is not None:
+            self.chunksOffsets = getChunksOffsets(self.filesize, self.chunksSizes)
+            if self.chunksOffsets is None:
+                self.chunksSizes = None
+
+        if self.chunksSizes is not None:
+            self.chunksNumber = len(self.chunksSizes)
+            self.lastChunkSize = self.chunksSizes[-1] if self.chunksNumber > 0 else 0
+        elif self.filesize == 0:
             # empty file
             self.chunksNumber = 0
             self.lastChunkSize = 0
@@ -110,13 +418,52 @@ class File:
             if self.lastChunkSize == 0:
                 self.lastChunkSize = CHUNK_SIZE
 
-        self.missingChunks = list()
-        self.availableChunks = list()
-        for i in range(0, self.chunksNumber):
-            if i in self.previousChunks:
-                self.availableChunks.append(i)
-            else:
-                self.missingChunks.append(i)
+    def getChunkOffset(self, chunkID):
+        """
+        Return the position of the first byte of a chunk in the file.
+        :param chunkID: number of the chunk
+        :return: offset in bytes
+        """
+        if self.chunksOffsets is not None:
+            return self.chunksOffsets[chunkID]
+        return chunkID * CHUNK_SIZE
+
+    def getChunkSize(self, chunkID):
+        """
+        Return the size of a chunk.
+        :param chunkID: number of the chunk
+        :return: size in bytes
+        """
+        if self.chunksSizes is not None:
+            return self.chunksSizes[chunkID]
+        if chunkID == self.chunksNumber - 1:
+            return self.lastChunkSize
+        return CHUNK_SIZE
+
+    def getMissingChunksNumber(self):
+        """
+        Return the number of chunks not retrieved yet.
+        :return: integer
+        """
+        return self.chunksNumber - len(self.availableChunks)
+
+    def initSync(self, chunksMap=None):
+        """
+        Initialize properties useful to download and upload chunks of the file.
+        Chunks already retrieved are taken from chunksMap if it's provided, otherwise from previousChunks.
+        :param chunksMap: bitmap of the chunks already retrieved (optional)
+        :return: void
+        """
+
+        self.initChunks()
+
+        if chunksMap is not None:
+            self.availableChunks = ChunkBitfield(self.chunksNumber, chunksMap)
+        else:
+            self.availableChunks = ChunkBitfield(self.chunksNumber)
+            for i in self.previousChunks:
+                if 0 <= i < self.chunksNumber:
+                    self.availableChunks.add(i)
 
         self.previousChunks = list()
         self.setProgress()
@@ -126,25 +473,557 @@ class File:
         Initialize all the properties in order to work as a seed for the file
         """
 
-        if self.filesize == 0:
-            # empty file
-            self.chunksNumber = 0
-            self.lastChunkSize = 0
-        else:
-            # calculate chunks number and last chunks size
-            self.chunksNumber = math.ceil(self.filesize / CHUNK_SIZE)
-            self.lastChunkSize = self.filesize % CHUNK_SIZE
-            if self.lastChunkSize == 0:
-                self.lastChunkSize = CHUNK_SIZE
+        self.initChunks()
 
         self.previousChunks = list()
-        self.missingChunks = list()
-        self.availableChunks = list()
-        for i in range(0, self.chunksNumber):
-            self.availableChunks.append(i)
+        self.availableChunks = ChunkBitfield(self.chunksNumber)
+        self.availableChunks.setAll()
 
         self.progress = 100
 
+        # chunks of the file can be copied into other local files
+        chunkStore.addFile(self)
+
+
+class ChunkStore:
+    """
+    Content-addressed index of the chunks of the synchronized local files, of any group.
+    Chunks are not copied in a separate storage: the digest of a chunk is mapped to the local files
+    containing it, so a chunk already on the disk (e.g. the same file synchronized in many groups)
+    is copied from there instead of being downloaded again.
+    Entries are checked when they're used: files updated or not synchronized anymore are skipped.
+    """
+
+    def __init__(self):
+        # key: hex digest
+        # value: dictionary File -> chunkID
+        self.chunks = dict()
+        # digests registered for each file
+        # key: File object
+        # value: list of hex digests
+        self.files = dict()
+        self.lock = Lock()
+
+    def addFile(self, file):
+        """
+        Register the chunks of a synchronized file, replacing its previous registration (if any).
+        :param file: File object
+        :return: void
+        """
+
+        self.removeFile(file)
+
+        if file.chunksHashes is None or len(file.chunksHashes) != file.chunksNumber:
+            # digests unknown: chunks can't be found
+            return
+
+        self.lock.acquire()
+        try:
+            self.files[file] = list(file.chunksHashes)
+            for chunkID in range(0, file.chunksNumber):
+                self.chunks.setdefault(file.chunksHashes[chunkID], dict())[file] = chunkID
+        finally:
+            self.lock.release()
+
+    def removeFile(self, file):
+        """
+        Remove the chunks of a file from the store.
+        :param file: File object
+        :return: void
+        """
+
+        self.lock.acquire()
+        try:
+            for digest in self.files.pop(file, list()):
+                owners = self.chunks.get(digest)
+                if owners is not None:
+                    owners.pop(file, None)
+                    if len(owners) == 0:
+                        del self.chunks[digest]
+        finally:
+            self.lock.release()
+
+    def findChunk(self, digest):
+        """
+        Find the local files containing a chunk.
+        :param digest: hex digest of the chunk
+        :return: list of (File object, chunkID)
+        """
+
+        self.lock.acquire()
+        try:
+            owners = list(self.chunks.get(digest, dict()).items())
+        finally:
+            self.lock.release()
+
+        # the file must still be synchronized with the same version of the chunk
+        return [(file, chunkID) for file, chunkID in owners
+                if file.status == "S" and file.getChunkHash(chunkID) == digest]
+
+
+class MerkleTree:
+    """
+    Binary hash tree built over the digests of the chunks of a file.
+    Node i of level l covers the chunks [i * 2^l, (i + 1) * 2^l), a node without sibling
+    is promoted as it is to the upper level. Two versions of a file are compared starting from the root
+    and skipping the subtrees with the same digest: k changed chunks are found with O(k log n) comparisons.
+    """
+
+    def __init__(self, leaves):
+        """
+        Build the tree.
+        :param leaves: list of hex digests of the chunks
+        :raise ValueError: if a digest is not a valid hex string
+        """
+
+        self.leaves = leaves
+        self.levels = [list(leaves)]
+
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            parents = list()
+            for i in range(0, len(level) - 1, 2):
+                parents.append(hashNodes(level[i], level[i + 1]))
+            if len(level) % 2 == 1:
+                parents.append(level[-1])
+            self.levels.append(parents)
+
+    def getRoot(self):
+        """
+        Return the digest of the root.
+        :return: hex digest
+        """
+        if len(self.leaves) == 0:
+            # empty file
+            return hashChunk(b"")
+        return self.levels[-1][0]
+
+    def getChangedChunks(self, other):
+        """
+        Find the chunks of another version of the file that are different from the chunks of this version.
+        :param other: MerkleTree of the other version
+        :return: sorted list of chunkIDs of the other version
+        """
+
+        changedChunks = list()
+        size = len(self.leaves)
+        otherSize = len(other.leaves)
+
+        if otherSize == 0:
+            return changedChunks
+
+        # (level, index) of the nodes to compare
+        stack = [(len(other.levels) - 1, 0)]
+
+        while len(stack) > 0:
+            level, index = stack.pop()
+
+            start = index << level
+            if start >= otherSize:
+                continue
+            end = min((index + 1) << level, otherSize)
+
+            # a node covering the same chunks in both trees with the same digest: the chunks didn't change
+            if level < len(self.levels) and index < len(self.levels[level]) and \
+                    min((index + 1) << level, size) == end and self.levels[level][index] == other.levels[level][index]:
+                continue
+
+            if level == 0:
+                changedChunks.append(index)
+            else:
+                # left child is compared first
+                stack.append((level - 1, 2 * index + 1))
+                stack.append((level - 1, 2 * index))
+
+        return changedChunks
+
+
+# chunks of the synchronized local files, indexed by digest
+chunkStore = ChunkStore()
+
+
+def getMerkleRoot(chunksHashes):
+    """
+    Return the root of the Merkle tree built over the digests of the chunks of a file.
+    :param chunksHashes: list of hex digests (None if unknown)
+    :return: hex digest or None
+    """
+    if chunksHashes is None:
+        return None
+    return MerkleTree(chunksHashes).getRoot()
+
+
+def hashNodes(left, right):
+    """
+    Compute the digest of an inner node of a Merkle tree.
+    :param left: hex digest of the left child
+    :param right: hex digest of the right child
+    :return: hex digest
+    :raise ValueError: if a digest is not a valid hex string
+    """
+    # the prefix distinguishes inner nodes from chunks
+    return hashlib.new(HASH_ALGORITHM, b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def hashChunk(data):
+    """
+    Compute the digest of a chunk.
+    :param data: bytes-like object
+    :return: hex digest
+    """
+    return hashlib.new(HASH_ALGORITHM, data).hexdigest()
+
+
+def hashFileChunk(filepath, offset, chunkSize):
+    """
+    Read a chunk of a file and compute its digest.
+    :param filepath: path of the file
+    :param offset: position of the first byte of the chunk
+    :param chunkSize: size of the chunk
+    :return: hex digest
+    :raise OSError: if the chunk can't be read
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        data = f.read(chunkSize)
+    if len(data) != chunkSize:
+        raise OSError("chunk at {} of {} truncated".format(offset, filepath))
+    return hashChunk(data)
+
+
+def computeChunks(filepath, filesize):
+    """
+    Split a file in chunks, content-defined if CONTENT_DEFINED_CHUNKING is enabled
+    and numpy is available, and compute their digests.
+    :param filepath: path of the file
+    :param filesize: size of the file
+    :return: list of the sizes of the chunks (None for fixed size chunks),
+             list of hex digests (None if the file can't be read)
+    """
+
+    chunksSizes = None
+    if CONTENT_DEFINED_CHUNKING and numpy is not None and filesize > CDC_MAX_SIZE:
+        # smaller files are made of a single chunk anyway
+        try:
+            chunksSizes = computeChunksSizes(filepath, filesize)
+        except OSError:
+            print("Error while chunking {}".format(filepath))
+            return None, None
+
+    return chunksSizes, computeChunksHashes(filepath, filesize, chunksSizes)
+
+
+def computeChunksHashes(filepath, filesize, chunksSizes=None):
+    """
+    Compute the digests of all the chunks of a file, hashing the chunks in parallel.
+    :param filepath: path of the file
+    :param filesize: size of the file
+    :param chunksSizes: list of the sizes of content-defined chunks (None for fixed size chunks)
+    :return: list of hex digests or None if the file can't be read
+    """
+
+    if chunksSizes is None:
+        chunksNumber = math.ceil(filesize / CHUNK_SIZE)
+        chunksSizes = [min(CHUNK_SIZE, filesize - chunkID * CHUNK_SIZE) for chunkID in range(0, chunksNumber)]
+
+    # at most HASH_PENDING chunks are queued at a time, so the verification of the chunks
+    # of the active downloads, done by the same pool, doesn't wait for the whole file to be hashed
+    chunksHashes = list()
+    pending = deque()
+    offset = 0
+    try:
+        for chunkSize in chunksSizes:
+            if len(pending) >= HASH_PENDING:
+                chunksHashes.append(pending.popleft().result())
+            pending.append(hashWorkers.submit(hashFileChunk, filepath, offset, chunkSize))
+            offset += chunkSize
+        while len(pending) > 0:
+            chunksHashes.append(pending.popleft().result())
+    except OSError:
+        for result in pending:
+            result.cancel()
+        print("Error while hashing {}".format(filepath))
+        return None
+
+    return chunksHashes
+
+
+def getChunksOffsets(filesize, chunksSizes):
+    """
+    Return the offsets of the chunks of a file.
+    :param filesize: size of the file
+    :param chunksSizes: list of the sizes of content-defined chunks (None for fixed size chunks)
+    :return: list of offsets or None if chunksSizes is not valid for the file
+    """
+
+    if chunksSizes is None:
+        return [chunkID * CHUNK_SIZE for chunkID in range(0, math.ceil(filesize / CHUNK_SIZE))]
+
+    offsets = list()
+    offset = 0
+    try:
+        for chunkSize in chunksSizes:
+            if not 0 < chunkSize <= CHUNK_SIZE:
+                return None
+            offsets.append(offset)
+            offset += chunkSize
+    except TypeError:
+        return None
+
+    if offset != filesize:
+        return None
+    return offsets
+
+
+def computeChunksSizes(filepath, filesize):
+    """
+    Split a file in content-defined chunks (FastCDC-style).
+    The file is scanned in buffers of CDC_BUFFER_SIZE bytes looking for the positions
+    where the Gear hash matches the masks, then boundaries are selected among them
+    respecting the minimum, average and maximum size of the chunks.
+    :param filepath: path of the file
+    :param filesize: size of the file
+    :return: list of the sizes of the chunks
+    :raise OSError: if the file can't be read
+    """
+
+    strictCandidates = list()
+    looseCandidates = list()
+
+    with open(filepath, 'rb') as f:
+        # last bytes of the previous buffer: the hash of a position depends on the previous GEAR_WINDOW bytes
+        history = b""
+        offset = 0
+        while True:
+            data = f.read(CDC_BUFFER_SIZE)
+            if len(data) == 0:
+                break
+            findCandidates(history + data, len(history), offset - len(history), strictCandidates, looseCandidates)
+            history = data[-(GEAR_WINDOW - 1):]
+            offset += len(data)
+
+    filesize = offset
+
+    chunksSizes = list()
+    start = 0
+    while start < filesize:
+        end = min(start + CDC_MAX_SIZE, filesize)
+        if filesize - start > CDC_MIN_SIZE:
+            cut = findCut(strictCandidates, start + CDC_MIN_SIZE, min(start + CDC_AVG_SIZE, end))
+            if cut is None:
+                cut = findCut(looseCandidates, start + CDC_AVG_SIZE + 1, end)
+            if cut is not None:
+                end = cut
+        chunksSizes.append(end - start)
+        start = end
+
+    return chunksSizes
+
+
+def findCandidates(data, skip, offset, strictCandidates, looseCandidates):
+    """
+    Find the positions of a buffer after which a chunk boundary can be placed.
+    The Gear hash of position i is sum(GEAR[data[i - k]] << k) for k < 32 (mod 2^32),
+    i.e. the usual rolling update h = (h << 1) + GEAR[byte] computed from the beginning of the file.
+    The hash is computed for the whole buffer at once with shifted numpy additions.
+    :param data: bytes of the buffer, preceded by the last bytes of the previous buffer
+    :param skip: number of bytes of the previous buffer at the beginning of data
+    :param offset: position of data in the file
+    :param strictCandidates: list extended with the end offsets matching the strict mask
+    :param looseCandidates: list extended with the end offsets matching the loose mask
+    :return: void
+    """
+
+    h = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+    shifted = numpy.empty_like(h)
+    n = len(h)
+    # window doubling: after the step with shift s the hash covers the last 2s bytes
+    shift = 1
+    while shift < min(GEAR_WINDOW, n):
+        numpy.left_shift(h[:n - shift], numpy.uint32(shift), out=shifted[:n - shift])
+        numpy.add(h[shift:], shifted[:n - shift], out=h[shift:])
+        shift <<= 1
+    h = h[skip:]
+    # the strict mask includes the bits of the loose one
+    loose = numpy.flatnonzero((h & numpy.uint32(CDC_LOOSE_MASK)) == 0)
+    strict = loose[(h[loose] & numpy.uint32(CDC_STRICT_MASK)) == 0]
+    base = offset + skip + 1
+    looseCandidates.extend((loose + base).tolist())
+    strictCandidates.extend((strict + base).tolist())
+
+
+def findCut(candidates, low, high):
+    """
+    Find the first candidate boundary in a range.
+    :param candidates: sorted list of end offsets
+    :param low: minimum end offset
+    :param high: maximum end offset
+    :return: end offset or None if there's no candidate in the range
+    """
+    i = bisect.bisect_left(candidates, low)
+    if i < len(candidates) and candidates[i] <= high:
+        return candidates[i]
+    return None
+
+
+def getDeltaBlockSize(filesize):
+    """
+    Return the size of the blocks used to compute the delta between two versions of a file.
+    :param filesize: size of the local version of the file
+    :return: block size in bytes
+    """
+    return max(DELTA_MIN_BLOCK_SIZE, min(DELTA_MAX_BLOCK_SIZE, int(math.sqrt(filesize))))
+
+
+def strongDigest(block):
+    """
+    Compute the strong digest of a block, used in the signatures of a file.
+    :param block: bytes-like object
+    :return: hex digest
+    """
+    return hashlib.new(HASH_ALGORITHM, block).hexdigest()[:2 * DELTA_STRONG_SIZE]
+
+
+def computeSignatures(filepath, blockSize):
+    """
+    Compute the signatures of the blocks of the local version of a file:
+    a weak rolling checksum (Adler-32) and a strong digest for each block.
+    The last block is left out if it's shorter than blockSize.
+    :param filepath: path of the file
+    :param blockSize: size of the blocks
+    :return: list of weak checksums, list of strong digests
+    :raise OSError: if the file can't be read
+    """
+
+    weakSums = list()
+    strongDigests = list()
+
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if len(block) < blockSize:
+                break
+            weakSums.append(zlib.adler32(block))
+            strongDigests.append(strongDigest(block))
+
+    return weakSums, strongDigests
+
+
+def computeDelta(filepath, blockSize, weakSums, strongDigests, maxLiteralSize):
+    """
+    Compute the instructions that rebuild a file from the blocks of another version of it,
+    given the signatures of the blocks of that version.
+    The weak checksum of the window is rolled one byte at a time, so blocks are found
+    at any offset (e.g. after data inserted in the middle of the file).
+    Instructions are integers: n >= 0 copies the block n of the other version,
+    n < 0 appends the next -n bytes of the literal data.
+    :param filepath: path of the file
+    :param blockSize: size of the blocks
+    :param weakSums: list of weak checksums of the blocks of the other version
+    :param strongDigests: list of strong digests of the blocks of the other version
+    :param maxLiteralSize: maximum size of the literal data
+    :return: list of instructions, literal data (bytes)
+             or None if the literal data would be bigger than maxLiteralSize
+    :raise OSError: if the file can't be read
+    """
+
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    # key: weak checksum
+    # value: list of blocks with that checksum
+    blocks = dict()
+    for i in range(0, len(weakSums)):
+        blocks.setdefault(weakSums[i], list()).append(i)
+
+    instructions = list()
+    literals = bytearray()
+
+    size = len(data)
+    pos = 0
+    literalStart = 0
+    weakSum = None
+    a = b = 0
+
+    while pos + blockSize <= size:
+
+        if weakSum is None:
+            # new window: checksum computed from scratch
+            weakSum = zlib.adler32(data[pos:pos + blockSize])
+            a = weakSum & 0xffff
+            b = weakSum >> 16
+
+        candidates = blocks.get(weakSum)
+        if candidates is not None:
+            digest = strongDigest(data[pos:pos + blockSize])
+            match = None
+            for i in candidates:
+                if strongDigests[i] == digest:
+                    match = i
+                    break
+            if match is not None:
+                if literalStart < pos:
+                    instructions.append(literalStart - pos)
+                    literals += data[literalStart:pos]
+                instructions.append(match)
+                pos += blockSize
+                literalStart = pos
+                weakSum = None
+                continue
+
+        if pos + blockSize == size or len(literals) + pos + 1 - literalStart > maxLiteralSize:
+            break
+
+        # roll the window of one byte
+        out = data[pos]
+        a = (a - out + data[pos + blockSize]) % ADLER_MOD
+        b = (b - blockSize * out + a - 1) % ADLER_MOD
+        weakSum = (b << 16) | a
+        pos += 1
+
+    if literalStart < size:
+        instructions.append(literalStart - size)
+        literals += data[literalStart:]
+
+    if len(literals) > maxLiteralSize:
+        return None
+
+    return instructions, bytes(literals)
+
+
+def applyDelta(f, blockSize, instructions, literals):
+    """
+    Rebuild a file from the blocks of another version of it and the instructions computed by computeDelta().
+    :param f: file object of the other version, opened in binary mode
+    :param blockSize: size of the blocks
+    :param instructions: list of instructions
+    :param literals: literal data (bytes-like object)
+    :return: generator of the consecutive pieces of the file
+    :raise ValueError: if the instructions are not valid for the file
+    :raise OSError: if the file can't be read
+    """
+
+    if not isinstance(instructions, list):
+        raise ValueError("invalid instructions")
+
+    literals = memoryview(literals)
+    literalPos = 0
+
+    for instruction in instructions:
+        if not isinstance(instruction, int) or isinstance(instruction, bool):
+            raise ValueError("invalid instruction {}".format(instruction))
+        if instruction >= 0:
+            f.seek(instruction * blockSize)
+            piece = f.read(blockSize)
+            if len(piece) != blockSize:
+                raise ValueError("block {} not available".format(instruction))
+        else:
+            piece = literals[literalPos:literalPos - instruction]
+            if len(piece) != -instruction:
+                raise ValueError("literal data truncated")
+            literalPos -= instruction
+        yield piece
+
 
 def getFileStat(filepath):
     """
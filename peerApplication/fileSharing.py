@@ -15,59 +15,149 @@ or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
 for more details.
 """
 
+import heapq
 import math
 import os
-import shutil
+import selectors
 import socket
+import struct
 import sys
 import time
+from collections import deque
+from concurrent import futures
 from random import random, shuffle
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
 
 import peerCore
 import syncScheduler
-from fileManagement import CHUNK_SIZE
+from fileManagement import CHUNK_SIZE, ChunkBitfield, chunkStore, hashChunk, hashFileChunk, hashWorkers, \
+    DELTA_MIN_BLOCK_SIZE, DELTA_MAX_BLOCK_SIZE, getDeltaBlockSize, computeSignatures, computeDelta, applyDelta
 
 if "networking" not in sys.modules:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     import shared.networking as networking
 
-# define the period of time between 2 consecutive refreshes of the rarestFirstChunksList
+if "codec" not in sys.modules:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import shared.codec as codec
+
+# define the period of time between 2 consecutive refreshes of the active peers:
+# chunks lists are not polled, subscribed peers announce their new chunks
 REFRESH_LIST_PERIOD = 10
 
 # maximum number of attempts before quitting a synchronization
 MAX_UNAVAILABLE = 5
 
-# maximum number of peers from which chunks list can be retrieved
-# in a single iteration of the download protocol, eventual peers not
-# considered cannot be used to retrieve chunks too
+# time (seconds) after which a file unavailable in the last attempt is retried
+RETRY_PERIOD = 1
+
+# maximum number of peers to which a transfer session subscribes in order to receive
+# the chunks announcements, eventual peers not considered cannot be used to retrieve chunks too
 MAX_PEERS = 10
 
 # parameters used to download the file
-# maximum number of parallel threads getting chunks
+# maximum number of parallel peer workers of a transfer session (one for each peer)
 MAX_THREADS = 5
-# maximum number of chunks that can be asked by a getChunk thread in a single iteration
+# number of workers shared by all the transfer sessions in order to execute peer workers
+MAX_CHUNKS_WORKERS = 16
+# maximum number of chunks that can be asked by a peer worker in a single iteration
 # of its internal cycle: it's not unbounded in order to don't block other threads, it's not
 # a small value in order to avoid too much cycle
 MAX_CHUNKS = 100
 
-# time between two consecutive checks on the synchronization thread status
-CHECK_PERIOD = 1.0
-
-# parameters for chunks random discard
-INITIAL_TRESHOLD = 0.5  # discard (INITIAL_TRESHOLD*100)% of the chunks
-TRESHOLD_INC_STEP = 0  # increment of the treshold after each iteration
-COMPLETION_RATE = 0.95  # realize random discard until (COMPLETION_RATE*100)% of the file is downloaded
+# the work assigned to a peer in a single iteration is sized according to the measured
+# throughput of the peer: it should be completed in about ASSIGNMENT_TIME seconds (plus a round trip),
+# so slow peers don't hoard chunks while fast peers are idle
+ASSIGNMENT_TIME = 2
+# work (bytes) assigned to a peer whose throughput has not been measured yet
+INITIAL_ASSIGNMENT = 4 * CHUNK_SIZE
+# weight of a new sample in the moving averages of throughput and round trip time
+STATS_ALPHA = 0.3
+# a peer falls behind when its work takes more than REBALANCE_FACTOR times the expected time:
+# the requests not sent yet are given back to the other peers
+REBALANCE_FACTOR = 2
+# minimum time (seconds) waited for an answer before giving back the requests not sent yet
+MIN_STALL_TIME = 0.5
 
 # maximum number of getChunk request leading to an error allowed before to quit a connection
 MAX_ERRORS = 3
 
-
-def sendChunksList(message, thread):
+# endgame mode: when all the missing chunks of a download are scheduled and they are at most
+# ENDGAME_CHUNKS, idle peer workers request them again, so a slow peer doesn't delay the whole file.
+# The first answer is written, the other ones are discarded
+ENDGAME_CHUNKS = 16
+# maximum number of peers from which a chunk is requested at the same time in endgame mode
+ENDGAME_PEERS = 3
+
+# maximum number of corrupted copies of a chunk accepted from its only owner:
+# then the peer is not asked anymore for the chunk
+MAX_CORRUPTED = 3
+
+# header of the chunks map sidecar file: timestamp and chunks number of the file version
+# it's followed by a bitmap where bit i (LSB first) is set if chunk i has been written in the part file
+# (same layout of fileManagement.ChunkBitfield)
+MAP_HEADER = struct.Struct("!qI")
+
+# throughput and round trip time measured for each peer, shared by all the transfer sessions
+# key: peerID
+# value: PeerStats object
+peersStats = dict()
+peersStatsLock = Lock()
+
+# pool of workers executing the peer workers of all the transfer sessions:
+# the number of threads doesn't grow with the number of files in sync
+chunksWorkers = futures.ThreadPoolExecutor(max_workers=MAX_CHUNKS_WORKERS)
+
+# active transfer sessions
+# key: groupName
+# value: TransferSession object
+sessions = dict()
+sessionsLock = Lock()
+
+# flag required on Windows in order to open files in binary mode with os.open()
+O_BINARY = getattr(os, "O_BINARY", 0)
+
+# maximum number of CHUNK requests sent to a peer on the same connection without waiting for the answers
+# (pipelining): it hides the round trip time between consecutive chunks on high-latency links
+PIPELINE_WINDOW = 8
+
+# files made of a single chunk are requested in bundles (BUNDLE request)
+# maximum number of files in a bundle
+MAX_BUNDLE_FILES = 64
+# maximum total size of the files in a bundle
+MAX_BUNDLE_SIZE = 4 * CHUNK_SIZE
+
+# updated files are first rebuilt from their local version with an rsync-style delta (DELTA request):
+# the signatures of the blocks of the local version are sent to a peer having the new version,
+# that answers with the instructions to copy blocks and the literal data.
+# Files smaller than DELTA_MIN_SIZE or bigger than DELTA_MAX_SIZE are downloaded only by chunks:
+# the serving peer rolls the checksum byte by byte in Python (a few MB/s), and the delta
+# must be computed well within the TIMEOUT of the answer
+DELTA_MIN_SIZE = 65536
+DELTA_MAX_SIZE = 4 * CHUNK_SIZE
+# delta is abandoned if the literal data exceed this fraction of the new version:
+# the chunks are downloaded in parallel from many peers
+DELTA_MAX_LITERAL_RATIO = 0.5
+# maximum number of peers asked for the delta
+DELTA_MAX_PEERS = 3
+
+# subscriptions of other peers to the chunks announcements (HAVE messages) of local files
+# key: (groupName, treePath)
+# value: dictionary PeerConnection -> timestamp of the subscribed version of the file
+subscribers = dict()
+subscribersLock = Lock()
+
+# HAVE messages are not sent by the threads writing the chunks: they are queued on the subscribed
+# connections and sent by these workers, so a slow subscriber doesn't stall downloads and hashing
+MAX_ANNOUNCE_WORKERS = 2
+announceWorkers = futures.ThreadPoolExecutor(max_workers=MAX_ANNOUNCE_WORKERS)
+
+
+def sendChunksList(message, conn):
     """
     Sends local chunks list of a file to another peer that requests it.
     :param message: message received
-    :param thread: thread handler of the connection
+    :param conn: handler of the connection
     :return: void
     """
 
@@ -86,8 +176,8 @@ def sendChunksList(message, thread):
             if fileNode.file.availableChunks is not None:
                 if len(fileNode.file.availableChunks) != 0:
 
-                    # send back chunks list
-                    answer = str(fileNode.file.availableChunks)
+                    # send back chunks list in its compact bitfield encoding
+                    answer = "OK - " + fileNode.file.availableChunks.encode()
 
                 else:
                     answer = "ERROR - EMPTY LIST"
@@ -99,16 +189,351 @@ def sendChunksList(message, thread):
         answer = "ERROR - UNRECOGNIZED FILE {} IN GROUP {}".format(fileTreePath, groupName)
 
     try:
-        networking.mySend(thread.clientSock, answer)
-    except (socket.timeout, RuntimeError, ValueError):
+        networking.mySend(conn.clientSock, answer)
+    except (socket.timeout, OSError, RuntimeError, ValueError):
+        print("Error while sending: ", answer)
+
+
+def sendChunksLists(message, conn):
+    """
+    Sends local chunks lists of many files of a group to another peer that requests them.
+    :param message: message received
+    :param conn: handler of the connection
+    :return: void
+    """
+
+    try:
+        # get message parameters
+        messageFields = message.split(" ", 2)
+        groupName = messageFields[1]
+        filesVersions = codec.decode(messageFields[2])
+
+        groupTree = peerCore.localFileTree.getGroup(groupName)
+        if groupTree is None:
+            answer = "ERROR - UNRECOGNIZED GROUP {}".format(groupName)
+        else:
+            # send back chunks lists in their compact bitfield encoding (null for unavailable files)
+            answer = "OK - " + codec.encode(getLocalChunksLists(groupTree, filesVersions))
+
+    except (IndexError, TypeError, ValueError):
+        answer = "ERROR - INVALID REQUEST"
+
+    try:
+        networking.mySend(conn.clientSock, answer)
+    except (socket.timeout, OSError, RuntimeError, ValueError):
+        print("Error while sending: ", answer)
+
+
+def getLocalChunksLists(groupTree, filesVersions):
+    """
+    Encode the local chunks lists of many files of a group.
+    :param groupTree: root Node of the group
+    :param filesVersions: list of [treePath, timestamp] of the files
+    :return: list of encoded bitfields (None for files not available locally)
+    """
+
+    chunksLists = list()
+    for fileTreePath, timestamp in filesVersions:
+        chunksList = None
+        fileNode = groupTree.findNode(fileTreePath)
+        # check timestamp in order to ensure local file validity
+        if fileNode is not None and fileNode.file.timestamp == timestamp:
+            availableChunks = fileNode.file.availableChunks
+            if availableChunks is not None and len(availableChunks) != 0:
+                chunksList = availableChunks.encode()
+        chunksLists.append(chunksList)
+
+    return chunksLists
+
+
+def subscribeChunks(message, conn):
+    """
+    Subscribe another peer to the chunks announcements of many files of a group.
+    The answer contains the current chunks lists of the files (as CHUNKS_LISTS),
+    then a HAVE message is sent on the same connection for each new chunk of the files.
+    Files that are not available yet are subscribed too: their chunks will be announced.
+    :param message: message received
+    :param conn: handler of the connection
+    :return: void
+    """
+
+    # announcements are sent after the answer: chunks added meanwhile
+    # are contained in the answer or announced later
+    conn.sendLock.acquire()
+
+    try:
+        # get message parameters
+        messageFields = message.split(" ", 2)
+        groupName = messageFields[1]
+        filesVersions = codec.decode(messageFields[2])
+
+        groupTree = peerCore.localFileTree.getGroup(groupName)
+        if groupTree is None:
+            answer = "ERROR - UNRECOGNIZED GROUP {}".format(groupName)
+        else:
+            subscribersLock.acquire()
+            for fileTreePath, timestamp in filesVersions:
+                subscribers.setdefault((groupName, fileTreePath), dict())[conn] = timestamp
+                conn.subscriptions.add((groupName, fileTreePath))
+            subscribersLock.release()
+
+            answer = "OK - " + codec.encode(getLocalChunksLists(groupTree, filesVersions))
+
+    except (IndexError, TypeError, ValueError):
+        answer = "ERROR - INVALID REQUEST"
+
+    try:
+        networking.mySend(conn.clientSock, answer)
+    except (socket.timeout, OSError, RuntimeError, ValueError):
         print("Error while sending: ", answer)
+    finally:
+        conn.sendLock.release()
+
+
+def unsubscribeChunks(message, conn):
+    """
+    Cancel the subscriptions of another peer to the chunks announcements of many files of a group.
+    No answer is sent.
+    :param message: message received
+    :param conn: handler of the connection
+    :return: void
+    """
+
+    try:
+        messageFields = message.split(" ", 2)
+        groupName = messageFields[1]
+        treePaths = codec.decode(messageFields[2])
+    except (IndexError, ValueError):
+        return
+
+    subscribersLock.acquire()
+    for fileTreePath in treePaths:
+        key = (groupName, fileTreePath)
+        conn.subscriptions.discard(key)
+        fileSubscribers = subscribers.get(key)
+        if fileSubscribers is not None:
+            fileSubscribers.pop(conn, None)
+            if len(fileSubscribers) == 0:
+                del subscribers[key]
+    subscribersLock.release()
+
+
+def removeSubscriptions(conn):
+    """
+    Cancel all the subscriptions made on a connection, e.g. when it's closed.
+    :param conn: handler of the connection
+    :return: void
+    """
+
+    subscribersLock.acquire()
+    for key in conn.subscriptions:
+        fileSubscribers = subscribers.get(key)
+        if fileSubscribers is not None:
+            fileSubscribers.pop(conn, None)
+            if len(fileSubscribers) == 0:
+                del subscribers[key]
+    conn.subscriptions = set()
+    # announcements not sent yet are useless too
+    conn.announcements = list()
+    subscribersLock.release()
+
+
+def announceChunk(file, chunkID):
+    """
+    Queue a HAVE message for a new local chunk on the connections of the peers subscribed to the file,
+    so that they can request it immediately. Messages are sent by announceWorkers: the caller never
+    waits for the network.
+    :param file: File object
+    :param chunkID: number of the chunk of the file
+    :return: void
+    """
+
+    message = "HAVE {} {}".format(file.groupName, codec.encode([file.treePath, file.timestamp, chunkID]))
+    flushConns = list()
 
+    subscribersLock.acquire()
+    fileSubscribers = subscribers.get((file.groupName, file.treePath))
+    if fileSubscribers is not None:
+        for conn, timestamp in fileSubscribers.items():
+            if timestamp != file.timestamp:
+                continue
+            conn.announcements.append(message)
+            if not conn.announcing:
+                # no worker is sending the announcements of the connection
+                conn.announcing = True
+                flushConns.append(conn)
+    subscribersLock.release()
+
+    for conn in flushConns:
+        announceWorkers.submit(sendAnnouncements, conn)
+
+
+def sendAnnouncements(conn):
+    """
+    Send the HAVE messages queued on a subscribed connection, until the queue is empty.
+    Messages queued in the meanwhile are sent in the same run.
+    :param conn: PeerConnection object
+    :return: void
+    """
+
+    while True:
+        subscribersLock.acquire()
+        messages = conn.announcements
+        conn.announcements = list()
+        if len(messages) == 0:
+            conn.announcing = False
+            subscribersLock.release()
+            return
+        subscribersLock.release()
+
+        failed = False
+        conn.sendLock.acquire()
+        try:
+            for message in messages:
+                networking.mySend(conn.clientSock, message)
+        except (socket.timeout, OSError, RuntimeError, ValueError):
+            failed = True
+        finally:
+            conn.sendLock.release()
+
+        if failed:
+            # subscriber not reachable anymore
+            removeSubscriptions(conn)
+            subscribersLock.acquire()
+            conn.announcing = False
+            subscribersLock.release()
+            return
+
+
+def sendBundle(message, conn):
+    """
+    Send many whole files of a group, each one made of a single chunk, to another peer.
+    The answer contains the sizes of the files (null for unavailable files)
+    and it's followed by the content of the files, in the requested order.
+    :param message: message received
+    :param conn: handler of the connection
+    :return: void
+    """
+
+    openFiles = list()
+
+    try:
+        # get message parameters
+        messageFields = message.split(" ", 2)
+        groupName = messageFields[1]
+        filesVersions = codec.decode(messageFields[2])
+
+        groupTree = peerCore.localFileTree.getGroup(groupName)
+        if groupTree is None or len(filesVersions) > MAX_BUNDLE_FILES:
+            raise ValueError("invalid bundle request")
+
+        sizes = list()
+        for fileTreePath, timestamp in filesVersions:
+            f = None
+            size = None
+            fileNode = groupTree.findNode(fileTreePath)
+            if fileNode is not None:
+                file = fileNode.file
+                # check timestamp in order to ensure local file validity
+                if file.timestamp == timestamp and file.chunksNumber == 1 and 0 in file.availableChunks:
+                    if file.status == "S":
+                        filePath = file.filepath
+                    else:
+                        filePath = getPartFilePath(file)
+                    try:
+                        f = open(filePath, 'rb')
+                        if os.fstat(f.fileno()).st_size < file.filesize:
+                            f.close()
+                            f = None
+                        else:
+                            size = file.filesize
+                    except OSError:
+                        f = None
+            openFiles.append(f)
+            sizes.append(size)
+
+        answer = "OK - " + codec.encode(sizes)
+
+    except (IndexError, TypeError, ValueError):
+        answer = "ERROR - INVALID REQUEST"
+
+    try:
+        networking.mySend(conn.clientSock, answer)
+        if answer.startswith("OK"):
+            # stream the files from the page cache (sendfile)
+            for i in range(0, len(openFiles)):
+                if openFiles[i] is not None:
+                    networking.sendFileChunk(conn.clientSock, openFiles[i], 0, sizes[i])
+    except (socket.timeout, OSError, RuntimeError, ValueError):
+        print("Error while sending a bundle")
+    finally:
+        for f in openFiles:
+            if f is not None:
+                f.close()
+
+
+def sendDelta(message, conn):
+    """
+    Send to another peer the delta between its version of a file, described by the signatures
+    of its blocks, and the local version. The answer contains the instructions
+    and it's followed by the literal data.
+    :param message: message received
+    :param conn: handler of the connection
+    :return: void
+    """
+
+    delta = None
+
+    try:
+        # get message parameters
+        messageFields = message.split(" ", 4)
+        groupName = messageFields[1]
+        fileTreePath = messageFields[2]
+        timestamp = int(messageFields[3])
+        signatures = codec.decode(messageFields[4])
+        blockSize = int(signatures["blockSize"])
+        weakSums = signatures["weak"]
+        strongDigests = signatures["strong"]
+
+        if not DELTA_MIN_BLOCK_SIZE <= blockSize <= DELTA_MAX_BLOCK_SIZE or len(weakSums) != len(strongDigests):
+            raise ValueError("invalid signatures")
+
+        groupTree = peerCore.localFileTree.getGroup(groupName)
+        fileNode = groupTree.findNode(fileTreePath) if groupTree is not None else None
+
+        if fileNode is None:
+            answer = "ERROR - UNRECOGNIZED FILE {} IN GROUP {}".format(fileTreePath, groupName)
+        elif fileNode.file.timestamp != timestamp or fileNode.file.status != "S":
+            answer = "ERROR - DIFFERENT VERSION"
+        elif fileNode.file.filesize > DELTA_MAX_SIZE:
+            answer = "ERROR - FILE TOO BIG"
+        else:
+            file = fileNode.file
+            delta = computeDelta(file.filepath, blockSize, weakSums, strongDigests,
+                                 int(file.filesize * DELTA_MAX_LITERAL_RATIO))
+            if delta is None:
+                answer = "ERROR - TOO MANY DIFFERENCES"
+            else:
+                answer = "OK - " + codec.encode(delta[0])
+
+    except (IndexError, KeyError, TypeError, ValueError):
+        answer = "ERROR - INVALID REQUEST"
+    except OSError:
+        answer = "ERROR - IT WAS NOT POSSIBLE TO READ THE FILE"
 
-def sendChunk(message, thread):
+    try:
+        networking.mySend(conn.clientSock, answer)
+        if delta is not None:
+            networking.mySend(conn.clientSock, delta[1])
+    except (socket.timeout, OSError, RuntimeError):
+        print("Error while sending a delta")
+
+
+def sendChunk(message, conn):
     """
     Send requested chunk to another peer.
     :param message: message received
-    :param thread: thread handler of the connection
+    :param conn: handler of the connection
     :return: void
     """
 
@@ -134,55 +559,32 @@ def sendChunk(message, thread):
         if file.timestamp == timestamp:
             if chunkID in file.availableChunks:
 
-                # get chunk's size
-                if chunkID == file.chunksNumber - 1:
-                    chunkSize = file.lastChunkSize
-                else:
-                    chunkSize = CHUNK_SIZE
+                # get chunk's size and position
+                chunkSize = file.getChunkSize(chunkID)
+                offset = file.getChunkOffset(chunkID)
 
                 if file.status == "S":
-                    # peer has the whole file: open and send it
-
-                    try:
-                        f = open(file.filepath, 'rb')
-                        offset = chunkID * CHUNK_SIZE
-                        f.seek(offset)
-
-                        dataChunk = f.read(chunkSize)
-
-                        try:
-                            error = False
-                            answer = "OK - I'M SENDING THE CHUNK"
-                            networking.mySend(thread.clientSock, answer)
-                            networking.sendChunk(thread.clientSock, dataChunk, chunkSize)
-                        except (socket.timeout, RuntimeError):
-                            print("Error while sending chunk {}".format(chunkID))
-
-                        f.close()
-                    except FileNotFoundError:
-                        answer = "ERROR - IT WAS NOT POSSIBLE TO OPEN THE FILE"
-
-                if file.status == "D":
-                    # peer is still downloading the file -> send chunk from tmp directory
-
-                    try:
-                        chunkPath = file.filepath + "_tmp/" + "chunk" + str(chunkID)
-
-                        f = open(chunkPath, 'rb')
-
-                        dataChunk = f.read(chunkSize)
-
-                        try:
-                            error = False
-                            answer = "OK - I'M SENDING THE CHUNK"
-                            networking.mySend(thread.clientSock, answer)
-                            networking.sendChunk(thread.clientSock, dataChunk, chunkSize)
-                        except (socket.timeout, RuntimeError):
-                            print("Error while sending chunk {}".format(chunkID))
+                    # peer has the whole file: send the chunk range of the file
+                    chunkPath = file.filepath
+                else:
+                    # peer is still downloading the file -> send chunk from the part file
+                    chunkPath = getPartFilePath(file)
 
-                        f.close()
-                    except FileNotFoundError:
-                        answer = "ERROR - IT WAS NOT POSSIBLE TO OPEN THE FILE"
+                try:
+                    with open(chunkPath, 'rb') as f:
+                        if os.fstat(f.fileno()).st_size < offset + chunkSize:
+                            answer = "ERROR - IT WAS NOT POSSIBLE TO READ THE CHUNK"
+                        else:
+                            try:
+                                error = False
+                                answer = "OK - I'M SENDING THE CHUNK"
+                                networking.mySend(conn.clientSock, answer)
+                                # stream the chunk from the page cache (sendfile)
+                                networking.sendFileChunk(conn.clientSock, f, offset, chunkSize)
+                            except (socket.timeout, OSError, RuntimeError):
+                                print("Error while sending chunk {}".format(chunkID))
+                except OSError:
+                    answer = "ERROR - IT WAS NOT POSSIBLE TO OPEN THE FILE"
             else:
                 answer = "ERROR - UNAVAILABLE CHUNK"
         else:
@@ -193,21 +595,23 @@ def sendChunk(message, thread):
     if error:
         # send error answer: other peer will not wait for the chunk
         try:
-            networking.mySend(thread.clientSock, answer)
-        except (socket.timeout, RuntimeError, ValueError):
+            networking.mySend(conn.clientSock, answer)
+        except (socket.timeout, OSError, RuntimeError, ValueError):
             print("Error while sending: ", answer)
 
 
 def startFileSync(file, taskTimestamp):
     """
-    Main thread for the synchronization of a file.
-    It starts the download and check periodically the status of the sync
-    in order to intercept external interruption.
+    Main function for the synchronization of a file, executed by a sync worker.
+    It downloads the file and then it updates the file state
+    according to the final state of the sync (terminated or externally interrupted).
     :param file: File object
     :param taskTimestamp: timestamp value of the synchronization
     :return: void
     """
 
+    key = file.groupName + "_" + file.treePath
+
     # acquire lock on the file
     file.syncLock.acquire()
 
@@ -221,627 +625,1931 @@ def startFileSync(file, taskTimestamp):
     # the last version will be download as soon as the scheduler
     # will select the last inserted task addressing the file
     if taskTimestamp != file.timestamp:
+        deferredActions = syncScheduler.removeSyncThread(key)
         file.syncLock.release()
+        syncScheduler.runDeferredActions(deferredActions)
+        syncScheduler.notifyScheduler()
         return
 
     print("Starting synchronization of", file.filename)
-    key = file.groupName + "_" + file.treePath
 
     file.stopSync = False
+    dl = Download(file)
 
-    # start download thread
-    t = Thread(target=downloadFile, args=(file, key))
-    t.daemon = True
-    t.start()
+    # from now on an external stop of the synchronization wakes up the download
+    syncScheduler.setSyncDownload(key, file, dl)
 
-    while True:
-        # check thread status
-        state = syncScheduler.getThreadState(key)
-
-        if state == syncScheduler.SYNC_RUNNING:
-            time.sleep(CHECK_PERIOD)
-
-        else:
-            # notify possible other threads
-            file.stopSync = True
-
-            if state == syncScheduler.SYNC_SUCCESS:
-                # download successfully finished
-                # clean the download current state
-                file.previousChunks = list()
-
-            elif state == syncScheduler.SYNC_FAILED or \
-                    state == syncScheduler.SYNC_STOPPED:
-                # save download status
-                file.previousChunks = file.availableChunks
-
-            elif state == syncScheduler.FILE_REMOVED:
-                # wait for other threads termination (if any)
-                time.sleep(1)
-                del file
-                syncScheduler.removeSyncThread(key)
-                return
+    # download the file in this worker, it returns when the download
+    # is terminated (chunks requested by peer workers included) or stopped
+    downloadFile(dl, file, key)
+    state = syncScheduler.getThreadState(key)
+    file.stopSync = True
+
+    if state == syncScheduler.SYNC_SUCCESS:
+        # download successfully finished
+        # clean the download current state
+        file.previousChunks = list()
+
+    elif state == syncScheduler.SYNC_FAILED or \
+            state == syncScheduler.SYNC_STOPPED:
+        # save download status
+        file.previousChunks = file.availableChunks.toList()
+
+    elif state == syncScheduler.FILE_REMOVED:
+        # actions waiting for the end of the sync are discarded with the file
+        del file
+        syncScheduler.removeSyncThread(key)
+        syncScheduler.notifyScheduler()
+        return
 
-            elif state == syncScheduler.FILE_UPDATED:
-                # wait for other threads termination (if any)
-                time.sleep(1)
+    elif state == syncScheduler.FILE_UPDATED:
+        pass
 
-            elif state == syncScheduler.UNDEFINED_STATE:
-                pass
+    elif state == syncScheduler.UNDEFINED_STATE:
+        pass
 
-            break
-    syncScheduler.removeSyncThread(key)
+    deferredActions = syncScheduler.removeSyncThread(key)
 
     # release file lock -> can trigger new synchronization on the same file
     # or modification on the file parameters
     file.syncLock.release()
 
+    # execute actions that were waiting for the end of the synchronization
+    syncScheduler.runDeferredActions(deferredActions)
+
+    # a sync worker is free
+    syncScheduler.notifyScheduler()
+
 
 class Download:
     """
     Data structure useful to collect download information.
     """
 
-    def __init__(self):
-        self.rarestFirstChunksList = None  # list of missing chunks ordered by their rarity
-        self.scheduledChunks = None  # list of chunks already scheduled by a getChunks
-        # thread in order to get them
-        self.chunksToPeers = None  # mapping chunkID -> list of active peers that have that chunk
-        self.activePeers = None  # list of active peers
+    def __init__(self, file):
+        self.file = file  # File object
+        self.rarestFirstChunksList = set()  # set of missing chunks owned by some peer and not scheduled yet,
+        # their rarity order is kept by the rarity index of the session
+        self.scheduledChunks = dict()  # chunks already scheduled by peer workers in order to get them,
+        # mapping chunkID -> set of peerIDs of the peers that have been asked for the chunk
+        self.writingChunks = set()  # scheduled chunks received and being written (and verified) in the part file
+        self.corruptedChunks = dict()  # mapping chunkID -> number of corrupted copies received
+        self.session = None  # transfer session of the download
         self.complete = False  # download complete
         self.unavailable = False  # file unavailable
-        self.lock = Lock()  # lock on the data structure
+        self.unavailableCounter = 0  # number of refreshes in which the file has been unavailable
+        self.mapFd = None  # file descriptor of the chunks map sidecar file
+        # lock on the data structure and condition notified when the download information changes,
+        # they are replaced by the ones of the transfer session when the download joins it
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
 
 
-def downloadFile(file, key):
+class TransferSession:
     """
-    This function manages the creation of all the threads related to a file download.
-    It creates the chunksManager thread and the getChunks threads.
-    :param file: File object
-    :param key: File key (groupName_filename)
-    :return: void
+    Group-level transfer session, shared by all the downloads of files of the same group.
+    A single manager thread retrieves the active peers and the chunks lists for all the files,
+    while a single worker for each peer requests chunks of any file over one connection,
+    following a rarest-first order that spans all the files.
     """
 
-    # initialize download parameters e.g. chunksNumber and chunks list
-    file.initSync()
-
-    unavailable = False
-    tmpDirPath = getTmpDirPath(file)
-    activeThreads = 0
-
-    if file.filesize == 0:
-        # all chunks have been collected
-        mergeChunks(file, tmpDirPath)
-        file.status = "S"
-        # force OS file timestamp to be file.timestamp
-        os.utime(file.filepath, (file.timestamp, file.timestamp))
-        file.initSeed()
-        exitStatus = syncSuccess(file, 0)
-    else:
-
-        dl = Download()
-
-        # create and start chunksManager thread, it collect chunks list from other active peers
-        # and calculate the missing chunks rarestFirstChunksList
-        chunksManagerThread = Thread(target=chunksManager, args=(dl, file))
-        chunksManagerThread.daemon = True
-        chunksManagerThread.start()
+    def __init__(self, groupName):
+        self.groupName = groupName
+        self.downloads = dict()  # mapping treePath -> Download object
+        self.newDownloads = list()  # downloads without chunks information yet
+        self.retryDownloads = list()  # downloads temporarily unavailable, retried after RETRY_PERIOD
+        self.activePeers = None  # list of active peers
+        self.peersTime = 0  # time of the last retrieval of the active peers
+        self.retryTime = 0  # time of the next attempt for unavailable downloads
+        self.peerWorkers = dict()  # mapping peerID -> Future of the worker of the peer
+        self.subscriptions = dict()  # mapping peerID -> Subscription object, used only by the manager
+        self.index = RarityIndex()  # chunks owned by each peer, ordered by rarity
+        self.closed = False  # no more downloads: the session is terminated
+        self.lock = Lock()  # lock on the session and on all its downloads
+        self.changed = Condition(self.lock)  # notified when the session information changes
+        # the manager waits for announcements on the subscriptions:
+        # it's woken up writing a byte on the wake pipe
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.wakeRead.setblocking(False)
+        self.wakeWrite.setblocking(False)
+        # watches the wake pipe and the connections of the subscriptions (select() is limited to FD_SETSIZE)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeRead, selectors.EVENT_READ)
+
+
+class Subscription:
+    """
+    Subscription of a transfer session to the chunks announcements of a peer.
+    It uses a dedicated connection, on which the peer sends a HAVE message for each new chunk
+    of the subscribed files.
+    """
 
-        # wait for the completion of the first iteration of chunksManager
-        while dl.activePeers is None:
-            time.sleep(0.1)
-            if dl.unavailable or file.stopSync:
-                unavailable = True
-                break
+    def __init__(self, peer, sock):
+        self.peer = peer  # peer information, it's a dictionary
+        self.sock = sock  # connection with the peer
+        self.files = dict()  # mapping treePath -> subscribed Download object
 
-        if not unavailable:
 
-            activePeers = dl.activePeers
+class PeerStats:
+    """
+    Throughput and round trip time of a peer, measured on the answers received by its workers
+    and smoothed with exponential moving averages.
+    """
 
-            for peer in activePeers:
-                # create a getChunks thread for each active peers
-                if activeThreads == MAX_THREADS:
-                    break
-                getChunksThread = Thread(target=getChunks, args=(dl, file, peer, tmpDirPath))
-                getChunksThread.daemon = True
-                getChunksThread.start()
-                activeThreads += 1
-
-            # get download start time
-            startTime = time.time()
-
-            # while the download is not complete
-            while not dl.complete:
-                # create new getChunks thread if new peers are active
-                for peer in dl.activePeers:
-                    if peer not in activePeers and activeThreads < MAX_THREADS:
-                        getChunksThread = Thread(target=getChunks, args=(dl, file, peer, tmpDirPath))
-                        getChunksThread.daemon = True
-                        getChunksThread.start()
-                        activeThreads += 1
-                # detect new unactive peers
-                for peerID in activePeers:
-                    if peerID not in dl.activePeers:
-                        activeThreads -= 1
-
-                # check download stop conditions
-                if dl.unavailable or file.stopSync:
-                    unavailable = True
-                    break
+    def __init__(self):
+        self.rate = None  # bytes per second, None until the first measurement
+        self.rtt = None  # seconds, None until the first measurement
+
+    def addRate(self, size, duration):
+        """
+        Add a throughput sample.
+        :param size: bytes received
+        :param duration: seconds taken to receive them
+        :return: void
+        """
+        if size <= 0 or duration <= 0:
+            return
+        sample = size / duration
+        if self.rate is None:
+            self.rate = sample
+        else:
+            self.rate += STATS_ALPHA * (sample - self.rate)
+
+    def addRTT(self, sample):
+        """
+        Add a round trip time sample.
+        :param sample: seconds between a request and the beginning of its answer
+        :return: void
+        """
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt += STATS_ALPHA * (sample - self.rtt)
+
+    def getAssignment(self):
+        """
+        Return the amount of work that the peer should complete in about ASSIGNMENT_TIME seconds.
+        :return: bytes
+        """
+        if self.rate is None:
+            return INITIAL_ASSIGNMENT
+        return max(CHUNK_SIZE, self.rate * (ASSIGNMENT_TIME + (self.rtt or 0)))
+
+    def getExpectedTime(self, size):
+        """
+        Return the time the peer is expected to take in order to send some data.
+        :param size: bytes
+        :return: seconds, None if the peer has not been measured yet
+        """
+        if self.rate is None:
+            return None
+        return (self.rtt or 0) + size / self.rate
+
+
+def getPeerStats(peerID):
+    """
+    Return the statistics of a peer, creating them the first time.
+    :param peerID: id of the peer
+    :return: PeerStats object
+    """
+    peersStatsLock.acquire()
+    stats = peersStats.get(peerID)
+    if stats is None:
+        stats = PeerStats()
+        peersStats[peerID] = stats
+    peersStatsLock.release()
+    return stats
 
-                activePeers = dl.activePeers
-                time.sleep(1)
 
-            if not unavailable:
-                # get end download time
-                endTime = time.time()
+class RarityIndex:
+    """
+    Index of the missing chunks owned by the active peers of a transfer session.
+    Each peer has a heap of the chunks it owns, ordered by replica count (number of
+    peers owning the chunk): a peer worker pops the rarest chunk the peer can serve
+    in O(log n). The index is updated incrementally with HAVE-style deltas: when
+    the replica count of a chunk changes the chunk is pushed again in the heaps of its owners
+    and outdated entries are dropped when they reach the top of a heap.
+    Ties among chunks with the same replica count are broken randomly, so different
+    peers downloading the same file request different chunks.
+    All the methods must be called holding the session lock.
+    """
 
-                # all chunks have been collected
-                mergeChunks(file, tmpDirPath)
-                file.status = "S"
-                # force OS file timestamp to be file.timestamp
-                os.utime(file.filepath, (file.timestamp, file.timestamp))
-                file.initSeed()
-                exitStatus = syncSuccess(file, math.floor(endTime - startTime))
-            else:
-                exitStatus = syncFail(file, key)
+    def __init__(self):
+        self.owners = dict()  # mapping (Download, chunkID) -> set of peerIDs owning the chunk
+        self.peersHeaps = dict()  # mapping peerID -> heap of (replica count, random, seq, Download, chunkID)
+        self.peersChunks = dict()  # mapping peerID -> dict (Download -> last ChunkBitfield received)
+        self.counter = 0  # number of pushes, used to never compare Download objects
+
+    def updatePeer(self, peerID, dl, chunksList):
+        """
+        Update the chunks of a file owned by a peer with its full chunks list,
+        applying only the differences with respect to the previous list.
+        :param peerID: id of the peer
+        :param dl: Download object
+        :param chunksList: ChunkBitfield of the chunks owned by the peer (None if the peer doesn't have the file)
+        :return: void
+        """
+
+        peerChunks = self.peersChunks.setdefault(peerID, dict())
+        oldList = peerChunks.get(dl)
+
+        if chunksList is None:
+            chunksList = ChunkBitfield(dl.file.chunksNumber)
+
+        if oldList is None:
+            addedChunks = chunksList
+            removedChunks = ()
         else:
-            exitStatus = syncFail(file, key)
+            addedChunks = chunksList.difference(oldList)
+            removedChunks = oldList.difference(chunksList)
+
+        peerChunks[dl] = chunksList
+
+        for chunkID in removedChunks:
+            self.removeHave(peerID, dl, chunkID)
+        for chunkID in addedChunks:
+            self.addHave(peerID, dl, chunkID)
+
+    def haveChunk(self, peerID, dl, chunkID):
+        """
+        Record a chunk announced by a peer after its chunks list of the file has been received.
+        :param peerID: id of the peer
+        :param dl: Download object
+        :param chunkID: number of the chunk of the file
+        :return: void
+        """
+
+        chunksList = self.peersChunks.get(peerID, dict()).get(dl)
+        if chunksList is None:
+            return
+
+        chunksList.add(chunkID)
+        self.addHave(peerID, dl, chunkID)
+
+    def dropChunk(self, peerID, dl, chunkID):
+        """
+        Stop considering a peer as owner of a chunk, e.g. because it sent a corrupted copy.
+        :param peerID: id of the peer
+        :param dl: Download object
+        :param chunkID: number of the chunk of the file
+        :return: void
+        """
+
+        chunksList = self.peersChunks.get(peerID, dict()).get(dl)
+        if chunksList is not None:
+            chunksList.discard(chunkID)
+        self.removeHave(peerID, dl, chunkID)
+
+    def removePeer(self, peerID):
+        """
+        Forget all the chunks owned by a peer.
+        :param peerID: id of the peer
+        :return: void
+        """
+
+        for dl in list(self.peersChunks.get(peerID, dict())):
+            self.updatePeer(peerID, dl, None)
+        self.peersChunks.pop(peerID, None)
+        self.peersHeaps.pop(peerID, None)
+
+    def addHave(self, peerID, dl, chunkID):
+        """
+        Record that a peer owns a chunk.
+        :param peerID: id of the peer
+        :param dl: Download object
+        :param chunkID: number of the chunk of the file
+        :return: void
+        """
+
+        if chunkID in dl.file.availableChunks:
+            # chunk already retrieved
+            return
+
+        owners = self.owners.setdefault((dl, chunkID), set())
+        if peerID in owners:
+            return
+        owners.add(peerID)
+
+        if chunkID not in dl.scheduledChunks:
+            dl.rarestFirstChunksList.add(chunkID)
+            self.pushChunk(dl, chunkID)
+
+    def removeHave(self, peerID, dl, chunkID):
+        """
+        Record that a peer doesn't own a chunk anymore.
+        :param peerID: id of the peer
+        :param dl: Download object
+        :param chunkID: number of the chunk of the file
+        :return: void
+        """
+
+        owners = self.owners.get((dl, chunkID))
+        if owners is None or peerID not in owners:
+            return
+        owners.discard(peerID)
+
+        if len(owners) == 0:
+            # nobody owns the chunk: it can't be requested
+            del self.owners[(dl, chunkID)]
+            dl.rarestFirstChunksList.discard(chunkID)
+        elif chunkID in dl.rarestFirstChunksList:
+            self.pushChunk(dl, chunkID)
+
+    def pushChunk(self, dl, chunkID):
+        """
+        Insert a chunk in the heaps of all its owners with its current replica count.
+        :param dl: Download object
+        :param chunkID: number of the chunk of the file
+        :return: void
+        """
+
+        owners = self.owners.get((dl, chunkID))
+        if owners is None:
+            return
+
+        tieBreak = random()
+        for peerID in owners:
+            self.counter += 1
+            heapq.heappush(self.peersHeaps.setdefault(peerID, list()),
+                           (len(owners), tieBreak, self.counter, dl, chunkID))
+
+    def popRarest(self, peerID):
+        """
+        Extract the rarest chunk, among all the files, that a peer can serve.
+        :param peerID: id of the peer
+        :return: (Download, chunkID) tuple or None if the peer has no useful chunks
+        """
+
+        heap = self.peersHeaps.get(peerID)
+        while heap:
+            count, __, __, dl, chunkID = heapq.heappop(heap)
+            owners = self.owners.get((dl, chunkID))
+            # drop outdated entries
+            if owners is None or peerID not in owners or len(owners) != count:
+                continue
+            if chunkID not in dl.rarestFirstChunksList or isFinished(dl):
+                continue
+            return dl, chunkID
+        return None
 
-    # this will terminate checkThread
-    syncScheduler.stopSyncThreadIfRunning(key, exitStatus)
+    def chunkRetrieved(self, dl, chunkID):
+        """
+        Forget a chunk that has been retrieved.
+        :param dl: Download object
+        :param chunkID: number of the chunk of the file
+        :return: void
+        """
+        self.owners.pop((dl, chunkID), None)
+
+    def removeDownload(self, dl):
+        """
+        Forget all the chunks of a terminated download.
+        Its heap entries are dropped when they reach the top of the heaps.
+        :param dl: Download object
+        :return: void
+        """
+
+        for peerChunks in self.peersChunks.values():
+            chunksList = peerChunks.pop(dl, None)
+            if chunksList is not None:
+                for chunkID in chunksList:
+                    self.owners.pop((dl, chunkID), None)
 
 
-def syncSuccess(file, syncTime):
+def notifyDownload(dl):
     """
-    Synchronization ended successfully. Print success messages.
-    :param file: File object
-    :param syncTime: indicate the time between syncStart and syncEnd
-    :return: syncScheduler status
+    Wake up the threads waiting for a change of the download information.
+    :param dl: Download object
+    :return: void
     """
-    print("Synchronization of {} successfully terminated".format(file.filename))
-    print("Synchronization completed in {} seconds".format(syncTime))
-    return syncScheduler.SYNC_SUCCESS
+    dl.lock.acquire()
+    dl.changed.notify_all()
+    dl.lock.release()
 
 
-def syncFail(file, key):
+def isFinished(dl):
     """
-    Synchronization fails. Print error messages and reload sync task.
-    :param file: File object
-    :param key: File key (groupName_filename)
-    :return: syncScheduler status
+    Check if no more chunks have to be requested for a download.
+    Must be called holding the download lock.
+    :param dl: Download object
+    :return: boolean
     """
-    # save download current state in order to restart it at next sync
-    print("Synchronization of {} failed or stopped".format(file.filename))
-    # re-append task: if the group is no longer active or the file has been removed
-    # the scheduler will detect it and it will skip the append operation
-    state = syncScheduler.getThreadState(key)
-    if state != syncScheduler.FILE_REMOVED and state != syncScheduler.FILE_UPDATED:
-        reloadTask = syncScheduler.syncTask(file.groupName, file.treePath, file.timestamp)
-        syncScheduler.appendTask(reloadTask, True)
-    return syncScheduler.SYNC_FAILED
+    return dl.complete or dl.unavailable or dl.file.stopSync
 
 
-def chunksManager(dl, file):
+def downloadFile(dl, file, key):
     """
-    Periodically asks other active peers for their chunksList of file.
-    Then, it calculates the rarestFirstChunksList of missing chunks.
+    This function manages a file download.
+    The download joins the transfer session of its group, that retrieves the missing chunks,
+    and it waits until the download is complete, unavailable or stopped.
     :param dl: Download object, contains download information
     :param file: File object
+    :param key: File key (groupName_filename)
     :return: void
     """
 
-    unavailable = 0
-    dl.rarestFirstChunksList = set()
-    dl.scheduledChunks = set()
-    dl.chunksToPeers = dict()
+    # preallocate the part file and retrieve chunks written by a previous partial download (if any)
+    try:
+        dl.mapFd, chunksMap = preparePartFile(file)
+    except OSError:
+        print("Error while creating the part file of {}".format(file.filename))
+        syncScheduler.stopSyncThreadIfRunning(key, syncFail(file, key))
+        return
 
-    while len(file.missingChunks) > 0 and unavailable < MAX_UNAVAILABLE:
+    # initialize download parameters e.g. chunksNumber and chunks bitfield
+    file.initSync(chunksMap)
 
-        # check synchronization status
-        if file.stopSync:
-            unavailable = MAX_UNAVAILABLE
-            break
+    if file.getMissingChunksNumber() > 0:
+        # copy the missing chunks already stored in other local files
+        copyStoredChunks(dl, file)
 
-        # retrieve the list of active peers for the file
-        activePeers = peerCore.retrievePeers(file.groupName, selectAll=False)
+    if file.getMissingChunksNumber() > 0:
+        # rebuild the missing chunks from the local version of the file (if any)
+        retrieveDelta(dl, file)
 
-        if activePeers is None:
-            # error occurred while asking the peers list to the tracker
-            unavailable += 1
-            time.sleep(1)
-            continue
+    unavailable = False
 
-        if len(activePeers) == 0:
-            # empty list retrieved: no active peers for that group
-            unavailable += 1
-            time.sleep(1)
-            continue
+    # get download start time
+    startTime = time.time()
 
-        # chunksToPeers is a dictionary where key is the chunkID and
-        # value is the list of peer which have that chunk
-        chunksToPeers = dict()
+    if file.getMissingChunksNumber() > 0:
 
-        # chunksCounter is a dictionary where key is the chunkID and
-        # value is the number of peers having that chunk
-        chunksCounter = dict()
+        session = joinSession(dl)
 
-        j = 0
+        dl.lock.acquire()
+        while not isFinished(dl):
+            dl.changed.wait()
+
+        # wait for the chunks requested by peer workers: after that
+        # no worker will write the part file of the download anymore
+        while len(dl.scheduledChunks) > 0:
+            dl.changed.wait()
+
+        del session.downloads[file.treePath]
+        session.index.removeDownload(dl)
+        unavailable = not dl.complete
+        session.changed.notify_all()
+        dl.lock.release()
 
-        # random.shuffle() guarantees that when the number of active peers
-        # is bigger than MAX_PEERS different peers are selected in different iterations
-        shuffle(activePeers)
+        # the manager unsubscribes the file
+        wakeManager(session)
 
-        # ask each peer which chunks it has and collect informations
-        # in order to apply the rarest-first approach
-        for peer in activePeers:
+    # no more chunks will be recorded in the chunks map
+    dl.lock.acquire()
+    if dl.mapFd is not None:
+        os.close(dl.mapFd)
+        dl.mapFd = None
+    dl.lock.release()
 
-            # limits to a maximum MAX_PEERS the number of peers considered
-            if j == MAX_PEERS:
-                break
+    if not unavailable and completeFile(file):
+        # get end download time
+        endTime = time.time()
 
-            # ask the peer for its chunksList for the file
-            chunksList = getChunksList(file, peer["address"])
+        file.status = "S"
+        # force OS file timestamp to be file.timestamp
+        os.utime(file.filepath, (file.timestamp, file.timestamp))
+        file.initSeed()
+        exitStatus = syncSuccess(file, math.floor(endTime - startTime))
+    else:
+        exitStatus = syncFail(file, key)
 
-            if chunksList is not None:
+    syncScheduler.stopSyncThreadIfRunning(key, exitStatus)
 
-                j += 1
 
-                # clean the list from already retrieved chunks
-                chunksList = [chunk for chunk in chunksList if chunk in file.missingChunks]
+def retrieveDelta(dl, file):
+    """
+    Rebuild the new version of a file from its local version, asking a delta to a peer
+    having the new version (rsync-style): the signatures of the blocks of the local version are sent
+    and the answer contains the instructions to copy blocks and the literal data.
+    Chunks rebuilt are verified against their digests and written in the part file,
+    the other ones will be downloaded by chunks.
+    :param dl: Download object
+    :param file: File object
+    :return: void
+    """
 
-                # fill chunkToPeers and chunksCounter
-                for chunk in chunksList:
-                    if chunk in chunksCounter:
-                        chunksCounter[chunk] += 1
-                        chunksToPeers[chunk].append(peer)
-                    else:
-                        chunksCounter[chunk] = 1
-                        chunksToPeers[chunk] = list()
-                        chunksToPeers[chunk].append(peer)
+    if file.chunksHashes is None or not DELTA_MIN_SIZE <= file.filesize <= DELTA_MAX_SIZE:
+        return
 
-        if len(chunksCounter) == 0:
-            # active peers don't have missing chunks
-            unavailable += 1
-            time.sleep(1)
-            continue
+    try:
+        localSize = os.path.getsize(file.filepath)
+    except OSError:
+        # no local version of the file
+        return
 
-        dl.lock.acquire()
+    if not DELTA_MIN_SIZE <= localSize <= DELTA_MAX_SIZE:
+        return
 
-        # update download information
-        for chunk in sorted(chunksCounter, key=chunksCounter.get):
-            if chunk not in dl.scheduledChunks:
-                dl.rarestFirstChunksList.add(chunk)
-            dl.chunksToPeers[chunk] = chunksToPeers[chunk]
-        dl.activePeers = activePeers
+    blockSize = getDeltaBlockSize(localSize)
+    try:
+        weakSums, strongDigests = computeSignatures(file.filepath, blockSize)
+    except OSError:
+        return
 
-        dl.lock.release()
+    activePeers = peerCore.retrievePeers(file.groupName, selectAll=False)
+    if activePeers is None or len(activePeers) == 0:
+        return
 
-        # wait REFRESH_LIST_PERIOD seconds, checking every second
-        # for a possible termination of the download or external stop
-        for i in range(0, REFRESH_LIST_PERIOD):
-            if file.stopSync:
-                unavailable = MAX_UNAVAILABLE
-                break
-            if len(file.missingChunks) == 0:
-                break
-            else:
-                file.setProgress()
-                time.sleep(1)
+    activePeers = list(activePeers)
+    shuffle(activePeers)
 
-    if unavailable == MAX_UNAVAILABLE:
-        dl.unavailable = True
-    else:
-        dl.complete = True
+    message = str(peerCore.peerID) + " " + \
+        "DELTA {} {} {} {}".format(file.groupName, file.treePath, file.timestamp,
+                                   codec.encode({"blockSize": blockSize, "weak": weakSums,
+                                                 "strong": strongDigests}))
+
+    for peer in activePeers[:DELTA_MAX_PEERS]:
+
+        s = peerCore.connectionPool.getConnection(peer["address"])
+        if s is None:
+            continue
+
+        try:
+            networking.mySend(s, message)
+            answer = networking.myRecv(s)
+            if answer.split(" ", 1)[0] != "OK":
+                # peer doesn't have the new version or the versions are too different
+                peerCore.connectionPool.releaseConnection(s)
+                continue
+            instructions = codec.decode(answer.split(" ", 2)[2])
+            if not isinstance(instructions, list) or \
+                    not all(isinstance(i, int) and not isinstance(i, bool) for i in instructions):
+                raise ValueError("invalid delta instructions")
+            literals = networking.myRecvBytes(s)
+            peerCore.connectionPool.releaseConnection(s)
+        except (socket.timeout, OSError, RuntimeError, ValueError, IndexError):
+            peerCore.connectionPool.discardConnection(s)
+            continue
+
+        writeDelta(dl, file, blockSize, instructions, literals)
+        return
 
 
-def getChunksList(file, peerAddr):
+def writeDelta(dl, file, blockSize, instructions, literals):
     """
-    Retrives the chunks list for a file from another active peer.
+    Apply a delta to the local version of a file, writing in the part file the missing chunks
+    whose digest is the expected one and recording them in the chunks map.
+    :param dl: Download object
     :param file: File object
-    :param peerAddr: IP address and port of the destination peer
-    :return: chunksList (list() of integer, each one represents a chunkID)
+    :param blockSize: size of the blocks
+    :param instructions: list of instructions
+    :param literals: literal data
+    :return: void
     """
 
-    # connect to remote peer
-    s = networking.createConnection(peerAddr)
-    if s is None:
-        return None
+    rebuiltChunks = list()
 
     try:
-        # send request and get the answer
-        message = str(peerCore.peerID) + " " + \
-                  "CHUNKS_LIST {} {} {}".format(file.groupName, file.treePath, file.timestamp)
-        networking.mySend(s, message)
-        data = networking.myRecv(s)
-        networking.closeConnection(s, peerCore.peerID)
-    except (socket.timeout, RuntimeError, ValueError):
-        print("Error while getting chunks list")
-        networking.closeConnection(s, peerCore.peerID)
-        return None
-
-    if str(data).split()[0] == "ERROR":
-        # remote peer answered with an error string
-        print('Received from the peer :', data)
-        return None
-    else:
-        # success: return chunksList
-        chunksList = eval(str(data))
-        return chunksList
-
-
-def getChunks(dl, file, peer, tmpDirPath):
+        with open(file.filepath, 'rb') as f:
+            fd = os.open(getPartFilePath(file), os.O_WRONLY | O_BINARY)
+            try:
+                chunkID = 0
+                chunk = bytearray()
+                pieces = applyDelta(f, blockSize, instructions, literals)
+                finished = False
+                while not finished and chunkID < file.chunksNumber:
+                    piece = next(pieces, None)
+                    if piece is None:
+                        finished = True
+                    else:
+                        chunk += piece
+                    # complete chunks (and the last one when the file is over) are verified
+                    while chunkID < file.chunksNumber and \
+                            (len(chunk) >= file.getChunkSize(chunkID) or finished and len(chunk) > 0):
+                        chunkSize = file.getChunkSize(chunkID)
+                        data = chunk[:chunkSize]
+                        del chunk[:chunkSize]
+                        if chunkID not in file.availableChunks and hashChunk(data) == file.getChunkHash(chunkID):
+                            writeAt(fd, data, file.getChunkOffset(chunkID))
+                            rebuiltChunks.append(chunkID)
+                        chunkID += 1
+            finally:
+                os.close(fd)
+    except (OSError, ValueError):
+        print("Error while applying the delta of {}".format(file.filename))
+
+    markLocalChunks(dl, file, rebuiltChunks)
+
+
+def copyStoredChunks(dl, file):
     """
-    This function allows to retrieve chunks from another active peer.
-    Chunks are selected from the dl.rarestFirstChunksList and requested.
-    The function iterate its behavior until the download is complete.
-    :param dl: download information and data
+    Copy into the part file the missing chunks of a file that are already stored in other local files,
+    of any group, found by digest in the local chunks store.
+    :param dl: Download object
     :param file: File object
-    :param peer: peer information, it's a dictionary
-    :param tmpDirPath: path of the directory where chunk will be stored
     :return: void
     """
 
-    # get peer address
-    peerAddr = peer["address"]
-
-    if len(file.availableChunks) + len(dl.scheduledChunks) >= COMPLETION_RATE * file.chunksNumber \
-            or len(file.missingChunks) <= MAX_CHUNKS:
-        # don't use random discard if the number of missing chunks is smaller than a certain amount
-        threshold = 1
+    storedChunks = list()
 
-    else:
-        # use random discard
-        threshold = INITIAL_TRESHOLD
+    try:
+        fd = os.open(getPartFilePath(file), os.O_WRONLY | O_BINARY)
+    except OSError:
+        return
 
-    # connect to remote peer
-    s = networking.createConnection(peerAddr)
-    if s is None:
+    try:
+        for chunkID in range(0, file.chunksNumber):
+            digest = file.getChunkHash(chunkID)
+            if digest is None:
+                # digests unknown: chunks can't be found
+                break
+            if chunkID in file.availableChunks:
+                continue
+            for source, sourceID in chunkStore.findChunk(digest):
+                if source is not file and source.getChunkSize(sourceID) == file.getChunkSize(chunkID) and \
+                        copyStoredChunk(source, sourceID, fd, file, chunkID):
+                    storedChunks.append(chunkID)
+                    break
+    finally:
+        os.close(fd)
+
+    markLocalChunks(dl, file, storedChunks)
+
+
+def copyStoredChunk(source, sourceID, fd, file, chunkID):
+    """
+    Copy a chunk of a local file into the part file of another file.
+    copy_file_range() is used when available: data are copied by the kernel and file systems
+    supporting reflinks share the data blocks instead of duplicating them.
+    Otherwise the chunk is read and written. In both cases the copied chunk is verified.
+    :param source: File object of the local file containing the chunk
+    :param sourceID: number of the chunk in the local file
+    :param fd: file descriptor of the part file
+    :param file: File object of the downloaded file
+    :param chunkID: number of the chunk in the downloaded file
+    :return: True if the chunk has been copied, False otherwise
+    """
+
+    sourceOffset = source.getChunkOffset(sourceID)
+    offset = file.getChunkOffset(chunkID)
+    chunkSize = file.getChunkSize(chunkID)
+    digest = file.getChunkHash(chunkID)
+
+    try:
+        with open(source.filepath, 'rb') as f:
+            if hasattr(os, "copy_file_range"):
+                try:
+                    copied = 0
+                    while copied < chunkSize:
+                        n = os.copy_file_range(f.fileno(), fd, chunkSize - copied,
+                                               sourceOffset + copied, offset + copied)
+                        if n == 0:
+                            break
+                        copied += n
+                    if copied == chunkSize:
+                        return hashFileChunk(getPartFilePath(file), offset, chunkSize) == digest
+                except OSError:
+                    # not supported between these files: fall back to read and write
+                    pass
+            f.seek(sourceOffset)
+            data = f.read(chunkSize)
+        if len(data) != chunkSize or hashChunk(data) != digest:
+            # local file changed in the meantime
+            return False
+        writeAt(fd, data, offset)
+        return True
+    except OSError:
+        return False
+
+
+def markLocalChunks(dl, file, chunks):
+    """
+    Record the chunks written in the part file before joining the transfer session,
+    both in memory and in the chunks map sidecar file.
+    :param dl: Download object
+    :param file: File object
+    :param chunks: list of chunkIDs
+    :return: void
+    """
+
+    if len(chunks) == 0:
+        return
+
+    dl.lock.acquire()
+    for chunkID in chunks:
+        file.availableChunks.add(chunkID)
+    if dl.mapFd is not None:
+        try:
+            writeAt(dl.mapFd, file.availableChunks.bits, MAP_HEADER.size)
+        except OSError:
+            print("Error while updating the chunks map of {}".format(file.filename))
+    file.setProgress()
+    dl.lock.release()
+
+
+def syncSuccess(file, syncTime):
+    """
+    Synchronization ended successfully. Print success messages.
+    :param file: File object
+    :param syncTime: indicate the time between syncStart and syncEnd
+    :return: syncScheduler status
+    """
+    print("Synchronization of {} successfully terminated".format(file.filename))
+    print("Synchronization completed in {} seconds".format(syncTime))
+    return syncScheduler.SYNC_SUCCESS
+
+
+def syncFail(file, key):
+    """
+    Synchronization fails. Print error messages and reload sync task.
+    :param file: File object
+    :param key: File key (groupName_filename)
+    :return: syncScheduler status
+    """
+    # save download current state in order to restart it at next sync
+    print("Synchronization of {} failed or stopped".format(file.filename))
+    # re-append task: if the group is no longer active or the file has been removed
+    # the scheduler will detect it and it will skip the append operation
+    state = syncScheduler.getThreadState(key)
+    if state != syncScheduler.FILE_REMOVED and state != syncScheduler.FILE_UPDATED:
+        reloadTask = syncScheduler.syncTask(file.groupName, file.treePath, file.timestamp)
+        syncScheduler.appendTask(reloadTask)
+    return syncScheduler.SYNC_FAILED
+
+
+def joinSession(dl):
+    """
+    Add a download to the transfer session of its group,
+    creating the session (and its manager thread) if it doesn't exist.
+    :param dl: Download object
+    :return: TransferSession object
+    """
+
+    sessionsLock.acquire()
+
+    session = sessions.get(dl.file.groupName)
+    if session is None:
+        session = TransferSession(dl.file.groupName)
+        sessions[dl.file.groupName] = session
+        managerThread = Thread(target=sessionManager, args=(session,))
+        managerThread.daemon = True
+        managerThread.start()
+
+    session.lock.acquire()
+    dl.lock = session.lock
+    dl.changed = session.changed
+    dl.session = session
+    session.downloads[dl.file.treePath] = dl
+    session.newDownloads.append(dl)
+    session.changed.notify_all()
+    session.lock.release()
+
+    sessionsLock.release()
+
+    wakeManager(session)
+
+    return session
+
+
+def wakeManager(session):
+    """
+    Wake up the manager of a transfer session waiting for announcements.
+    :param session: TransferSession object
+    :return: void
+    """
+
+    try:
+        session.wakeWrite.send(b"\x00")
+    except (BlockingIOError, InterruptedError):
+        # the wake pipe is full, the manager will be woken up anyway
+        pass
+    except OSError:
+        # session closed
+        pass
+
+
+def sessionManager(session):
+    """
+    Main cycle of the manager thread of a transfer session.
+    Every REFRESH_LIST_PERIOD seconds it retrieves the active peers of the group and subscribes
+    to their chunks announcements for all the files in download (a single request for each peer).
+    Downloads joining the session are subscribed immediately, without waiting for the refresh.
+    Between refreshes it receives the announcements of new chunks.
+    It starts a worker for each active peer and terminates when the session has no downloads.
+    :param session: TransferSession object
+    :return: void
+    """
+
+    refreshTime = 0
+
+    while True:
+
+        sessionsLock.acquire()
+        session.lock.acquire()
+
+        if len(session.downloads) == 0:
+            # no more downloads: terminate the session
+            session.closed = True
+            del sessions[session.groupName]
+            session.changed.notify_all()
+            session.lock.release()
+            sessionsLock.release()
+            closeSession(session)
+            return
+
+        sessionsLock.release()
+
+        # files no longer in download
+        unsubscriptions = list()
+        for subscription in session.subscriptions.values():
+            treePaths = [treePath for treePath, dl in subscription.files.items()
+                         if session.downloads.get(treePath) is not dl]
+            if len(treePaths) > 0:
+                unsubscriptions.append((subscription, treePaths))
+
+        # update progress of the downloads (at least every second)
+        for dl in session.downloads.values():
+            dl.file.setProgress()
+
+        now = time.time()
+        if len(session.retryDownloads) > 0 and now >= session.retryTime:
+            session.newDownloads.extend(session.retryDownloads)
+            session.retryDownloads = list()
+
+        if now >= refreshTime:
+            # periodic refresh of all the downloads
+            downloads = [dl for dl in session.downloads.values() if not isFinished(dl)]
+            session.newDownloads = list()
+            session.retryDownloads = list()
+            refreshTime = now + REFRESH_LIST_PERIOD
+        elif len(session.newDownloads) > 0:
+            downloads = [dl for dl in session.newDownloads if not isFinished(dl)]
+            session.newDownloads = list()
+        else:
+            downloads = None
+            timeout = refreshTime - now
+            if len(session.retryDownloads) > 0:
+                timeout = min(timeout, session.retryTime - now)
+
+        session.lock.release()
+
+        for subscription, treePaths in unsubscriptions:
+            unsubscribe(session, subscription, treePaths)
+
+        if downloads is None:
+            waitAnnouncements(session, max(0, min(1, timeout)))
+        elif len(downloads) > 0:
+            refreshDownloads(session, downloads)
+
+
+def closeSession(session):
+    """
+    Close the subscriptions and the wake pipe of a terminated transfer session.
+    :param session: TransferSession object
+    :return: void
+    """
+
+    for subscription in session.subscriptions.values():
+        # the peer cancels the subscriptions when the connection is closed
+        peerCore.connectionPool.discardConnection(subscription.sock)
+    session.subscriptions = dict()
+
+    session.selector.close()
+    session.wakeRead.close()
+    session.wakeWrite.close()
+
+
+def refreshDownloads(session, downloads):
+    """
+    Subscribe some downloads of a session to the chunks announcements of the active peers
+    and check their availability.
+    :param session: TransferSession object
+    :param downloads: list of Download objects
+    :return: void
+    """
+
+    activePeers = session.activePeers
+    if activePeers is None or time.time() - session.peersTime >= REFRESH_LIST_PERIOD:
+        # retrieve the list of active peers for the group: a single query for all the files
+        activePeers = peerCore.retrievePeers(session.groupName, selectAll=False)
+        if activePeers is not None and len(activePeers) > 0:
+            session.peersTime = time.time()
+
+    if activePeers is None or len(activePeers) == 0:
+        # error occurred while asking the peers list to the tracker
+        # or empty list retrieved: no active peers for that group
+        setUnavailable(session, downloads)
         return
 
-    while not dl.complete:
+    # subscribed peers are considered first, in order to keep their subscriptions,
+    # random.shuffle() guarantees that when the number of active peers is bigger
+    # than MAX_PEERS different peers are selected in different refreshes
+    activePeers = list(activePeers)
+    shuffle(activePeers)
+    activePeers.sort(key=lambda peer: peer["peerID"] not in session.subscriptions)
+
+    subscribedPeers = set()
+
+    # subscribe to the chunks announcements of the peers: the answers contain the chunks lists
+    # used to apply the rarest-first approach, then new chunks are announced
+    for peer in activePeers:
 
-        if file.stopSync:
+        # limits to a maximum MAX_PEERS the number of peers considered
+        if len(subscribedPeers) == MAX_PEERS:
             break
 
-        # list of chunks that the function will retrieve in a single iteration
-        chunksList = list()
+        subscription = session.subscriptions.get(peer["peerID"])
+        if subscription is None:
+            # the connection is dedicated to the announcements
+            s = peerCore.connectionPool.getConnection(peer["address"])
+            if s is None:
+                continue
+            subscription = Subscription(peer, s)
+            session.subscriptions[peer["peerID"]] = subscription
+            session.selector.register(s, selectors.EVENT_READ, subscription)
 
-        dl.lock.acquire()
+        # files not subscribed yet (or subscribed for a previous download)
+        newDownloads = [dl for dl in downloads if subscription.files.get(dl.file.treePath) is not dl]
+
+        if len(newDownloads) > 0 and not subscribe(session, subscription, newDownloads):
+            closeSubscription(session, subscription)
+            continue
+
+        subscribedPeers.add(peer["peerID"])
 
-        for chunk in dl.rarestFirstChunksList:
-            if len(chunksList) >= MAX_CHUNKS:
-                # chunksList full
+    # peers no longer active
+    for peerID in [p for p in session.subscriptions if p not in subscribedPeers]:
+        closeSubscription(session, session.subscriptions[peerID])
+
+    unavailableDownloads = list()
+
+    session.lock.acquire()
+
+    session.activePeers = activePeers
+
+    for dl in downloads:
+        # check if some peer has missing chunks of the file
+        available = False
+        for peerID in subscribedPeers:
+            chunksList = session.index.peersChunks.get(peerID, dict()).get(dl)
+            if chunksList is not None and len(chunksList.difference(dl.file.availableChunks)) > 0:
+                available = True
                 break
-            if len(file.missingChunks) > MAX_CHUNKS \
-                    and len(file.availableChunks) + len(dl.scheduledChunks) <= COMPLETION_RATE * file.chunksNumber \
-                    and random() > threshold:
-                # randomly discard this chunk from the request list
-                continue
-            if peer in dl.chunksToPeers[chunk]:
-                # add chunk to request list and scheduled list
-                chunksList.append(chunk)
-                dl.scheduledChunks.add(chunk)
 
-        # remove scheduled chunks from main list
-        # this avoid that other threads request scheduled chunks
-        for chunk in chunksList:
-            dl.rarestFirstChunksList.remove(chunk)
+        if not available:
+            # active peers don't have missing chunks
+            unavailableDownloads.append(dl)
 
-        dl.lock.release()
+    # new chunks can be requested
+    session.changed.notify_all()
+    session.lock.release()
 
-        # decrease discard probability for next round
-        threshold += TRESHOLD_INC_STEP
+    if len(unavailableDownloads) > 0:
+        setUnavailable(session, unavailableDownloads)
 
-        if len(chunksList) == 0:
-            # if no chunks can be request to the peer
-            # sleep 5 seconds and then try again to compute chunksList
+    startPeerWorkers(session)
 
-            for i in range(0, 5):
-                if file.stopSync or dl.complete:
-                    break
-                else:
-                    time.sleep(1)
 
+def setUnavailable(session, downloads):
+    """
+    Record that some downloads are unavailable in the current refresh: they will be
+    retried after RETRY_PERIOD seconds, until MAX_UNAVAILABLE attempts.
+    :param session: TransferSession object
+    :param downloads: list of Download objects
+    :return: void
+    """
+
+    session.lock.acquire()
+
+    for dl in downloads:
+        dl.unavailableCounter += 1
+        if dl.unavailableCounter >= MAX_UNAVAILABLE:
+            dl.unavailable = True
         else:
+            session.retryDownloads.append(dl)
+
+    session.retryTime = time.time() + RETRY_PERIOD
+    session.changed.notify_all()
+    session.lock.release()
+
+
+def startPeerWorkers(session):
+    """
+    Start a worker for each subscribed active peer without a running worker,
+    up to MAX_THREADS workers for the session.
+    Must be called by the manager of the session.
+    :param session: TransferSession object
+    :return: void
+    """
+
+    session.lock.acquire()
+
+    runningWorkers = len([w for w in session.peerWorkers.values() if not w.done()])
+
+    for peer in session.activePeers:
+        if runningWorkers == MAX_THREADS:
+            break
+
+        if peer["peerID"] not in session.subscriptions:
+            # chunks of the peer unknown
+            continue
+
+        worker = session.peerWorkers.get(peer["peerID"])
+        if worker is not None and not worker.done():
+            # peer already served by a worker
+            continue
+
+        session.peerWorkers[peer["peerID"]] = chunksWorkers.submit(peerWorker, session, peer)
+        runningWorkers += 1
+
+    session.lock.release()
+
+
+def subscribe(session, subscription, downloads):
+    """
+    Subscribe to the chunks announcements of many files of a group with a single request.
+    The chunks lists of the files, contained in the answer, are recorded in the rarity index.
+    :param session: TransferSession object
+    :param subscription: Subscription object
+    :param downloads: list of Download objects
+    :return: boolean value (True for success)
+    """
 
-            errors = 0
+    files = [dl.file for dl in downloads]
 
-            for i in range(0, len(chunksList)):
+    try:
+        # send request and get the answer
+        message = str(peerCore.peerID) + " " + \
+                  "SUBSCRIBE {} {}".format(session.groupName,
+                                           codec.encode([[f.treePath, f.timestamp] for f in files]))
+        networking.mySend(subscription.sock, message)
+        data = networking.myRecv(subscription.sock)
+        # announcements of files already subscribed can precede the answer
+        while data.startswith("HAVE "):
+            handleHave(session, subscription, data)
+            data = networking.myRecv(subscription.sock)
+    except (socket.timeout, OSError, RuntimeError, ValueError):
+        print("Error while subscribing to chunks announcements")
+        return False
 
-                chunkID = chunksList[i]
+    if str(data).split()[0] == "ERROR":
+        # remote peer answered with an error string
+        print('Received from the peer :', data)
+        return False
+
+    # success: decode the bitfields skipping the initial 'OK -'
+    try:
+        encodedLists = codec.decode(data.split(" ", 2)[2])
+        if len(encodedLists) != len(files):
+            raise ValueError("wrong number of chunks lists")
+        chunksLists = list()
+        for i in range(0, len(files)):
+            chunksList = None
+            if encodedLists[i] is not None:
+                chunksList = ChunkBitfield.decode(encodedLists[i])
+                if chunksList.size != files[i].chunksNumber:
+                    chunksList = None
+            chunksLists.append(chunksList)
+    except (IndexError, TypeError, ValueError):
+        print('Invalid chunks lists received from the peer')
+        return False
+
+    session.lock.acquire()
+    for i in range(0, len(downloads)):
+        subscription.files[files[i].treePath] = downloads[i]
+        # update the rarity index with the differences from the previous list
+        session.index.updatePeer(subscription.peer["peerID"], downloads[i], chunksLists[i])
+    session.changed.notify_all()
+    session.lock.release()
 
-                if errors == MAX_ERRORS:
-                    networking.closeConnection(s, peerCore.peerID)
-                    # try to re-establish connection
-                    s = networking.createConnection(peerAddr)
-                    if s is None:
-                        # connection broken or peer disconnected
-                        for j in range(i, len(chunksList)):
-                            # reload in the main list all the scheduled chunks
-                            chunk = chunksList[j]
-                            errorOnGetChunk(dl, chunk)
-                        return
+    return True
 
-                # check eventual stop forced from main thread
-                if file.stopSync:
+
+def unsubscribe(session, subscription, treePaths):
+    """
+    Cancel the subscriptions to the chunks announcements of files no longer in download.
+    :param session: TransferSession object
+    :param subscription: Subscription object
+    :param treePaths: list of treePaths of the files
+    :return: void
+    """
+
+    for treePath in treePaths:
+        del subscription.files[treePath]
+
+    try:
+        message = str(peerCore.peerID) + " " + \
+                  "UNSUBSCRIBE {} {}".format(session.groupName, codec.encode(treePaths))
+        networking.mySend(subscription.sock, message)
+    except (socket.timeout, OSError, RuntimeError, ValueError):
+        closeSubscription(session, subscription)
+
+
+def closeSubscription(session, subscription):
+    """
+    Close a subscription: the chunks of the peer are no longer considered.
+    :param session: TransferSession object
+    :param subscription: Subscription object
+    :return: void
+    """
+
+    try:
+        session.selector.unregister(subscription.sock)
+    except (KeyError, ValueError):
+        pass
+    peerCore.connectionPool.discardConnection(subscription.sock)
+    del session.subscriptions[subscription.peer["peerID"]]
+
+    session.lock.acquire()
+    session.index.removePeer(subscription.peer["peerID"])
+    session.lock.release()
+
+
+def waitAnnouncements(session, timeout):
+    """
+    Wait for the chunks announcements of the subscribed peers, or for a wake up of the manager,
+    and record the new chunks in the rarity index.
+    :param session: TransferSession object
+    :param timeout: maximum waiting time (seconds)
+    :return: void
+    """
+
+    try:
+        events = session.selector.select(timeout=timeout)
+    except (OSError, ValueError):
+        return
+
+    changed = False
+
+    for key, __ in events:
+        if key.fileobj is session.wakeRead:
+            try:
+                while session.wakeRead.recv(networking.BUFSIZE):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+            # e.g. a download entered the endgame mode
+            changed = True
+            continue
+
+        subscription = key.data
+        sock = subscription.sock
+        if session.subscriptions.get(subscription.peer["peerID"]) is not subscription:
+            # closed while handling a previous event
+            continue
+        try:
+            # read all the announcements already received
+            while True:
+                message = networking.myRecv(sock)
+                if not message.startswith("HAVE "):
+                    raise ValueError("unexpected message")
+                handleHave(session, subscription, message)
+                if not networking.waitReadable(sock, 0):
                     break
+            changed = True
+        except (socket.timeout, OSError, RuntimeError, ValueError):
+            # connection closed by the peer
+            closeSubscription(session, subscription)
 
-                try:
-                    # send request and wait for a string response
-                    message = str(peerCore.peerID) + " " + \
-                              "CHUNK {} {} {} {}".format(file.groupName, file.treePath, file.timestamp, chunkID)
-                    networking.mySend(s, message)
-                    answer = networking.myRecv(s)
-                except (socket.timeout, RuntimeError, ValueError):
-                    print("Error receiving message about chunk {}".format(chunkID))
-                    errorOnGetChunk(dl, chunkID)
-                    errors += 1
+    if changed:
+        # new chunks can be served by peers without a running worker
+        startPeerWorkers(session)
+
+
+def handleHave(session, subscription, message):
+    """
+    Record a chunk announced by a subscribed peer with a HAVE message.
+    :param session: TransferSession object
+    :param subscription: Subscription object
+    :param message: HAVE message
+    :return: void
+    """
+
+    try:
+        treePath, timestamp, chunkID = codec.decode(message.split(" ", 2)[2])
+    except (IndexError, TypeError, ValueError):
+        return
+
+    dl = subscription.files.get(treePath)
+    if dl is None or dl.file.timestamp != timestamp or \
+            not isinstance(chunkID, int) or chunkID < 0 or chunkID >= dl.file.chunksNumber:
+        return
+
+    session.lock.acquire()
+    session.index.haveChunk(subscription.peer["peerID"], dl, chunkID)
+    # the chunk can be requested by workers waiting for chunks
+    session.changed.notify_all()
+    session.lock.release()
+
+
+def peerWorker(session, peer):
+    """
+    This function allows to retrieve chunks of all the downloads of a session from another active peer.
+    Chunks are selected in rarest-first order among all the files the peer can serve and requested
+    over a single connection. Each received chunk is written at its offset in the part file of its file.
+    The function iterate its behavior until the session has chunks that the peer can serve.
+    :param session: TransferSession object
+    :param peer: peer information, it's a dictionary
+    :return: void
+    """
+
+    # file descriptors of the part files, one for each download served by the worker
+    fds = dict()
+
+    try:
+        peerWorkerLoop(session, peer, fds)
+    finally:
+        for fd in fds.values():
+            os.close(fd)
+
+
+def selectChunks(session, peer, assignment):
+    """
+    Select the chunks to request to a peer, among all the downloads of a session,
+    in rarest-first order (chunks owned by less peers first), until the assigned amount of work.
+    Selected chunks are moved to the scheduled chunks of their download.
+    Must be called holding the session lock.
+    :param session: TransferSession object
+    :param peer: peer information, it's a dictionary
+    :param assignment: amount of work (bytes) assigned to the peer
+    :return: list of (Download, chunkID) tuples
+    """
+
+    chunksList = list()
+    size = 0
+    endgame = False
+
+    while len(chunksList) < MAX_CHUNKS and size < assignment:
+        rarest = session.index.popRarest(peer["peerID"])
+        if rarest is None:
+            break
+
+        # remove scheduled chunk from main list
+        # this avoid that other workers request scheduled chunks
+        dl, chunkID = rarest
+        dl.rarestFirstChunksList.remove(chunkID)
+        dl.scheduledChunks[chunkID] = {peer["peerID"]}
+        chunksList.append(rarest)
+        size += dl.file.getChunkSize(chunkID)
+
+        if len(dl.rarestFirstChunksList) == 0 and dl.file.getMissingChunksNumber() <= ENDGAME_CHUNKS:
+            endgame = True
+
+    if endgame:
+        # a download entered the endgame mode: idle workers can request its chunks again
+        session.changed.notify_all()
+        wakeManager(session)
+
+    if len(chunksList) == 0:
+        # the peer can't serve new chunks: help downloads near completion
+        chunksList = selectEndgameChunks(session, peer)
+
+    return chunksList
+
+
+def selectEndgameChunks(session, peer):
+    """
+    Select the chunks to request again to a peer for the downloads in endgame mode:
+    all their missing chunks have been scheduled and they are at most ENDGAME_CHUNKS.
+    A chunk is requested at most to ENDGAME_PEERS peers at the same time.
+    Must be called holding the session lock.
+    :param session: TransferSession object
+    :param peer: peer information, it's a dictionary
+    :return: list of (Download, chunkID) tuples
+    """
+
+    chunksList = list()
+
+    for dl in session.downloads.values():
+        if isFinished(dl) or len(dl.rarestFirstChunksList) > 0 or \
+                dl.file.getMissingChunksNumber() > ENDGAME_CHUNKS:
+            continue
+
+        for chunkID, requesters in dl.scheduledChunks.items():
+            if peer["peerID"] in requesters or len(requesters) >= ENDGAME_PEERS or \
+                    chunkID in dl.writingChunks:
+                continue
+            owners = session.index.owners.get((dl, chunkID))
+            if owners is not None and peer["peerID"] in owners:
+                requesters.add(peer["peerID"])
+                chunksList.append((dl, chunkID))
+
+    return chunksList
+
+
+def peerWorkerLoop(session, peer, fds):
+    """
+    Main cycle of a peer worker.
+    :param session: TransferSession object
+    :param peer: peer information, it's a dictionary
+    :param fds: dictionary of file descriptors of the part files (Download -> fd)
+    :return: void
+    """
+
+    # get peer address
+    peerAddr = peer["address"]
+    peerID = peer["peerID"]
+    stats = getPeerStats(peerID)
+
+    # get a connection to the remote peer
+    s = peerCore.connectionPool.getConnection(peerAddr)
+    if s is None:
+        return
+
+    # no chunks could be requested in the last iteration
+    idle = False
+
+    while True:
+
+        session.lock.acquire()
+
+        # close the part files of terminated downloads
+        for dl in [d for d in fds if session.downloads.get(d.file.treePath) is not d or isFinished(d)]:
+            os.close(fds.pop(dl))
+
+        if session.closed or len(session.downloads) == 0:
+            session.lock.release()
+            break
+
+        # list of chunks that the function will retrieve in a single iteration
+        chunksList = selectChunks(session, peer, stats.getAssignment())
+
+        if len(chunksList) == 0:
+            if idle:
+                # give back the worker to the pool: the session manager
+                # will start a new worker for the peer at the next refresh
+                session.lock.release()
+                break
+            # if no chunks can be request to the peer
+            # wait (at most 5 seconds) for new chunks and then try again to compute chunksList
+            session.changed.wait(5)
+            session.lock.release()
+            idle = True
+            continue
+
+        session.lock.release()
+        idle = False
+
+        # group chunks in CHUNK and BUNDLE requests
+        requests = buildRequests(chunksList)
+
+        errors = 0
+
+        # requests sent to the peer and not answered yet, in request order:
+        # the peer answers pipelined requests in the same order
+        inFlight = deque()
+        # sending time of the requests in flight
+        sendTimes = deque()
+        nextIndex = 0
+        # time at which the last answer has been completely received
+        lastAnswerTime = 0
+
+        while nextIndex < len(requests) or len(inFlight) > 0:
+
+            # check eventual errors
+            if s is None or errors == MAX_ERRORS:
+                # connection broken or peer disconnected:
+                # reload in the main list all the scheduled chunks
+                for request in list(inFlight) + requests[nextIndex:]:
+                    for dl, chunk in request:
+                        errorOnGetChunk(dl, chunk, peerID)
+                # answers still in flight make the connection unusable
+                peerCore.connectionPool.discardConnection(s)
+                return
+
+            try:
+                # fill the window of outstanding requests
+                while nextIndex < len(requests) and len(inFlight) < PIPELINE_WINDOW:
+                    request = list()
+                    for dl, chunkID in requests[nextIndex]:
+                        if dl.file.stopSync or chunkID in dl.file.availableChunks:
+                            # sync stopped or chunk already received from another peer
+                            # (endgame mode): don't request the chunk
+                            errorOnGetChunk(dl, chunkID, peerID)
+                        else:
+                            request.append((dl, chunkID))
+                    nextIndex += 1
+                    if len(request) == 0:
+                        continue
+                    inFlight.append(request)
+                    sendTimes.append(time.time())
+                    networking.mySend(s, requestMessage(request))
+
+                if len(inFlight) == 0:
                     continue
 
+                # wait for the string response to the oldest request
+                request = inFlight[0]
+                requestSize = getRequestSize(request)
+
+                if nextIndex < len(requests):
+                    expectedTime = stats.getExpectedTime(requestSize)
+                    if expectedTime is not None:
+                        waitTime = max(MIN_STALL_TIME, REBALANCE_FACTOR * expectedTime)
+                        if not networking.waitReadable(s, waitTime):
+                            # the peer is falling behind: other peers can request the chunks not sent yet
+                            releaseRequests(requests, nextIndex, peerID)
+
+                answer = networking.myRecv(s)
+                answerTime = time.time()
+                sendTime = sendTimes[0]
+                if sendTime >= lastAnswerTime:
+                    # the request has not been queued behind other answers
+                    stats.addRTT(answerTime - sendTime)
+
                 if answer.split()[0] == "ERROR":
                     # error: consider next chunks
                     print("Received:", answer)
-                    errorOnGetChunk(dl, chunkID)
+                    inFlight.popleft()
+                    sendTimes.popleft()
+                    lastAnswerTime = answerTime
+                    for dl, chunkID in request:
+                        errorOnGetChunk(dl, chunkID, peerID)
                     continue
 
-                try:
+                if len(request) == 1:
                     # success: get the chunk
+                    dl, chunkID = request[0]
+                    receiveChunk(s, dl, chunkID, dl.file.getChunkSize(chunkID), fds, peerID)
+                else:
+                    # success: get the bundled files, the answer contains their sizes
+                    try:
+                        sizes = codec.decode(answer.split(" ", 2)[2])
+                        if len(sizes) != len(request):
+                            raise ValueError("wrong number of files in the bundle")
+                    except (IndexError, TypeError, ValueError):
+                        # the connection is no longer aligned with the protocol
+                        raise ValueError("invalid bundle answer")
+
+                    for size in sizes:
+                        # request keeps only the files not received yet
+                        dl, chunkID = request[0]
+                        if size is None:
+                            # file not available on the peer
+                            errorOnGetChunk(dl, chunkID, peerID)
+                        elif size != dl.file.filesize:
+                            raise ValueError("wrong size of a bundled file")
+                        else:
+                            receiveChunk(s, dl, chunkID, size, fds, peerID)
+                        del request[0]
+
+                inFlight.popleft()
+                sendTimes.popleft()
+
+                # the answer has been transferred since the request was sent
+                # or since the previous answer was completely received
+                now = time.time()
+                stats.addRate(requestSize, now - max(sendTime, lastAnswerTime))
+                lastAnswerTime = now
+
+                # requests not sent yet that the peer can't complete in time are given back
+                if nextIndex < len(requests):
+                    assignment = stats.getAssignment()
+                    pendingSize = 0
+                    for i in range(nextIndex, len(requests)):
+                        pendingSize += getRequestSize(requests[i])
+                        if pendingSize > REBALANCE_FACTOR * assignment:
+                            releaseRequests(requests, i, peerID)
+                            break
+
+            except (socket.timeout, OSError, RuntimeError, ValueError):
+                print("Error receiving chunks from {}".format(peerAddr))
+                # requests in flight are lost together with the connection
+                while len(inFlight) > 0:
+                    for dl, chunkID in inFlight.popleft():
+                        errorOnGetChunk(dl, chunkID, peerID)
+                sendTimes.clear()
+                errors += 1
+                # the connection is no longer aligned with the protocol: replace it
+                peerCore.connectionPool.discardConnection(s)
+                s = peerCore.connectionPool.getConnection(peerAddr)
+                continue
 
-                    # evaluate chunks size
-                    if chunkID == file.chunksNumber - 1:
-                        chunkSize = file.lastChunkSize
-                    else:
-                        chunkSize = CHUNK_SIZE
+    # keep the connection open for next requests to the same peer
+    peerCore.connectionPool.releaseConnection(s)
 
-                    data = networking.recvChunk(s, chunkSize)
-                except (socket.timeout, RuntimeError):
-                    print("Error receiving chunk {}".format(chunkID))
-                    errorOnGetChunk(dl, chunkID)
-                    errors += 1
-                    continue
 
-                try:
-                    peerCore.pathCreationLock.acquire()
-                    if not os.path.exists(tmpDirPath):
-                        # print("Creating the path: " + tmpDirPath)
-                        os.makedirs(tmpDirPath)
-                    peerCore.pathCreationLock.release()
+def buildRequests(chunksList):
+    """
+    Group the chunks selected for a peer in requests.
+    Files made of a single chunk are grouped in BUNDLE requests (up to MAX_BUNDLE_FILES files
+    and MAX_BUNDLE_SIZE bytes), while other chunks are requested one at a time with CHUNK requests.
+    :param chunksList: list of (Download, chunkID) tuples
+    :return: list of requests, each one is a list of (Download, chunkID) tuples
+    """
+
+    requests = list()
+    bundle = list()
+    bundleSize = 0
 
-                    chunkPath = tmpDirPath + "chunk" + str(chunkID)
+    for dl, chunkID in chunksList:
+        if dl.file.chunksNumber != 1:
+            requests.append([(dl, chunkID)])
+            continue
 
-                    # write chunk in a new file
-                    f = open(chunkPath, 'wb')
-                    f.write(data)
-                    f.close()
+        if len(bundle) == MAX_BUNDLE_FILES or bundleSize + dl.file.filesize > MAX_BUNDLE_SIZE:
+            requests.append(bundle)
+            bundle = list()
+            bundleSize = 0
 
-                    try:
-                        file.missingChunks.remove(chunkID)
-                        file.availableChunks.append(chunkID)
-                        dl.scheduledChunks.remove(chunkID)
-                    except ValueError:
-                        pass
-
-                except FileNotFoundError:
-                    errorOnGetChunk(dl, chunkID)
-                    continue
+        bundle.append((dl, chunkID))
+        bundleSize += dl.file.filesize
+
+    if len(bundle) > 0:
+        requests.append(bundle)
+
+    return requests
+
+
+def releaseRequests(requests, index, peerID):
+    """
+    Give back the chunks of the requests not sent yet, from a certain index:
+    they can be requested to other peers.
+    :param requests: list of requests, each one is a list of (Download, chunkID) tuples
+    :param index: index of the first request to release
+    :param peerID: id of the peer
+    :return: void
+    """
+
+    for request in requests[index:]:
+        for dl, chunkID in request:
+            errorOnGetChunk(dl, chunkID, peerID)
+    del requests[index:]
+
+
+def getRequestSize(request):
+    """
+    Return the amount of data requested by a request.
+    :param request: list of (Download, chunkID) tuples
+    :return: bytes
+    """
+
+    size = 0
+    for dl, chunkID in request:
+        size += dl.file.getChunkSize(chunkID)
+    return size
+
+
+def requestMessage(request):
+    """
+    Build the message of a request: a CHUNK message for a single chunk,
+    otherwise a BUNDLE message asking whole files of the same group.
+    :param request: list of (Download, chunkID) tuples
+    :return: message string
+    """
+
+    if len(request) == 1:
+        dl, chunkID = request[0]
+        return str(peerCore.peerID) + " " + \
+            "CHUNK {} {} {} {}".format(dl.file.groupName, dl.file.treePath, dl.file.timestamp, chunkID)
+
+    return str(peerCore.peerID) + " " + \
+        "BUNDLE {} {}".format(request[0][0].file.groupName,
+                              codec.encode([[dl.file.treePath, dl.file.timestamp] for dl, __ in request]))
 
-    networking.closeConnection(s, peerCore.peerID)
+
+def receiveChunk(s, dl, chunkID, chunkSize, fds, peerID):
+    """
+    Receive a chunk from a connection and write it at its offset in the part file.
+    In endgame mode only the first answer for a chunk is written, the other ones are discarded.
+    :param s: connection with the peer
+    :param dl: Download object
+    :param chunkID: number of the chunk of the file
+    :param chunkSize: size of the chunk
+    :param fds: dictionary of file descriptors of the part files (Download -> fd)
+    :param peerID: id of the peer
+    :return: void
+    :raise: socket and protocol errors of the connection
+    """
+
+    # data is a view on the connection receive buffer:
+    # it must be written on disk before receiving the next chunk
+    data = networking.recvChunk(s, chunkSize)
+
+    file = dl.file
+
+    if file.stopSync:
+        # sync stopped while the chunk was in flight: discard it
+        errorOnGetChunk(dl, chunkID, peerID)
+        return
+
+    dl.lock.acquire()
+    requesters = dl.scheduledChunks.get(chunkID)
+    if requesters is None or chunkID in dl.writingChunks:
+        # the chunk has been received from another peer
+        if requesters is not None:
+            requesters.discard(peerID)
+        dl.lock.release()
+        return
+    dl.writingChunks.add(chunkID)
+    dl.lock.release()
+
+    try:
+        fd = fds.get(dl)
+        if fd is None:
+            # open the part file: each worker uses its own file descriptor
+            fd = os.open(getPartFilePath(file), os.O_WRONLY | O_BINARY)
+            fds[dl] = fd
+        # write chunk at its offset in the part file straight from the receive buffer
+        writeAt(fd, data, file.getChunkOffset(chunkID))
+    except OSError:
+        dl.lock.acquire()
+        dl.writingChunks.discard(chunkID)
+        dl.lock.release()
+        errorOnGetChunk(dl, chunkID, peerID)
+        return
+
+    if file.getChunkHash(chunkID) is None:
+        # digests unknown (e.g. file added by an older peer): the chunk can't be verified
+        markChunk(dl, file, chunkID)
+    else:
+        # verify the chunk off the receive thread: meanwhile next chunks are received
+        hashWorkers.submit(verifyChunk, dl, chunkID, chunkSize, peerID)
 
 
-def errorOnGetChunk(dl, chunkID):
+def verifyChunk(dl, chunkID, chunkSize, peerID):
+    """
+    Verify the digest of a chunk written in the part file, executed by a hash worker.
+    A valid chunk is recorded as retrieved, a corrupted one is requested again to another peer.
+    :param dl: Download object
+    :param chunkID: number of the chunk of the file
+    :param chunkSize: size of the chunk
+    :param peerID: id of the peer that sent the chunk
+    :return: void
+    """
+
+    file = dl.file
+
+    try:
+        # the chunk is read back from the page cache
+        valid = hashFileChunk(getPartFilePath(file), file.getChunkOffset(chunkID), chunkSize) == file.getChunkHash(chunkID)
+    except OSError:
+        valid = False
+
+    if valid:
+        markChunk(dl, file, chunkID)
+        return
+
+    print("Chunk {} of {} received from peer {} is corrupted".format(chunkID, file.filename, peerID))
+
+    dl.lock.acquire()
+    dl.writingChunks.discard(chunkID)
+    dl.corruptedChunks[chunkID] = dl.corruptedChunks.get(chunkID, 0) + 1
+    owners = dl.session.index.owners.get((dl, chunkID), ())
+    if len(owners) > 1 or dl.corruptedChunks[chunkID] >= MAX_CORRUPTED:
+        # the peer is not considered anymore as owner of the chunk
+        dl.session.index.dropChunk(peerID, dl, chunkID)
+    dl.lock.release()
+
+    errorOnGetChunk(dl, chunkID, peerID)
+
+
+def errorOnGetChunk(dl, chunkID, peerID):
     """
     Function that handles an error occurred while asking for a certain chunk.
-    It makes a specific chunk available to be ask for other getChunks threads.
+    It makes a specific chunk available to be ask for other peer workers,
+    unless it has been received or it's still requested to other peers (endgame mode).
+    :param dl: download information
+    :param chunkID: number of the chunk of the file
+    :param peerID: id of the peer
+    :return: void
+    """
+    dl.lock.acquire()
+    requesters = dl.scheduledChunks.get(chunkID)
+    if requesters is not None:
+        requesters.discard(peerID)
+        if len(requesters) == 0:
+            # remove the chunk from the list of scheduled chunks
+            del dl.scheduledChunks[chunkID]
+            if (dl, chunkID) in dl.session.index.owners:
+                # add the chunk to the main list, in rarity order
+                dl.rarestFirstChunksList.add(chunkID)
+                dl.session.index.pushChunk(dl, chunkID)
+    # the chunk can be requested by threads waiting for chunks
+    dl.changed.notify_all()
+    dl.lock.release()
+
+
+def markChunk(dl, file, chunkID):
+    """
+    Record that a chunk has been written in the part file.
+    The chunk bit is set both in memory and in the chunks map sidecar file,
+    so a stopped or crashed download can be resumed.
     :param dl: download information
+    :param file: File object
     :param chunkID: number of the chunk of the file
     :return: void
     """
     dl.lock.acquire()
-    # add the chunk to the main list
-    dl.rarestFirstChunksList.add(chunkID)
-    # remove the chunk from the list of scheduled chunks
-    dl.scheduledChunks.remove(chunkID)
+
+    # the bitfield of available chunks has the same layout of the chunks map
+    file.availableChunks.add(chunkID)
+    # requests of the chunk still in flight (endgame mode) will be discarded
+    dl.scheduledChunks.pop(chunkID, None)
+    dl.writingChunks.discard(chunkID)
+    dl.session.index.chunkRetrieved(dl, chunkID)
+
+    if file.getMissingChunksNumber() == 0:
+        # last chunk: the download is complete
+        dl.complete = True
+        dl.changed.notify_all()
+
+    if dl.mapFd is not None:
+        byteIndex = chunkID >> 3
+        try:
+            writeAt(dl.mapFd, file.availableChunks.bits[byteIndex:byteIndex + 1], MAP_HEADER.size + byteIndex)
+        except OSError:
+            print("Error while updating the chunks map of {}".format(file.filename))
+
     dl.lock.release()
 
+    # the chunk can be requested immediately by the subscribed peers
+    announceChunk(file, chunkID)
+
 
-def mergeChunks(file, tmpDirPath):
+def preparePartFile(file):
     """
-    This function merges all the chunks of a file in a new file.
+    Prepare the part file, where chunks are directly written at their offset during the download,
+    and its sidecar chunks map, that records which chunks have been written.
+    A partial download of the same version of the file is resumed,
+    otherwise the part file is preallocated, the chunks map is reset
+    and the chunks that didn't change with respect to the local version are copied.
+    Files made of a single chunk are received at once: they don't need the chunks map
+    and their part file is truncated, so none of their chunks is available.
     :param file: File object
-    :param tmpDirPath: path of the directory where all the chunks have been collected
-    :return: boolen value (True for success)
+    :return: file descriptor of the chunks map, bytearray bitmap of the written chunks
+             (None and an empty bitmap for files made of a single chunk)
     """
 
-    # path of the new file
-    newFilePath = getNewFilePath(file)
+    partFilePath = getPartFilePath(file)
+    chunksMapPath = getChunksMapPath(file)
+
+    # chunks of the version to download (fixed size or content-defined)
+    file.initChunks()
+    chunksNumber = file.chunksNumber
+    header = MAP_HEADER.pack(file.timestamp, chunksNumber)
+    mapSize = (chunksNumber + 7) // 8
+
+    dirPath, __ = os.path.split(partFilePath)
+    peerCore.pathCreationLock.acquire()
+    if not os.path.exists(dirPath):
+        # print("Creating the path: " + dirPath)
+        os.makedirs(dirPath)
+    peerCore.pathCreationLock.release()
+
+    if chunksNumber <= 1:
+        # nothing to resume and nothing to preallocate: just create the empty part file
+        fd = os.open(partFilePath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY)
+        os.close(fd)
+        return None, bytearray(mapSize)
+
+    chunksMap = None
+    try:
+        with open(chunksMapPath, 'rb') as f:
+            data = f.read()
+        if data[:MAP_HEADER.size] == header and len(data) == MAP_HEADER.size + mapSize \
+                and os.path.getsize(partFilePath) == file.filesize:
+            # same version of the file: resume the previous download
+            chunksMap = bytearray(data[MAP_HEADER.size:])
+    except OSError:
+        pass
+
+    if chunksMap is None:
+        # new download: preallocate the part file and reset the chunks map
+        chunksMap = bytearray(mapSize)
+        fd = os.open(partFilePath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY)
+        try:
+            preallocate(fd, file.filesize)
+            copyReusableChunks(file, fd, chunksMap)
+        finally:
+            os.close(fd)
+
+        with open(chunksMapPath, 'wb') as f:
+            f.write(header)
+            f.write(chunksMap)
+
+    mapFd = os.open(chunksMapPath, os.O_WRONLY | O_BINARY)
 
-    # save available chunks in case the merge operations fails or it's stopped
-    file.previousChunks = file.availableChunks
+    return mapFd, chunksMap
+
+
+def copyReusableChunks(file, fd, chunksMap):
+    """
+    Copy into the part file the chunks of the local version of the file
+    that are also part of the version to download, so they don't need to be downloaded.
+    Each chunk is verified against the digest of the new version before being copied.
+    :param file: File object
+    :param fd: file descriptor of the part file
+    :param chunksMap: bytearray bitmap of the written chunks, updated with the copied chunks
+    :return: void
+    """
+
+    reusableChunks = file.reusableChunks
+    file.reusableChunks = list()
+
+    if len(reusableChunks) == 0 or file.getChunkHash(0) is None:
+        return
 
-    # merge chunks writing each chunks in the new file
     try:
+        f = open(file.filepath, 'rb')
+    except OSError:
+        # local version not available anymore
+        return
+
+    with f:
+        for chunkID, localOffset in reusableChunks:
+            if not 0 <= chunkID < file.chunksNumber:
+                continue
+            chunkSize = file.getChunkSize(chunkID)
+            try:
+                f.seek(localOffset)
+                data = f.read(chunkSize)
+            except OSError:
+                return
+            if len(data) != chunkSize or hashChunk(data) != file.getChunkHash(chunkID):
+                # local file changed in the meantime: the chunk will be downloaded
+                continue
+            writeAt(fd, data, file.getChunkOffset(chunkID))
+            chunksMap[chunkID >> 3] |= 1 << (chunkID & 7)
 
-        dirPath, __ = os.path.split(newFilePath)
-        peerCore.pathCreationLock.acquire()
-        if not os.path.exists(dirPath):
-            # print("Creating the path: " + dirPath)
-            os.makedirs(dirPath)
-        peerCore.pathCreationLock.release()
-
-        f1 = open(newFilePath, 'wb')
-        # merge chunks
-        if file.filesize > 0:
-            for chunkID in range(0, file.chunksNumber):
-                chunkPath = tmpDirPath + "chunk" + str(chunkID)
-                with open(chunkPath, 'rb') as f2:
-                    f1.write(f2.read())
-        f1.close()
-    except FileNotFoundError:
-        print("Error while creating the new file")
-        return False
 
-    # remove previous version of the file (if any)
-    if os.path.exists(file.filepath):
-        os.remove(file.filepath)
+def preallocate(fd, size):
+    """
+    Give to a file its final size, reserving disk space when the OS supports it.
+    Otherwise the file is left sparse.
+    :param fd: file descriptor
+    :param size: size of the file in bytes
+    :return: void
+    """
 
-    # rename the tmp file to the real name of the file
-    os.rename(newFilePath, file.filepath)
+    os.ftruncate(fd, size)
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # not supported by the file system: keep the sparse file
+            pass
 
-    # remove chunks directory
-    if file.filesize > 0:
-        shutil.rmtree(tmpDirPath)
 
-    print("Chunks of {} successfully merged".format(file.filename))
+def writeAt(fd, data, offset):
+    """
+    Write data at a certain offset of a file without moving a shared file position.
+    :param fd: file descriptor
+    :param data: bytes-like object
+    :param offset: position of the first byte
+    :return: void
+    """
 
-    return True
+    view = memoryview(data)
+    if hasattr(os, "pwrite"):
+        while len(view) > 0:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        # fd is not shared among threads, so seek and write are safe
+        os.lseek(fd, offset, os.SEEK_SET)
+        while len(view) > 0:
+            written = os.write(fd, view)
+            view = view[written:]
 
 
-def getNewFilePath(file):
+def completeFile(file):
     """
-    Build the newFilePath
-           ex.
-           file.filepath = home/prova.txt
-           filenameWE = prova
-           fileExtension = splitFilename[1] = txt
-           dirPath = home/
-           newFilePath = home/prova_new.txt
+    Replace the previous version of the file (if any) with the downloaded one.
+    Chunks have been written in place in the part file, so no merge is required.
     :param file: File object
-    :return: newFilePath
+    :return: boolean value (True for success)
     """
 
-    # split filepath into directorypath and filename
-    (dirPath, filename) = os.path.split(file.filepath)
-    # remove extension from the filename (if any)
-    # WoE stands for Without Extension
-    splitFilename = filename.split(".")
-    filenameWoE = splitFilename[0]
+    try:
+        # atomically replace the previous version of the file
+        os.replace(getPartFilePath(file), file.filepath)
+    except OSError:
+        print("Error while replacing {}".format(file.filepath))
+        return False
+
+    try:
+        os.remove(getChunksMapPath(file))
+    except OSError:
+        pass
 
-    # path where the file will be merged
-    newFilePath = dirPath + "/" + filenameWoE + "_new"
-    if len(splitFilename) > 1:
-        # concatenate file extension if present
-        newFilePath += "."
-        newFilePath += splitFilename[1]
+    print("{} successfully written".format(file.filename))
 
-    return newFilePath
+    return True
 
 
-def getTmpDirPath(file):
+def getPartFilePath(file):
     """
-    Build the new temporary directory path
+    Build the path of the part file, where chunks are written during the download
                ex.
                file.filepath = home/prova.txt
-               dirPath = home/
-               tmpDirPath = home/prova.txt_tmp/
+               partFilePath = home/prova.txt_part
     :param file: File object
     :return: string representing the path
     """
 
-    # split filepath into directoryPath and filename
-    (dirPath, filename) = os.path.split(file.filepath)
+    return file.filepath + "_part"
+
 
-    # directory path where the chunks have been stored
-    tmpDirPath = dirPath + "/" + filename + "_tmp/"
+def getChunksMapPath(file):
+    """
+    Build the path of the chunks map sidecar file of a download
+               ex.
+               file.filepath = home/prova.txt
+               chunksMapPath = home/prova.txt_part.map
+    :param file: File object
+    :return: string representing the path
+    """
 
-    return tmpDirPath
+    return getPartFilePath(file) + ".map"
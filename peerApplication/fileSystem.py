@@ -200,6 +200,9 @@ class Node:
                 return
 
         last = nodeList.pop()
+        if last.file is not None:
+            # chunks of the file can't be copied into other local files anymore
+            fileManagement.chunkStore.removeFile(last.file)
         if removeFileObj:
             # delete File object
             del last.file
@@ -316,7 +319,8 @@ def fillNode(node, childs):
             file = fileManagement.File(fileInfo["groupName"], fileInfo["treePath"],
                                        fileInfo["filename"], fileInfo["filepath"],
                                        fileInfo["filesize"], fileInfo["timestamp"],
-                                       fileInfo["status"], fileInfo["previousChunks"])
+                                       fileInfo["status"], fileInfo["previousChunks"],
+                                       fileInfo.get("chunksHashes"), fileInfo.get("chunksSizes"))
             newNode = Node(child["nodeName"], False, file)
         node.addChild(newNode)
 
@@ -392,6 +396,8 @@ def fillChildsInfo(groupInfo, childs):
             nestedInfo["info"]["timestamp"] = child.file.timestamp
             nestedInfo["info"]["status"] = child.file.status
             nestedInfo["info"]["previousChunks"] = child.file.previousChunks
+            nestedInfo["info"]["chunksHashes"] = child.file.chunksHashes
+            nestedInfo["info"]["chunksSizes"] = child.file.chunksSizes
 
         groupInfo["childs"].append(nestedInfo)
 
@@ -105,6 +105,10 @@ class myP2PSync(QMainWindow):
         self.changeRoleLayout = QHBoxLayout()
         self.selectRole = QComboBox()
         self.changeRole = QPushButton("CHANGE ROLE")
+        self.syncPolicyLayout = QHBoxLayout()
+        self.selectPolicy = QComboBox()
+        self.selectWeight = QDoubleSpinBox()
+        self.setPolicy = QPushButton("SET SYNC POLICY")
         self.leaveDisconnectLayout = QHBoxLayout()
         self.leaveButton = QPushButton("LEAVE GROUP")
         self.disconnectButton = QPushButton("DISCONNECT")
@@ -203,6 +207,17 @@ class myP2PSync(QMainWindow):
         self.changeRoleLayout.addWidget(self.selectRole)
         self.changeRoleLayout.addWidget(self.changeRole)
         self.fileManagerLayout.addLayout(self.changeRoleLayout)
+        self.selectPolicy.addItem("FIFO")
+        self.selectPolicy.addItem("SMALLEST FIRST")
+        self.selectPolicy.addItem("NEWEST FIRST")
+        self.selectWeight.setPrefix("WEIGHT ")
+        self.selectWeight.setDecimals(1)
+        self.selectWeight.setRange(0.1, 100)
+        self.selectWeight.setToolTip("Share of the sync slots given to the group when other groups have files to sync")
+        self.syncPolicyLayout.addWidget(self.selectPolicy)
+        self.syncPolicyLayout.addWidget(self.selectWeight)
+        self.syncPolicyLayout.addWidget(self.setPolicy)
+        self.fileManagerLayout.addLayout(self.syncPolicyLayout)
         self.fileManagerLayout.addSpacing(30)
         self.leaveDisconnectLayout.addWidget(self.leaveButton)
         self.leaveDisconnectLayout.addWidget(self.disconnectButton)
@@ -221,11 +236,13 @@ class myP2PSync(QMainWindow):
         self.syncDirButton.clicked.connect(self.syncDirHandler)
         self.syncAllButton.clicked.connect(self.syncAllHandler)
         self.changeRole.clicked.connect(self.changeRoleHandler)
+        self.setPolicy.clicked.connect(self.setPolicyHandler)
         self.leaveButton.clicked.connect(self.leaveGroupHandler)
         self.disconnectButton.clicked.connect(self.disconnectGroupHandler)
 
         # connect the refresh signal signal to its handler
         self.signals.refresh.connect(self.refreshHandler)
+        self.signals.hashingDone.connect(self.hashingDoneHandler)
 
         # set and show peerID
         peerCore.setPeerID()
@@ -304,6 +321,44 @@ class myP2PSync(QMainWindow):
         if not self.fileList.isHidden():
             self.loadFileManager()
 
+    def runInBackground(self, hashFunction, hashArgs, function, args, successMessage, errorMessage):
+        """
+        Compute the digests of the files on a secondary thread, so that the GUI stays responsive
+        while the files are hashed. The hashing function doesn't touch the files tree:
+        the operation that modifies it is run on the GUI thread when the hashingDone signal is received.
+        :param hashFunction: peerCore function collecting the files information (None in case of error)
+        :param hashArgs: tuple of arguments of the hashing function
+        :param function: peerCore function receiving the files information as last argument, returning a boolean
+        :param args: tuple of arguments of the function (files information excluded)
+        :param successMessage: message shown if the operation succeeds
+        :param errorMessage: message shown if the operation fails
+        :return: void
+        """
+
+        def hashing():
+            filesInfo = hashFunction(*hashArgs)
+            self.signals.hashingDone.emit((filesInfo, function, args, successMessage, errorMessage))
+
+        t = Thread(target=hashing, args=())
+        t.daemon = True
+        t.start()
+
+    def hashingDoneHandler(self, operation):
+        """
+        Complete an operation whose files have been hashed in background and show its result.
+        :param operation: tuple (filesInfo, function, args, successMessage, errorMessage)
+        :return: void
+        """
+
+        filesInfo, function, args, successMessage, errorMessage = operation
+
+        if filesInfo is not None and function(*args, filesInfo):
+            self.addLogMessage(successMessage)
+            if not self.fileList.isHidden():
+                self.loadFileManager()
+        else:
+            self.addLogMessage(errorMessage)
+
     def closeEvent(self, event):
         """
         Handler for the closing operation (after a click on the 'X' in the window)
@@ -364,6 +419,9 @@ class myP2PSync(QMainWindow):
         self.peersList.hide()
         self.selectRole.hide()
         self.changeRole.hide()
+        self.selectPolicy.hide()
+        self.selectWeight.hide()
+        self.setPolicy.hide()
         self.leaveButton.hide()
         self.disconnectButton.hide()
 
@@ -569,6 +627,13 @@ class myP2PSync(QMainWindow):
         self.peersListLabel.show()
         self.fillPeersList()
         self.peersList.show()
+        # the sync policy and weight are local settings: show the current ones
+        policy = peerCore.getSyncPolicy(self.groupName).replace("_", " ")
+        self.selectPolicy.setCurrentIndex(self.selectPolicy.findText(policy))
+        self.selectWeight.setValue(peerCore.getSyncWeight(self.groupName))
+        self.selectPolicy.show()
+        self.selectWeight.show()
+        self.setPolicy.show()
         self.leaveButton.show()
         self.disconnectButton.show()
 
@@ -668,11 +733,10 @@ class myP2PSync(QMainWindow):
                                     filename cannot contains spaces!".format(filename))
 
         if len(filepaths) > 0:
-            if peerCore.addFiles(self.groupName, filepaths, directory=""):
-                self.loadFileManager()
-                self.addLogMessage("Files {} added to group {}".format(filenames[:-1], self.groupName))
-            else:
-                QMessageBox.about(self, "Error", "Cannot add the selected files!")
+            self.runInBackground(peerCore.getAddedFilesInfo, (filepaths, ""),
+                                 peerCore.addFiles, (self.groupName, filepaths, ""),
+                                 "Files {} added to group {}".format(filenames[:-1], self.groupName),
+                                 "Cannot add the selected files!")
         else:
             QMessageBox.about(self, "Error", "Cannot add the selected files!")
 
@@ -703,11 +767,10 @@ class myP2PSync(QMainWindow):
 
                             filepaths.append(filepath)
 
-                if peerCore.addFiles(self.groupName, filepaths, directory.replace("\\", "/")):
-                    self.addLogMessage("Directory {} added to group {}".format(dirName, self.groupName))
-                    self.loadFileManager()
-                else:
-                    QMessageBox.about(self, "Error", "It was not possible to add the directory {}".format(dirName))
+                self.runInBackground(peerCore.getAddedFilesInfo, (filepaths, directory.replace("\\", "/")),
+                                     peerCore.addFiles, (self.groupName, filepaths, directory.replace("\\", "/")),
+                                     "Directory {} added to group {}".format(dirName, self.groupName),
+                                     "It was not possible to add the directory {}".format(dirName))
             else:
                 QMessageBox.about(self, "Error", "Cannot add the selected directory")
         else:
@@ -803,12 +866,10 @@ class myP2PSync(QMainWindow):
                 if oldTimestamp < file.timestamp:
                     # the file can be updated: the local version is newer than the synched one
                     files.append((file, file.timestamp))
-                    if peerCore.updateFiles(self.groupName, files):
-                        self.addLogMessage("File {} synchronized".format(file.filename))
-                        self.loadFileManager()
-                    else:
-                        self.addLogMessage("It was not possible to synchronize the file {}"
-                                           .format(file.filename))
+                    self.runInBackground(peerCore.getUpdatedFilesInfo, (files,),
+                                         peerCore.updateFiles, (self.groupName, files),
+                                         "File {} synchronized".format(file.filename),
+                                         "It was not possible to synchronize the file {}".format(file.filename))
                 else:
                     QMessageBox.about(self, "Info", "File has been already synchronized")
             else:
@@ -848,12 +909,10 @@ class myP2PSync(QMainWindow):
 
                 if len(files) > 0:
 
-                    if peerCore.updateFiles(self.groupName, files):
-                        self.addLogMessage("Dir {} synchronized".format(dirName))
-                        self.loadFileManager()
-                    else:
-                        self.addLogMessage("It was not possible to synchronize the directory {}"
-                                           .format(dirName))
+                    self.runInBackground(peerCore.getUpdatedFilesInfo, (files,),
+                                         peerCore.updateFiles, (self.groupName, files),
+                                         "Dir {} synchronized".format(dirName),
+                                         "It was not possible to synchronize the directory {}".format(dirName))
 
                 else:
                     QMessageBox.about(self, "Info", "All files have been already synchronized")
@@ -897,11 +956,10 @@ class myP2PSync(QMainWindow):
                     files.append((file, file.timestamp))
 
             if len(files) > 0:
-                if peerCore.updateFiles(self.groupName, files):
-                    self.addLogMessage("All files have been synchronized")
-                    self.loadFileManager()
-                else:
-                    self.addLogMessage("It was not possible to synchronize all the files")
+                self.runInBackground(peerCore.getUpdatedFilesInfo, (files,),
+                                     peerCore.updateFiles, (self.groupName, files),
+                                     "All files have been synchronized",
+                                     "It was not possible to synchronize all the files")
             else:
                 QMessageBox.about(self, "Info", "All files are already synchronized")
 
@@ -932,6 +990,21 @@ class myP2PSync(QMainWindow):
         else:
             QMessageBox.about(self, "Error", "You must select a peer from the list")
 
+    def setPolicyHandler(self):
+        """
+        Set the order in which the files of the group are synchronized
+        and the share of the sync slots given to the group.
+        :return: void
+        """
+
+        # make policy string compatible with peerCore.setSyncPolicy()
+        policy = self.selectPolicy.currentText().replace(" ", "_")
+        weight = self.selectWeight.value()
+        if peerCore.setSyncPolicy(self.groupName, policy, weight):
+            self.addLogMessage("Sync policy of group {} set to {} (weight {})".format(self.groupName, policy, weight))
+        else:
+            QMessageBox.about(self, "Error", "Something went wrong!")
+
     def leaveGroupHandler(self):
         """
         Leave a group handler.
@@ -1022,6 +1095,9 @@ class mySig(QObject):
 
     # declare the signal
     refresh = pyqtSignal()
+    # emitted when the files of an operation have been hashed in background:
+    # tuple (filesInfo, function, args, successMessage, errorMessage)
+    hashingDone = pyqtSignal(object)
 
     def __init__(self):
         QObject.__init__(self)
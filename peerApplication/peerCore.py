@@ -32,6 +32,7 @@ import syncScheduler
 
 if "networking" not in sys.modules:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import shared.codec as codec
     import shared.networking as networking
 
 # Obtain script path and script name, it will be useful to manage filepaths
@@ -41,6 +42,7 @@ scriptPath += "/"
 # Set session files' paths
 configurationFile = scriptPath + "sessionFiles/configuration.json"
 previousSessionFile = scriptPath + "sessionFiles/fileList.json"
+syncPoliciesFile = scriptPath + "sessionFiles/syncPolicies.json"
 
 # Initialize some global variables
 peerID = None
@@ -51,6 +53,9 @@ myPortNumber = None
 # Lock used to avoid race conditions among threads
 pathCreationLock = Lock()
 
+# Process-wide pool of keep-alive connections toward other peers
+connectionPool = networking.ConnectionPool()
+
 # Main data structure for the groups handling.
 # It's a dictionary with the following structure:
 #    key: groupName
@@ -158,7 +163,10 @@ def getTrackerZTAddr():
         networking.closeConnection(s, peerID)
         return False
 
-    trackerZTAddr = eval(answer)
+    try:
+        trackerZTAddr = tuple(codec.decode(answer))
+    except (TypeError, ValueError):
+        return False
 
 
 def retrieveGroups():
@@ -190,7 +198,10 @@ def retrieveGroups():
     else:
         # set the local groups list equals to the retrieved one
         # split operation in order to skip the initial 'OK -'
-        groupsList = eval(answer.split(" ", 2)[2])
+        try:
+            groupsList = codec.decode(answer.split(" ", 2)[2])
+        except (IndexError, ValueError):
+            return False
 
     return True
 
@@ -412,11 +423,52 @@ def retrievePeers(groupName, selectAll):
         peersList = None
     else:
         # split operation in order to skip the initial 'OK -'
-        peersList = eval(answer.split(" ", 2)[2])
+        try:
+            peersList = codec.decode(answer.split(" ", 2)[2])
+        except (IndexError, ValueError):
+            peersList = None
 
     return peersList
 
 
+def getSyncPolicy(groupName):
+    """
+    Retrieve the scheduling policy used for the synchronizations of a group.
+    :param groupName: name of the group
+    :return: policy string (one of syncScheduler.POLICIES)
+    """
+
+    return syncScheduler.getGroupPolicy(groupName)["policy"]
+
+
+def getSyncWeight(groupName):
+    """
+    Retrieve the weight of a group, i.e. the share of the sync slots given to it.
+    :param groupName: name of the group
+    :return: positive number
+    """
+
+    return syncScheduler.getGroupPolicy(groupName)["weight"]
+
+
+def setSyncPolicy(groupName, policy, weight=None):
+    """
+    Set the scheduling policy and weight used for the synchronizations of a group
+    and save them, so that they're restored in the next sessions.
+    :param groupName: name of the group
+    :param policy: policy string (one of syncScheduler.POLICIES)
+    :param weight: positive number, share of the sync slots given to the group (current weight if None)
+    :return: boolean (True for success, False for any error)
+    """
+
+    if weight is None:
+        weight = getSyncWeight(groupName)
+    if not syncScheduler.setGroupPolicy(groupName, policy, weight):
+        return False
+
+    return syncScheduler.saveGroupsPolicy(syncPoliciesFile)
+
+
 def startPeer():
     """
     Load previous session information about files.
@@ -432,6 +484,9 @@ def startPeer():
     if localFileTree is None:
         return None
 
+    # restore the scheduling policies chosen in previous sessions (if any)
+    syncScheduler.loadGroupsPolicy(syncPoliciesFile)
+
     # create and start the scheduler thread
     schedulerThread = Thread(target=syncScheduler.scheduler, args=())
     schedulerThread.daemon = True
@@ -508,7 +563,11 @@ def startGroupSync(groupName):
         return
     else:
         # split operation in order to skip the initial 'OK -'
-        updatedFileList = eval(answer.split(" ", 2)[2])
+        try:
+            updatedFileList = codec.decodeFilesInfo(answer.split(" ", 2)[2])
+        except (IndexError, ValueError):
+            print("Invalid file list received from the tracker")
+            return
 
     # call the function that evaluates the information retrieved from the tracker
     # comparing them with local information about a previous session (if it exists)
@@ -555,18 +614,18 @@ def updateLocalGroupTree(groupName, localGroupTree, updatedFileList):
             if myFile.timestamp == fileInfo["timestamp"] and myFile.status == "D":
                 # file have been not synchronized yet e.g. partial sync
                 myFile.status = "D"
+                if myFile.chunksHashes is None:
+                    myFile.chunksHashes = fileInfo.get("chunksHashes")
+                    myFile.chunksSizes = fileInfo.get("chunksSizes")
                 task = syncScheduler.syncTask(groupName, myFile.treePath, myFile.timestamp)
                 syncScheduler.appendTask(task)
 
             elif myFile.timestamp < fileInfo["timestamp"]:
                 # local version is not the last one
-                # put file into a synchronization status
-                myFile.timestamp = int(fileInfo["timestamp"])
-                myFile.filesize = int(fileInfo["filesize"])
-                myFile.previousChunks = list()
-                myFile.status = "D"
-                task = syncScheduler.syncTask(groupName, myFile.treePath, myFile.timestamp)
-                syncScheduler.appendTask(task)
+                # put file into a synchronization status, unless only the timestamp changed
+                if myFile.updateVersion(fileInfo):
+                    task = syncScheduler.syncTask(groupName, myFile.treePath, myFile.timestamp)
+                    syncScheduler.appendTask(task)
 
             myFile.syncLock.release()
 
@@ -590,7 +649,9 @@ def updateLocalGroupTree(groupName, localGroupTree, updatedFileList):
             file = fileManagement.File(groupName=groupName, treePath=treePath,
                                        filename=filename, filepath=filepath,
                                        filesize=fileInfo["filesize"], timestamp=fileInfo["timestamp"],
-                                       status="D", previousChunks=list())
+                                       status="D", previousChunks=list(),
+                                       chunksHashes=fileInfo.get("chunksHashes"),
+                                       chunksSizes=fileInfo.get("chunksSizes"))
 
             localGroupTree.addNode(treePath, file)
 
@@ -609,23 +670,20 @@ def updateLocalGroupTree(groupName, localGroupTree, updatedFileList):
             localGroupTree.removeNode(treePath, True)
 
 
-def addFiles(groupName, filepaths, directory):
+def getAddedFilesInfo(filepaths, directory):
     """
-    Add a list of files to a synchronization group.
-    :param groupName: name of the group in which files will be added
+    Collect the information of a list of files that will be added to a synchronization group,
+    computing the chunks of the files and their digests.
+    It doesn't use any shared state, so it can be run outside the GUI thread.
     :param filepaths: filepaths list of the files that will be added
     :param directory: directory path (empty if the file doesn't belong a directory)
-    :return: boolean (True for success, False for any error)
+    :return: list of dictionaries (treePath, filepath, filesize, timestamp, chunksSizes, chunksHashes, merkleRoot)
     """
 
     # list of dictionary, where each dict contains all the info required
     # from the tracker to add a file in the group
     filesInfo = list()
 
-    # WP stands for Without FilePath: it's a copy of filesInfo but without filepaths
-    # because I don't need to send them to the tracker
-    filesInfoWFP = list()
-
     if directory == "":
         for filepath in filepaths:
             fileInfo = dict()
@@ -633,12 +691,12 @@ def addFiles(groupName, filepaths, directory):
             __, fileInfo["treePath"] = os.path.split(filepath)
             fileInfo["filepath"] = filepath
             fileInfo["filesize"], fileInfo["timestamp"] = fileManagement.getFileStat(filepath)
+            # chunks and their digests, used by other peers to verify the received chunks
+            fileInfo["chunksSizes"], fileInfo["chunksHashes"] = \
+                fileManagement.computeChunks(filepath, fileInfo["filesize"])
+            fileInfo["merkleRoot"] = fileManagement.getMerkleRoot(fileInfo["chunksHashes"])
             filesInfo.append(fileInfo)
 
-            fileInfoWFP = fileInfo.copy()
-            del fileInfoWFP["filepath"]
-            filesInfoWFP.append(fileInfoWFP)
-
     else:
         # it's a directory
         for filepath in filepaths:
@@ -652,11 +710,35 @@ def addFiles(groupName, filepaths, directory):
             fileInfo["treePath"] = filepath.replace(dirPath, "")[1:]
             fileInfo["filepath"] = filepath
             fileInfo["filesize"], fileInfo["timestamp"] = fileManagement.getFileStat(filepath)
+            # chunks and their digests, used by other peers to verify the received chunks
+            fileInfo["chunksSizes"], fileInfo["chunksHashes"] = \
+                fileManagement.computeChunks(filepath, fileInfo["filesize"])
+            fileInfo["merkleRoot"] = fileManagement.getMerkleRoot(fileInfo["chunksHashes"])
             filesInfo.append(fileInfo)
 
-            fileInfoWFP = fileInfo.copy()
-            del fileInfoWFP["filepath"]
-            filesInfoWFP.append(fileInfoWFP)
+    return filesInfo
+
+
+def addFiles(groupName, filepaths, directory, filesInfo=None):
+    """
+    Add a list of files to a synchronization group.
+    :param groupName: name of the group in which files will be added
+    :param filepaths: filepaths list of the files that will be added
+    :param directory: directory path (empty if the file doesn't belong a directory)
+    :param filesInfo: information of the files returned by getAddedFilesInfo (computed if not provided)
+    :return: boolean (True for success, False for any error)
+    """
+
+    if filesInfo is None:
+        filesInfo = getAddedFilesInfo(filepaths, directory)
+
+    # WP stands for Without FilePath: it's a copy of filesInfo but without filepaths
+    # because I don't need to send them to the tracker
+    filesInfoWFP = list()
+    for fileInfo in filesInfo:
+        fileInfoWFP = fileInfo.copy()
+        del fileInfoWFP["filepath"]
+        filesInfoWFP.append(fileInfoWFP)
 
     s = networking.createConnection(trackerZTAddr)
     if s is None:
@@ -664,7 +746,7 @@ def addFiles(groupName, filepaths, directory):
 
     try:
         # send request message and wait for the answer, then close the socket
-        message = str(peerID) + " " + "ADDED_FILES {} {}".format(groupName, str(filesInfoWFP))
+        message = str(peerID) + " " + "ADDED_FILES {} {}".format(groupName, codec.encodeFilesInfo(filesInfoWFP))
         networking.mySend(s, message)
         answer = networking.myRecv(s)
         networking.closeConnection(s, peerID)
@@ -689,7 +771,9 @@ def addFiles(groupName, filepaths, directory):
             file = fileManagement.File(groupName=groupName, treePath=treePath,
                                        filename=filename, filepath=fileInfo["filepath"],
                                        filesize=fileInfo["filesize"], timestamp=fileInfo["timestamp"],
-                                       status="S", previousChunks=list())
+                                       status="S", previousChunks=list(),
+                                       chunksHashes=fileInfo["chunksHashes"],
+                                       chunksSizes=fileInfo["chunksSizes"])
 
             groupTree.addNode(treePath, file)
             file.initSeed()
@@ -700,18 +784,18 @@ def addFiles(groupName, filepaths, directory):
         # notify other active peers
         for peer in activePeers:
 
-            s = networking.createConnection(peer["address"])
+            s = connectionPool.getConnection(peer["address"])
             if s is None:
                 continue
 
             try:
-                # send request message and wait for the answer, then close the socket
-                message = str(peerID) + " " + "ADDED_FILES {} {}".format(groupName, str(filesInfoWFP))
+                # send request message and wait for the answer, then give back the connection
+                message = str(peerID) + " " + "ADDED_FILES {} {}".format(groupName, codec.encodeFilesInfo(filesInfoWFP))
                 networking.mySend(s, message)
                 __ = networking.myRecv(s)
-                networking.closeConnection(s, peerID)
-            except (socket.timeout, RuntimeError, ValueError):
-                networking.closeConnection(s, peerID)
+                connectionPool.releaseConnection(s)
+            except (socket.timeout, OSError, RuntimeError, ValueError):
+                connectionPool.discardConnection(s)
                 continue
 
         return True
@@ -731,7 +815,7 @@ def removeFiles(groupName, treePaths):
 
     try:
         # send request message and wait for the answer, then close the socket
-        message = str(peerID) + " " + "REMOVED_FILES {} {}".format(groupName, str(treePaths))
+        message = str(peerID) + " " + "REMOVED_FILES {} {}".format(groupName, codec.encode(treePaths))
         networking.mySend(s, message)
         answer = networking.myRecv(s)
         networking.closeConnection(s, peerID)
@@ -763,50 +847,77 @@ def removeFiles(groupName, treePaths):
         # notify other active peers
         for peer in activePeers:
 
-            s = networking.createConnection(peer["address"])
+            s = connectionPool.getConnection(peer["address"])
             if s is None:
                 continue
 
             try:
-                # send request message and wait for the answer, then close the socket
-                message = str(peerID) + " " + "REMOVED_FILES {} {}".format(groupName, str(treePaths))
+                # send request message and wait for the answer, then give back the connection
+                message = str(peerID) + " " + "REMOVED_FILES {} {}".format(groupName, codec.encode(treePaths))
                 networking.mySend(s, message)
                 __ = networking.myRecv(s)
-                networking.closeConnection(s, peerID)
-            except (socket.timeout, RuntimeError, ValueError):
-                networking.closeConnection(s, peerID)
+                connectionPool.releaseConnection(s)
+            except (socket.timeout, OSError, RuntimeError, ValueError):
+                connectionPool.discardConnection(s)
                 continue
 
         return True
 
 
-def updateFiles(groupName, files):
+def getUpdatedFilesInfo(files):
     """
-    Update a list of file in the synchronization group,
-    making them ready to be acknowledged from other peers.
-    :param groupName: name of the group from which files will be updated
+    Collect the information of the new versions of a list of files,
+    computing the chunks of the files and their digests.
+    The File objects are not modified, so it can be run outside the GUI thread.
     :param files: list of tuples (fileObject, timestamp)
-    :return: void
+    :return: list of dictionaries (treePath, filesize, timestamp, chunksHashes, merkleRoot, chunksSizes)
+             or None if a file can't be read
     """
 
-    s = networking.createConnection(trackerZTAddr)
-    if s is None:
-        return False
-
     # collect information required for the update operation
     filesInfo = list()
 
     for f in files:
         file = f[0]
+        # chunks of the new version and their digests: the File object is not modified here,
+        # it can still be used by a synchronization until its lock is acquired
+        chunksSizes, chunksHashes = fileManagement.computeChunks(file.filepath, file.filesize)
+        if chunksHashes is None:
+            return None
         fileInfo = dict()
         fileInfo["treePath"] = file.treePath
         fileInfo["filesize"] = file.filesize
         fileInfo["timestamp"] = file.timestamp
+        fileInfo["chunksHashes"] = chunksHashes
+        fileInfo["merkleRoot"] = fileManagement.getMerkleRoot(chunksHashes)
+        fileInfo["chunksSizes"] = chunksSizes
         filesInfo.append(fileInfo)
 
+    return filesInfo
+
+
+def updateFiles(groupName, files, filesInfo=None):
+    """
+    Update a list of file in the synchronization group,
+    making them ready to be acknowledged from other peers.
+    :param groupName: name of the group from which files will be updated
+    :param files: list of tuples (fileObject, timestamp)
+    :param filesInfo: information of the new versions returned by getUpdatedFilesInfo (computed if not provided)
+    :return: boolean (True for success, False for any error)
+    """
+
+    if filesInfo is None:
+        filesInfo = getUpdatedFilesInfo(files)
+    if filesInfo is None:
+        return False
+
+    s = networking.createConnection(trackerZTAddr)
+    if s is None:
+        return False
+
     try:
         # send request message and wait for the answer, then close the socket
-        message = str(peerID) + " " + "UPDATED_FILES {} {}".format(groupName, str(filesInfo))
+        message = str(peerID) + " " + "UPDATED_FILES {} {}".format(groupName, codec.encodeFilesInfo(filesInfo))
         networking.mySend(s, message)
         answer = networking.myRecv(s)
         networking.closeConnection(s, peerID)
@@ -820,7 +931,7 @@ def updateFiles(groupName, files):
         return False
     else:
 
-        for f in files:
+        for f, fileInfo in zip(files, filesInfo):
             file = f[0]
             timestamp = f[1]
             key = file.groupName + "_" + file.treePath
@@ -830,16 +941,14 @@ def updateFiles(groupName, files):
             # make the peer ready to upload chunks
             if file.syncLock.acquire(blocking=False):
                 # file not used by any sinchronization process
+                file.chunksSizes, file.chunksHashes = fileInfo["chunksSizes"], fileInfo["chunksHashes"]
                 file.status = "S"
                 file.initSeed()
                 file.syncLock.release()
             else:
-                # file is currently in synchronization
-                # create a thread which will wait under the end of the synchronization
-                # and then it will update file state
-                t = Thread(target=waitSyncAndUpdate, args=(file, timestamp))
-                t.daemon = True
-                t.start()
+                # file is currently in synchronization:
+                # update file state at the end of the synchronization
+                syncScheduler.runAfterSync(key, waitSyncAndUpdate, (file, timestamp, fileInfo))
 
         # retrieve the list of active peers for the file
         activePeers = retrievePeers(groupName, selectAll=False)
@@ -847,41 +956,44 @@ def updateFiles(groupName, files):
         # notify other active peers
         for peer in activePeers:
 
-            s = networking.createConnection(peer["address"])
+            s = connectionPool.getConnection(peer["address"])
             if s is None:
                 continue
 
             try:
-                # send request message and wait for the answer, then close the socket
-                message = str(peerID) + " " + "UPDATED_FILES {} {}".format(groupName, str(filesInfo))
+                # send request message and wait for the answer, then give back the connection
+                message = str(peerID) + " " + "UPDATED_FILES {} {}".format(groupName, codec.encodeFilesInfo(filesInfo))
                 networking.mySend(s, message)
                 __ = networking.myRecv(s)
-                networking.closeConnection(s, peerID)
-            except (socket.timeout, RuntimeError, ValueError):
-                networking.closeConnection(s, peerID)
+                connectionPool.releaseConnection(s)
+            except (socket.timeout, OSError, RuntimeError, ValueError):
+                connectionPool.discardConnection(s)
                 continue
 
         return True
 
 
-def waitSyncAndUpdate(file, timestamp):
+def waitSyncAndUpdate(file, timestamp, fileInfo):
     """
-    Wait until the file lock is released and then update the file object
+    Update the file object, if the file lock is free.
+    Executed by the scheduler thread (see syncScheduler.runAfterSync).
     :param file: File object to update
     :param timestamp: timestamp of the update operation
-    :return: void
+    :param fileInfo: dictionary of information about the new version of the file (chunks included)
+    :return: boolean (False if the file is still locked, the update is retried later)
     """
 
-    # iterate until the lock is blocked
-    # sleeping for 0.5 second after a False check
-    while not file.syncLock.acquire(blocking=False):
-        time.sleep(0.5)
+    # the scheduler thread doesn't wait until the lock is released by the synchronization
+    if not file.syncLock.acquire(blocking=False):
+        return False
 
     if timestamp == file.timestamp:
         # equals timestamp, operation still valid
+        file.chunksSizes, file.chunksHashes = fileInfo["chunksSizes"], fileInfo["chunksHashes"]
         file.status = "S"
         file.initSeed()
     file.syncLock.release()
+    return True
 
 
 def leaveGroup(groupName):
@@ -993,6 +1105,9 @@ def peerExit():
         # stop every working synchronization thread
         syncScheduler.stopAllSyncThreads(syncScheduler.SYNC_STOPPED)
 
+        # close keep-alive connections toward other peers
+        connectionPool.closeAll()
+
         # leave ZetoTier network
         networking.leaveNetwork()
 
@@ -16,10 +16,13 @@ for more details.
 """
 
 import os
-import select
+import selectors
 import socket
 import sys
-from threading import Thread
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
 
 import fileSharing
 import syncScheduler
@@ -28,20 +31,38 @@ if "networking" not in sys.modules:
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     import shared.networking as networking
 
+# maximum number of requests (e.g. chunks reads from disk) served concurrently
+MAX_WORKERS = 8
+
+# maximum time (seconds) the server event loop waits for events before checking the stop condition
+SELECT_TIMEOUT = 1.0
+
+# maximum number of pipelined requests served in a row on the same connection
+MAX_REQUESTS_PER_TURN = 16
+
+# seconds after which an idle connection with another peer is closed
+# (connections carrying chunks announcements are never idle)
+IDLE_TIMEOUT = 60
+# seconds between two scans of the connections looking for the idle ones
+IDLE_CHECK_PERIOD = IDLE_TIMEOUT / 4
+
 
 class Server(Thread):
     """
-    Multithread server class that will manage incoming connections.
-    For each incoming connection it will create a thread.
-    This thread will manage the request and terminate.
+    Event-loop server class that will manage incoming connections.
+    A single thread waits, using a selector, for requests on all the connections:
+    when a request is available the connection is handed over to a bounded pool of
+    workers that serves it (reading chunks from disk may block) and gives the
+    connection back to the event loop.
     The server runs until the property __stop is equals to False.
     The port on which the server will listen is choosen among available ports.
     """
 
-    def __init__(self, max_clients=5):
+    def __init__(self, max_clients=socket.SOMAXCONN, maxWorkers=MAX_WORKERS):
         """
         Initialize server.
-        :param max_clients: maximum number of incoming connections.
+        :param max_clients: maximum number of pending incoming connections.
+        :param maxWorkers: maximum number of requests served concurrently
         :return: void
         """
         Thread.__init__(self)
@@ -56,53 +77,174 @@ class Server(Thread):
         self.port = self.sock.getsockname()[1]
 
         self.sock.listen(max_clients)
-        self.sockThreads = []
+        self.sock.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+
+        # workers threads serving the requests
+        self.workers = ThreadPoolExecutor(max_workers=maxWorkers)
+
+        # connections served by a worker that have to be given back to the event loop,
+        # the event loop is woken up writing a byte on the wake pipe
+        self.returned = deque()
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.wakeRead.setblocking(False)
+        self.wakeWrite.setblocking(False)
+        self.selector.register(self.wakeRead, selectors.EVENT_READ, self.wakeRead)
+
+        # open connections (both idle and served by a worker)
+        self.connections = set()
 
-        # give a number to each thread
+        # give a number to each connection
         self.counter = 0
         self.__stop = False
         self.serverStart = False
 
     def run(self):
         """
-        Accept an incoming connection.
-        Start a new SocketServerThread that will handle the communication.
+        Wait for incoming connections and requests.
+        Each request is served by a worker of the pool.
         :return: void
         """
 
         print('Starting socket server (host {}, port {})'.format(self.host, self.port))
         self.serverStart = True
 
+        # time of the next scan of the idle connections
+        idleCheckTime = time.time() + IDLE_CHECK_PERIOD
+
         while not self.__stop:
-            self.sock.settimeout(1)
+            events = self.selector.select(timeout=SELECT_TIMEOUT)
+
+            for key, mask in events:
+                if key.data is None:
+                    self.acceptConnections()
+                elif key.data is self.wakeRead:
+                    self.registerReturned()
+                else:
+                    # a request is available: the connection is given to a worker
+                    # and it is not watched until the worker has finished
+                    conn = key.data
+                    self.selector.unregister(conn.clientSock)
+                    self.workers.submit(self.serveConnection, conn)
+
+            if time.time() >= idleCheckTime:
+                # the scan costs O(connections): it's not done at every iteration
+                self.closeIdleConnections()
+                idleCheckTime = time.time() + IDLE_CHECK_PERIOD
+
+        self.closeServer()
+
+    def acceptConnections(self):
+        """
+        Accept all the pending incoming connections.
+        :return: void
+        """
+
+        while True:
             try:
-                # accept an incoming connection
                 clientSock, clientAddr = self.sock.accept()
-            except socket.timeout:
-                clientSock = None
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. too many open files: retry at next event
+                print("Error while accepting a connection: {}".format(e))
+                return
+
+            # worker will use blocking operations (with timeout) on the socket
+            clientSock.settimeout(networking.TIMEOUT)
+            conn = PeerConnection(clientSock, clientAddr, self.counter)
+            self.counter += 1
+            self.connections.add(conn)
+            self.selector.register(clientSock, selectors.EVENT_READ, conn)
+
+    def serveConnection(self, conn):
+        """
+        Serve a request available on a connection, executed by a worker.
+        At the end the connection is given back to the event loop.
+        :param conn: PeerConnection object
+        :return: void
+        """
 
-            if clientSock:
-                # create and start a thread that will handle the communication
-                clientThr = SocketServerThread(clientSock, clientAddr, self.counter)
-                self.counter += 1
-                self.sockThreads.append(clientThr)
-                clientThr.daemon = True
-                clientThr.start()
+        try:
+            conn.serveRequests()
+        except Exception as e:
+            print("[Conn {}] Error serving {}: {}".format(conn.number, conn.clientAddr, e))
+            conn.closed = True
+
+        conn.lastActivity = time.time()
+        self.returned.append(conn)
+        try:
+            self.wakeWrite.send(b"\x00")
+        except (BlockingIOError, InterruptedError):
+            # the wake pipe is full, the event loop will be woken up anyway
+            pass
+        except OSError:
+            # server closed
+            pass
+
+    def registerReturned(self):
+        """
+        Watch again the connections given back by workers, close the terminated ones.
+        :return: void
+        """
 
-        self.closeServer()
+        try:
+            while self.wakeRead.recv(networking.BUFSIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while len(self.returned) > 0:
+            conn = self.returned.popleft()
+            if conn.closed or self.__stop:
+                self.closeConnection(conn)
+            else:
+                self.selector.register(conn.clientSock, selectors.EVENT_READ, conn)
+
+    def closeIdleConnections(self):
+        """
+        Close the connections without requests for more than IDLE_TIMEOUT seconds,
+        except the ones with subscriptions to chunks announcements.
+        :return: void
+        """
+
+        limit = time.time() - IDLE_TIMEOUT
+        for key in list(self.selector.get_map().values()):
+            conn = key.data
+            if isinstance(conn, PeerConnection) and conn.lastActivity < limit and len(conn.subscriptions) == 0:
+                self.selector.unregister(conn.clientSock)
+                self.closeConnection(conn)
+
+    def closeConnection(self, conn):
+        """
+        Close a connection and forget it.
+        :param conn: PeerConnection object
+        :return: void
+        """
+
+        self.connections.discard(conn)
+        fileSharing.removeSubscriptions(conn)
+        conn.close()
 
     def closeServer(self):
         """
-        Close the client socket threads and server socket if they exists.
+        Wait for the running requests and close the connections and server socket if they exists.
         :return: void
         """
 
         print('Closing server socket (host {}, port {})'.format(self.host, self.port))
 
-        # wait for running thread termination
-        for thr in self.sockThreads:
-            thr.stop()
-            thr.join()
+        # wait for running requests termination
+        self.workers.shutdown(wait=True)
+
+        for conn in list(self.connections):
+            self.closeConnection(conn)
+
+        self.selector.close()
+        self.wakeRead.close()
+        self.wakeWrite.close()
 
         if self.sock:
             self.sock.close()
@@ -116,67 +258,75 @@ class Server(Thread):
         self.__stop = True
 
 
-# Thread which will manage an incoming connection and then terminate.
-class SocketServerThread(Thread):
+class PeerConnection:
+    """
+    Connection with another peer.
+    It's watched by the server event loop while idle and served by a worker
+    when a request is available.
+    """
 
     def __init__(self, clientSock, clientAddr, number):
         """
-        Initialize the Thread with a client socket and address.
+        Initialize the connection with a client socket and address.
         :return: void
         """
 
-        Thread.__init__(self)
         self.clientSock = clientSock
         self.clientAddr = clientAddr
         self.number = number
-        self.__stop = False
-
-    def run(self):
+        self.handshake = False  # framing mode not agreed yet
+        self.lastActivity = time.time()
+        self.closed = False
+        # files of which chunks announcements are sent on the connection, (groupName, treePath) tuples
+        self.subscriptions = set()
+        # announcements can be sent while a worker serves a request: the lock keeps messages whole
+        self.sendLock = Lock()
+        # HAVE messages waiting to be sent, and whether a worker is sending them (see fileSharing.announceChunk)
+        self.announcements = list()
+        self.announcing = False
+
+    def serveRequests(self):
         """
-        Run the thread socketServer and manage the incoming communication.
+        Read and manage the requests available on the connection.
+        The first time the framing mode is agreed with the remote host.
+        Pipelined requests already received are served in a row, up to
+        MAX_REQUESTS_PER_TURN, then the connection is given back to the event loop.
         :return: void
         """
 
-        # print("[Thr {}] SocketServerThread starting with peer {}".format(self.number, self.clientAddr))
-
-        while not self.__stop:
-            if self.clientSock:
-                # Check if the client is still connected and if data is available:
-                try:
-                    rdyRead, __, __ = select.select([self.clientSock, ], [self.clientSock, ], [], 5)
-                except select.error:
-                    print('[Thr {}] Select() failed on socket with {}'.format(self.number, self.clientAddr))
-                    self.stop()
-                    return
-
-                if len(rdyRead) > 0:
-                    # read request
-                    readData = networking.myRecv(self.clientSock)
-
-                    # Check if socket has been closed
-                    if len(readData) == 0:
-                        # print('[Thr {}] {} closed the socket.'.format(self.number, self.clientAddr))
-                        self.stop()
-                    else:
-                        # Strip newlines just for output clarity
-                        message = readData.rstrip()
-                        messageFields = message.split(' ', 1)
-                        peerID = messageFields[0]
-                        message = messageFields[1]
-                        self.manageRequest(message, peerID)
-            else:
-                print("[Thr {}] No peer is connected, SocketServer can't receive data".format(self.number))
-                self.stop()
-
-        self.close()
+        if not self.handshake:
+            # agree the framing mode with the remote host
+            self.clientSock = networking.acceptConnection(self.clientSock)
+            self.handshake = True
+            if self.clientSock is None:
+                self.closed = True
+                return
 
-    def stop(self):
-        """
-        Stop the thread socket server.
-        :return: void
-        """
+        for __ in range(MAX_REQUESTS_PER_TURN):
+            # serve only requests that can be read without waiting
+            if not networking.waitReadable(self.clientSock, 0):
+                return
 
-        self.__stop = True
+            # read request
+            try:
+                readData = networking.myRecv(self.clientSock)
+            except (socket.timeout, OSError, RuntimeError, ValueError):
+                # connection closed or broken by the remote host
+                readData = ""
+
+            # Check if socket has been closed
+            if len(readData) == 0:
+                self.closed = True
+                return
+
+            # Strip newlines just for output clarity
+            message = readData.rstrip()
+            messageFields = message.split(' ', 1)
+            peerID = messageFields[0]
+            message = messageFields[1]
+            if self.manageRequest(message, peerID):
+                self.closed = True
+                return
 
     def close(self):
         """
@@ -184,31 +334,47 @@ class SocketServerThread(Thread):
         :return: void
         """
 
+        self.closed = True
         if self.clientSock:
-            # print('[Thr {}] Closing connection with {}'.format(self.number, self.clientAddr))
             self.clientSock.close()
 
-
     def manageRequest(self, message, peerID):
         """
         Manage different incoming requests.
         Call an appropriate handler according to the message content.
+        Requests are served one at a time, so pipelined requests (e.g. CHUNK)
+        are answered in the same order in which they have been sent.
         :param message: incoming message
         :param peerID: id of the peer who sent the message
-        :return: void
+        :return: True if the connection has to be closed, False otherwise
         """
 
         action = message.split()[0]
 
         # if action != "BYE":
-        #     print('[Thr {}] [Peer: {}] Received {}'.format(self.number, peerID, message))
+        #     print('[Conn {}] [Peer: {}] Received {}'.format(self.number, peerID, message))
 
         if action == "CHUNKS_LIST":
             fileSharing.sendChunksList(message, self)
 
+        elif action == "CHUNKS_LISTS":
+            fileSharing.sendChunksLists(message, self)
+
+        elif action == "BUNDLE":
+            fileSharing.sendBundle(message, self)
+
+        elif action == "SUBSCRIBE":
+            fileSharing.subscribeChunks(message, self)
+
+        elif action == "UNSUBSCRIBE":
+            fileSharing.unsubscribeChunks(message, self)
+
         elif action == "CHUNK":
             fileSharing.sendChunk(message, self)
 
+        elif action == "DELTA":
+            fileSharing.sendDelta(message, self)
+
         elif action == "ADDED_FILES":
             answer = syncScheduler.addedFiles(message)
             networking.mySend(self.clientSock, answer)
@@ -224,4 +390,6 @@ class SocketServerThread(Thread):
         elif action == "BYE":
             answer = "BYE PEER"
             networking.mySend(self.clientSock, answer)
-            self.stop()
+            return True
+
+        return False
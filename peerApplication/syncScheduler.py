@@ -16,33 +16,87 @@ for more details.
 """
 
 
+import heapq
+import json
 import os
+import sys
 import time
-from collections import deque
-from threading import Thread, Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Event
 
 import fileManagement
 import fileSharing
 import peerCore
 
-# Data structure where sync operations will be scheduled
-queue = deque()
+if "codec" not in sys.modules:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import shared.codec as codec
+
+# lock on the queue of sync operations (see queue below)
 queueLock = Lock()
 
 # Global variable used to stop the sync scheduler thread
 stop = False
 
+# Event used to wake up the scheduler thread: it's set when a task is appended,
+# when a synchronization ends (freeing a sync thread slot) and when the scheduler is stopped
+schedulerEvent = Event()
+
+# maximum time (seconds) the scheduler waits before re-checking tasks postponed
+# because their file was locked by another operation
+POSTPONED_RETRY_PERIOD = 1.0
+
 # Data structure that keep tracks of synchronization threads
 # associated to file that are being synchronized
 # key : groupName_filename, makes possible to identify files
 # values: dict()    ->      groupName
-#                           stop
+#                           state
+#                           file (File object, set when the download starts)
+#                           download (Download object, set when the download starts)
+#                           deferred (list of actions executed at the end of the sync)
 syncThreads = dict()
 syncThreadsLock = Lock()
 
+# actions waiting for the lock of a file (see runAfterSync), executed by the scheduler thread:
+# list of (function, args) tuples, a function returns False if the file is still locked
+# and then it's retried after POSTPONED_RETRY_PERIOD
+pendingActions = list()
+
 # Maximum number of synchronization threads working at the same time
 MAX_SYNC_THREAD = 5
 
+# pool of workers executing the synchronizations
+syncWorkers = ThreadPoolExecutor(max_workers=MAX_SYNC_THREAD)
+
+# scheduling policies, used to order the sync tasks of a group
+# tasks are scheduled in the same order in which they have been appended
+POLICY_FIFO = "FIFO"
+# smaller files first (shortest job first)
+POLICY_SMALLEST_FIRST = "SMALLEST_FIRST"
+# most recently updated files first (bigger timestamp)
+POLICY_NEWEST_FIRST = "NEWEST_FIRST"
+
+# all the available scheduling policies
+POLICIES = (POLICY_FIFO, POLICY_SMALLEST_FIRST, POLICY_NEWEST_FIRST)
+
+# policy of groups without an explicit policy
+DEFAULT_POLICY = POLICY_FIFO
+
+# weight of groups without an explicit weight: groups with waiting tasks get a number
+# of sync slots proportional to their weight (weighted fair share across groups)
+DEFAULT_WEIGHT = 1
+
+# seconds after which a waiting task is scheduled before any other task,
+# regardless of policies and weights (starvation protection)
+MAX_TASK_WAIT = 300
+
+# scheduling policy and weight of each group
+# key: groupName
+# value: dict()     ->      policy
+#                           weight
+groupsPolicy = dict()
+
 # define synchronization thread possible states
 # synchronization thread is working
 SYNC_RUNNING = 0
@@ -77,6 +131,9 @@ class syncTask:
         self.groupName = groupName
         self.fileTreePath = fileTreePath
         self.timestamp = timestamp
+        self.filesize = 0  # size of the file version, set when the task is appended
+        self.appendTime = None  # time of the first insertion in the queue
+        self.seq = None  # insertion number in the queue
 
     def toString(self):
         """
@@ -100,68 +157,383 @@ class syncTask:
 
         return False
 
+    def getKey(self):
+        """
+        Return the key of the file the task refers to.
+        :return: tuple (groupName, fileTreePath)
+        """
+        return self.groupName, self.fileTreePath
+
+
+class TaskQueue:
+    """
+    Priority queue of synchronization tasks holding at most one task for each file.
+    Tasks are indexed by file, so a new version of a file replaces the queued task
+    in constant time, and by group: each group has its own heap ordered by the
+    scheduling policy of the group.
+    The group of the next task is selected by weighted fair share (stride scheduling),
+    except for tasks waiting from more than MAX_TASK_WAIT seconds, that are served first.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty queue.
+        """
+        # key: (groupName, fileTreePath), value: syncTask, in insertion order (oldest first)
+        self.tasks = OrderedDict()
+        # key: groupName, value: dict()     ->      heap (list of (priority, seq, key))
+        #                                           count (number of queued tasks of the group)
+        #                                           pass (virtual time of the group)
+        self.groups = dict()
+        self.counter = 0  # number of insertions, used to break priority ties in FIFO order
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def append(self, task):
+        """
+        Append a task to the queue.
+        A task outdated with respect to a queued task of the same file (older or equal
+        timestamp) is not appended, while an outdated queued task is replaced.
+        :param task: syncTask object
+        :return: boolean (True if the task has been appended, otherwise False)
+        """
+        key = task.getKey()
+        queuedTask = self.tasks.get(key)
+
+        if queuedTask is not None:
+            if task.isOutdated(queuedTask):
+                return False
+            # the new version of the file inherits the waiting time of the old one
+            task.appendTime = queuedTask.appendTime
+            self.tasks[key] = task
+        else:
+            task.appendTime = time.time()
+            self.tasks[key] = task
+            self.getGroup(task.groupName)["count"] += 1
+
+        self.push(task)
+        return True
+
+    def appendLeft(self, task):
+        """
+        Insert again a task extracted from the queue, keeping its waiting time,
+        unless a task of the same file has been queued in the meanwhile.
+        :param task: syncTask object
+        :return: boolean (True if the task has been inserted, otherwise False)
+        """
+        key = task.getKey()
+        if key in self.tasks:
+            return False
+
+        self.tasks[key] = task
+        self.tasks.move_to_end(key, last=False)
+        self.getGroup(task.groupName)["count"] += 1
+        self.push(task)
+        return True
+
+    def popLeft(self):
+        """
+        Extract the next task to be scheduled.
+        :return: syncTask object
+        :raise KeyError: if the queue is empty
+        """
+
+        if len(self.tasks) == 0:
+            raise KeyError("empty queue")
+
+        oldestTask = next(iter(self.tasks.values()))
+
+        if time.time() - oldestTask.appendTime > MAX_TASK_WAIT:
+            # starvation protection
+            task = oldestTask
+        else:
+            # select the group with the smallest virtual time
+            groupName = min((g for g in self.groups if self.groups[g]["count"] > 0),
+                            key=lambda g: self.groups[g]["pass"])
+            task = self.peek(groupName)
+
+        group = self.groups[task.groupName]
+        del self.tasks[task.getKey()]
+        group["count"] -= 1
+        # advance the virtual time of the group proportionally to its weight
+        group["pass"] += 1 / getGroupPolicy(task.groupName)["weight"]
+        return task
+
+    def removeGroup(self, groupName):
+        """
+        Remove all the tasks of a group.
+        :param groupName: name of the group
+        :return: void
+        """
+        group = self.groups.pop(groupName, None)
+        if group is None:
+            return
+        for __, __, key in group["heap"]:
+            self.tasks.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all the tasks.
+        :return: void
+        """
+        self.tasks.clear()
+        self.groups.clear()
+
+    def reorderGroup(self, groupName):
+        """
+        Rebuild the heap of a group, e.g. after a change of its scheduling policy.
+        Outdated heap entries are dropped.
+        :param groupName: name of the group
+        :return: void
+        """
+        group = self.groups.get(groupName)
+        if group is None:
+            return
+        policy = getGroupPolicy(groupName)["policy"]
+        group["heap"] = [(getPriority(self.tasks[key], policy), seq, key)
+                         for __, seq, key in group["heap"]
+                         if key in self.tasks and self.tasks[key].seq == seq]
+        heapq.heapify(group["heap"])
+
+    def getGroup(self, groupName):
+        """
+        Return the data structure of a group, creating it if it doesn't exist.
+        :param groupName: name of the group
+        :return: dictionary
+        """
+        group = self.groups.get(groupName)
+        if group is None:
+            # a new group starts from the current minimum virtual time:
+            # it can't monopolize the scheduler claiming the time it has not been waiting
+            activePasses = [g["pass"] for g in self.groups.values() if g["count"] > 0]
+            group = {"heap": list(), "count": 0,
+                     "pass": min(activePasses) if len(activePasses) > 0 else 0}
+            self.groups[groupName] = group
+        elif group["count"] == 0:
+            # idle group: same as a new one
+            activePasses = [g["pass"] for g in self.groups.values() if g["count"] > 0]
+            if len(activePasses) > 0:
+                group["pass"] = max(group["pass"], min(activePasses))
+        return group
+
+    def push(self, task):
+        """
+        Insert a task in the heap of its group.
+        :param task: syncTask object
+        :return: void
+        """
+        group = self.groups[task.groupName]
+        task.seq = self.counter
+        self.counter += 1
+        policy = getGroupPolicy(task.groupName)["policy"]
+        heapq.heappush(group["heap"], (getPriority(task, policy), task.seq, task.getKey()))
+
+        # replaced tasks leave outdated entries in the heap: compact it if they are too many
+        if len(group["heap"]) > 2 * group["count"] + 16:
+            self.reorderGroup(task.groupName)
+
+    def peek(self, groupName):
+        """
+        Return the task with the highest priority of a group,
+        dropping outdated entries on the top of its heap.
+        :param groupName: name of the group
+        :return: syncTask object
+        """
+        heap = self.groups[groupName]["heap"]
+        while True:
+            __, seq, key = heap[0]
+            task = self.tasks.get(key)
+            if task is not None and task.seq == seq:
+                return task
+            heapq.heappop(heap)
+
+
+def getPriority(task, policy):
+    """
+    Compute the priority of a task according to a scheduling policy (smaller first).
+    :param task: syncTask object
+    :param policy: scheduling policy
+    :return: priority value
+    """
+    if policy == POLICY_SMALLEST_FIRST:
+        return task.filesize
+    elif policy == POLICY_NEWEST_FIRST:
+        return -task.timestamp
+    else:
+        # FIFO: ties are broken by insertion order
+        return 0
+
+
+def getGroupPolicy(groupName):
+    """
+    Return the scheduling policy and weight of a group.
+    :param groupName: name of the group
+    :return: dictionary (policy, weight)
+    """
+    return groupsPolicy.get(groupName, {"policy": DEFAULT_POLICY, "weight": DEFAULT_WEIGHT})
+
+
+def setGroupPolicy(groupName, policy=DEFAULT_POLICY, weight=DEFAULT_WEIGHT):
+    """
+    Set the scheduling policy and the weight of a group.
+    Tasks already queued are reordered according to the new policy.
+    :param groupName: name of the group
+    :param policy: one of POLICY_FIFO, POLICY_SMALLEST_FIRST, POLICY_NEWEST_FIRST
+    :param weight: positive number, share of the sync slots given to the group
+    :return: boolean (True if the policy has been set, otherwise False)
+    """
+    if policy not in POLICIES or weight <= 0:
+        return False
+
+    queueLock.acquire()
+    groupsPolicy[groupName] = {"policy": policy, "weight": weight}
+    queue.reorderGroup(groupName)
+    queueLock.release()
+    return True
+
+
+def loadGroupsPolicy(policyFile):
+    """
+    Load the scheduling policies and weights saved in a previous session.
+    Invalid entries are ignored, a missing file means default policies for every group.
+    :param policyFile: name of the JSON file
+    :return: void
+    """
+    try:
+        f = open(policyFile, "r")
+        try:
+            savedPolicies = json.load(f)
+        except ValueError:
+            savedPolicies = dict()
+        f.close()
+    except FileNotFoundError:
+        return
+
+    if not isinstance(savedPolicies, dict):
+        return
+
+    for groupName, groupPolicy in savedPolicies.items():
+        try:
+            setGroupPolicy(groupName, groupPolicy["policy"], groupPolicy["weight"])
+        except (KeyError, TypeError):
+            continue
+
+
+def saveGroupsPolicy(policyFile):
+    """
+    Save the scheduling policies and weights of the groups into a JSON file.
+    :param policyFile: name of the JSON file
+    :return: boolean (True for success)
+    """
+    queueLock.acquire()
+    savedPolicies = dict(groupsPolicy)
+    queueLock.release()
+
+    try:
+        f = open(policyFile, 'w')
+        json.dump(savedPolicies, f, indent=4)
+        f.close()
+    except OSError:
+        print("Error while saving the scheduling policies")
+        return False
+
+    return True
+
+
+# Data structure where sync operations will be scheduled
+queue = TaskQueue()
+
 
 def scheduler():
     """
     Scheduler function.
-    It periodically looks for waiting sync task and if it's possible it actives them.
+    It waits for new sync tasks or free sync thread slots and it actives the waiting tasks.
     :return: void
     """
 
-    global queue, stop
+    global stop
+
+    # tasks whose file is locked by another operation,
+    # they are retried at the next wake up
+    postponed = list()
 
     while True:
 
+        # wait for an event, clearing it before reading the queue: events notified while
+        # the queue is processed are not lost and they will cause another iteration
+        if len(postponed) == 0 and len(pendingActions) == 0:
+            schedulerEvent.wait()
+        else:
+            schedulerEvent.wait(POSTPONED_RETRY_PERIOD)
+        schedulerEvent.clear()
+
         if stop:
             break
-        else:
-            # extract action from the queue until is empty or all syncThreads are busy
-            while len(queue) > 0 and len(syncThreads) < MAX_SYNC_THREAD:
 
-                queueLock.acquire()
-                task = queue.popleft()
-                queueLock.release()
+        runPendingActions()
 
-                # skip task of non active groups
-                if peerCore.groupsList[task.groupName]["status"] != "ACTIVE":
-                    continue
+        # postponed tasks precede tasks appended in the meanwhile
+        # (unless a newer task of the same file has been appended)
+        queueLock.acquire()
+        for task in reversed(postponed):
+            queue.appendLeft(task)
+        queueLock.release()
+        postponed = list()
 
-                # assign task to a sync thread
+        # extract action from the queue until is empty or all syncThreads are busy
+        while len(queue) > 0 and len(syncThreads) < MAX_SYNC_THREAD:
 
-                groupTree = peerCore.localFileTree.getGroup(task.groupName)
-                fileNode = groupTree.findNode(task.fileTreePath)
+            queueLock.acquire()
+            task = queue.popLeft()
+            queueLock.release()
 
-                if fileNode is None:
-                    # file has been removed
-                    continue
+            # skip task of non active groups
+            if peerCore.groupsList[task.groupName]["status"] != "ACTIVE":
+                continue
 
-                # if the file is not already in sync
-                if fileNode.file.syncLock.acquire(blocking=False):
-                    # Sync file if status is "D" and there are available threads
-                    syncThreadsLock.acquire()
+            # assign task to a sync thread
 
-                    if fileNode.file.status == "D":
-                        # start a new synchronization thread if there are less
-                        # than MAX_SYNC_THREAD already active threads
-                        syncThread = Thread(target=fileSharing.startFileSync,
-                                            args=(fileNode.file, task.timestamp))
-                        syncThread.daemon = True
-                        key = task.groupName + "_" + task.fileTreePath
-                        syncThreads[key] = dict()
-                        syncThreads[key]["groupName"] = task.groupName
-                        syncThreads[key]["state"] = SYNC_RUNNING
-                        syncThread.start()
+            groupTree = peerCore.localFileTree.getGroup(task.groupName)
+            fileNode = groupTree.findNode(task.fileTreePath)
 
-                    syncThreadsLock.release()
-                    fileNode.file.syncLock.release()
+            if fileNode is None:
+                # file has been removed
+                continue
 
-                else:
-                    # file is already in sync but the new task refers to a new version
-                    # re-append this task in order to allow a new sync in the future
-                    # print("Re-appending task: ", task.toString())
-                    appendTask(task)
+            # if the file is not already in sync
+            if fileNode.file.syncLock.acquire(blocking=False):
+                # Sync file if status is "D" and there are available threads
+                syncThreadsLock.acquire()
 
-            time.sleep(1)
+                if fileNode.file.status == "D":
+                    # start a new synchronization on a sync worker: there are less
+                    # than MAX_SYNC_THREAD already active synchronizations
+                    key = task.groupName + "_" + task.fileTreePath
+                    syncThreads[key] = dict()
+                    syncThreads[key]["groupName"] = task.groupName
+                    syncThreads[key]["state"] = SYNC_RUNNING
+                    syncThreads[key]["file"] = None
+                    syncThreads[key]["download"] = None
+                    syncThreads[key]["deferred"] = list()
+                    syncWorkers.submit(fileSharing.startFileSync, fileNode.file, task.timestamp)
+
+                syncThreadsLock.release()
+                fileNode.file.syncLock.release()
+
+            else:
+                # file is already in sync but the new task refers to a new version:
+                # postpone this task in order to allow a new sync in the future
+                # print("Postponing task: ", task.toString())
+                postponed.append(task)
+
+
+def notifyScheduler():
+    """
+    Wake up the scheduler, e.g. because a synchronization has terminated.
+    :return: void
+    """
+    schedulerEvent.set()
 
 
 def stopScheduler():
@@ -171,60 +543,41 @@ def stopScheduler():
     """
     global stop
     stop = True
+    schedulerEvent.set()
 
 
-def appendTask(task, checkOutdated=False):
+def appendTask(task):
     """
     Append a task to queue.
-    If checkOutdated is True verify all the task in the queue
-    and remove outdated tasks (smaller timestamp for the same file).
-    Furthermore, if task is outdated don't append it.
+    If the queue contains a task for the same file, only the task
+    referring to the newest version (bigger timestamp) is kept.
     :param task: task to insert
-    :param checkOutdated: boolean (if True enable the check)
     :return: void
     """
 
-    global queue
     queueLock.acquire()
 
     # skip task of non active groups
     if peerCore.groupsList[task.groupName]["status"] != "ACTIVE":
+        queueLock.release()
         return
 
-
     groupTree = peerCore.localFileTree.getGroup(task.groupName)
     fileNode = groupTree.findNode(task.fileTreePath)
     if fileNode is None:
         # file has been removed
+        queueLock.release()
         return
 
-    if checkOutdated:
-        # remove outdated tasks and check if task is outdated or not
-        deleteIndex = list()
-        outdated = False
-
-        for i in range(0, len(queue)):
-            # check if task is outdated respect to task-i
-            if task.isOutdated(queue[i]):
-                outdated = True
-                break
-
-            # check if task-i is outdated respect to task
-            if queue[i].isOutdated(task):
-                deleteIndex.append(i)
-
-        if not outdated:
-            # delete outdated tasks and append the new one
-            for index in deleteIndex:
-                del queue[index]
-            queue.append(task)
-
-    else:
-        # append task without any check
-        queue.append(task)
+    task.filesize = fileNode.file.filesize
+    appended = queue.append(task)
 
     queueLock.release()
 
+    if appended:
+        # the task can be immediately scheduled
+        schedulerEvent.set()
+
 
 def removeGroupTasks(groupName):
     """
@@ -234,9 +587,8 @@ def removeGroupTasks(groupName):
     :return: void
     """
 
-    global queue
     queueLock.acquire()
-    queue = deque([t for t in queue if t.groupName != groupName])
+    queue.removeGroup(groupName)
     queueLock.release()
 
 
@@ -246,9 +598,8 @@ def removeAllTasks():
     Useful before the client termination
     :return: void
     """
-    global queue
     queueLock.acquire()
-    queue = deque()
+    queue.clear()
     queueLock.release()
 
 
@@ -257,14 +608,15 @@ def removeSyncThread(key):
     Remove an active synchronization thread associated to a certain file
     from the syncThreads data structure that collects information about all t.
     :param key: key of the file (groupName_filename)
-    :return: void
+    :return: list of actions waiting for the end of the synchronization
     """
     syncThreadsLock.acquire()
     try:
-        del syncThreads[key]
+        deferredActions = syncThreads.pop(key)["deferred"]
     except KeyError:
-        pass
+        deferredActions = list()
     syncThreadsLock.release()
+    return deferredActions
 
 
 def getThreadState(key):
@@ -282,6 +634,107 @@ def getThreadState(key):
     syncThreadsLock.release()
     return state
 
+
+def setSyncDownload(key, file, dl):
+    """
+    Associate the running download to an active sync thread,
+    so that a stopping state can interrupt it.
+    If the sync has been already stopped the download is immediately interrupted.
+    :param key: key of the file (groupName_filename)
+    :param file: File object
+    :param dl: Download object
+    :return: void
+    """
+    syncThreadsLock.acquire()
+    try:
+        syncThreads[key]["file"] = file
+        syncThreads[key]["download"] = dl
+        if syncThreads[key]["state"] != SYNC_RUNNING:
+            file.stopSync = True
+    except KeyError:
+        file.stopSync = True
+    syncThreadsLock.release()
+
+
+def setThreadState(thread, value):
+    """
+    Set the state of a sync thread and interrupt its download if the state is a stopping one.
+    Must be called holding syncThreadsLock.
+    :param thread: sync thread information (value of syncThreads)
+    :param value: new state value
+    :return: void
+    """
+    thread["state"] = value
+    if value != SYNC_RUNNING and thread["download"] is not None:
+        thread["file"].stopSync = True
+        fileSharing.notifyDownload(thread["download"])
+
+
+def runAfterSync(key, function, args):
+    """
+    Execute a function when the active synchronization of a file terminates.
+    The function is always executed by the scheduler thread, so the caller never waits:
+    it must not block on the file lock, it returns False if the file is still locked.
+    :param key: key of the file (groupName_filename)
+    :param function: function to execute
+    :param args: tuple of arguments of the function
+    :return: void
+    """
+    syncThreadsLock.acquire()
+    try:
+        syncThreads[key]["deferred"].append((function, args))
+        deferred = True
+    except KeyError:
+        deferred = False
+    syncThreadsLock.release()
+
+    if not deferred:
+        # no active synchronization of the file
+        runDeferredActions([(function, args)])
+
+
+def runDeferredActions(deferredActions):
+    """
+    Hand the actions that were waiting for the end of a synchronization to the scheduler thread.
+    :param deferredActions: list of (function, args) tuples
+    :return: void
+    """
+    if len(deferredActions) == 0:
+        return
+
+    queueLock.acquire()
+    pendingActions.extend(deferredActions)
+    queueLock.release()
+    schedulerEvent.set()
+
+
+def runPendingActions():
+    """
+    Execute the actions handed to the scheduler thread (see runAfterSync).
+    Actions whose file is still locked are kept for the next wake up of the scheduler.
+    :return: void
+    """
+    queueLock.acquire()
+    actions = list(pendingActions)
+    del pendingActions[:]
+    queueLock.release()
+
+    retry = list()
+    for function, args in actions:
+        try:
+            done = function(*args)
+        except Exception as e:
+            # a failed action must not stop the scheduler thread
+            print("Error while executing a deferred action: {}".format(e))
+            continue
+        if done is False:
+            retry.append((function, args))
+
+    queueLock.acquire()
+    pendingActions[:0] = retry
+    queueLock.release()
+
+
 def stopSyncThread(key, value):
     """
     Force a new state for a certain synchronization thread,
@@ -295,11 +748,12 @@ def stopSyncThread(key, value):
         return
     syncThreadsLock.acquire()
     try:
-        syncThreads[key]["state"] = value
+        setThreadState(syncThreads[key], value)
     except KeyError:
         pass
     syncThreadsLock.release()
 
+
 def stopSyncThreadIfRunning(key, value):
     """
     Force a new state for a certain synchronization thread,
@@ -316,7 +770,7 @@ def stopSyncThreadIfRunning(key, value):
     try:
         state = syncThreads[key]["state"]
         if state == SYNC_RUNNING:
-            syncThreads[key]["state"] = value
+            setThreadState(syncThreads[key], value)
     except KeyError:
         pass
     syncThreadsLock.release()
@@ -336,7 +790,7 @@ def stopSyncThreadsByGroup(groupName, value):
     syncThreadsLock.acquire()
     for thread in syncThreads.values():
         if thread["groupName"] == groupName:
-            thread["state"] = value
+            setThreadState(thread, value)
     syncThreadsLock.release()
 
 
@@ -351,7 +805,7 @@ def stopAllSyncThreads(value):
         return
     syncThreadsLock.acquire()
     for thread in syncThreads.values():
-        thread["state"] = value
+        setThreadState(thread, value)
     syncThreadsLock.release()
 
 
@@ -363,12 +817,10 @@ def addedFiles(message):
     :param message: string containing all the files information
     :return: answer string
     """
-    global queue
-
     try:
         messageFields = message.split(" ", 2)
         groupName = messageFields[1]
-        filesInfo = eval(messageFields[2])
+        filesInfo = codec.decodeFilesInfo(messageFields[2])
 
         if groupName in peerCore.groupsList:
             if peerCore.groupsList[groupName]["status"] == "ACTIVE":
@@ -393,7 +845,9 @@ def addedFiles(message):
                                                filename=filename, filepath=filepath,
                                                filesize=fileInfo["filesize"],
                                                timestamp=fileInfo["timestamp"],
-                                               status="D", previousChunks=list())
+                                               status="D", previousChunks=list(),
+                                               chunksHashes=fileInfo.get("chunksHashes"),
+                                               chunksSizes=fileInfo.get("chunksSizes"))
 
                     peerCore.localFileTree.getGroup(groupName).addNode(treePath, file)
 
@@ -407,7 +861,7 @@ def addedFiles(message):
         else:
             answer = "ERROR - GROUP DOESN'T EXIST"
 
-    except IndexError:
+    except (IndexError, ValueError):
         answer = "ERROR - INVALID REQUEST"
 
     return answer
@@ -425,7 +879,7 @@ def removedFiles(message):
     try:
         messageFields = message.split(" ", 2)
         groupName = messageFields[1]
-        fileTreePaths = eval(messageFields[2])
+        fileTreePaths = codec.decode(messageFields[2])
 
         if groupName in peerCore.groupsList:
             if peerCore.groupsList[groupName]["status"] == "ACTIVE":
@@ -445,7 +899,7 @@ def removedFiles(message):
         else:
             answer = "ERROR - GROUP DOESN'T EXIST"
 
-    except IndexError:
+    except (IndexError, ValueError):
         answer = "ERROR - INVALID REQUEST"
 
     return answer
@@ -460,12 +914,10 @@ def updatedFiles(message):
     :return: answer string
     """
 
-    global queue
-
     try:
         messageFields = message.split(" ", 2)
         groupName = messageFields[1]
-        filesInfo = eval(messageFields[2])
+        filesInfo = codec.decodeFilesInfo(messageFields[2])
 
         if groupName in peerCore.groupsList:
             if peerCore.groupsList[groupName]["status"] == "ACTIVE":
@@ -485,23 +937,19 @@ def updatedFiles(message):
 
                     if fileNode.file.syncLock.acquire(blocking=False):
 
-                        fileNode.file.filesize = fileInfo["filesize"]
-                        fileNode.file.timestamp = fileInfo["timestamp"]
-                        fileNode.file.status = "D"
-                        fileNode.file.previousChunks = list()
+                        # only the chunks changed with respect to the local version will be downloaded
+                        syncRequired = fileNode.file.updateVersion(fileInfo)
 
                         fileNode.file.syncLock.release()
 
-                        # create new syncTask
-                        newTask = syncTask(groupName, fileInfo["treePath"], fileInfo["timestamp"])
-                        appendTask(newTask, True)
+                        if syncRequired:
+                            # create new syncTask
+                            newTask = syncTask(groupName, fileInfo["treePath"], fileInfo["timestamp"])
+                            appendTask(newTask)
                     else:
-                        # file is currently in synchronization
-                        # create a thread which will wait under the end of the synchronization
-                        # and then it will update file state
-                        t = Thread(target=waitSyncAndUpdate, args=(fileNode,))
-                        t.daemon = True
-                        t.start()
+                        # file is currently in synchronization:
+                        # update file state at the end of the synchronization
+                        runAfterSync(key, waitSyncAndUpdate, (fileNode, fileInfo))
 
                 answer = "OK - SYNC TASK LOADED"
             else:
@@ -509,7 +957,7 @@ def updatedFiles(message):
         else:
             answer = "ERROR - GROUP DOESN'T EXIST"
 
-    except IndexError:
+    except (IndexError, ValueError):
         answer = "ERROR - INVALID REQUEST"
 
     return answer
@@ -517,29 +965,26 @@ def updatedFiles(message):
 
 def waitSyncAndUpdate(fileNode, fileInfo):
     """
-    Wait until the file lock is released and then update the File object
-    and insert the new sync task in the scheduler queue.
+    Update the File object and insert the new sync task in the scheduler queue,
+    if the file lock is free. Executed by the scheduler thread (see runAfterSync).
     :param fileNode: Node in the file tree associated to the file
     :param fileInfo: dictionary of information about the new version of the file
-    :return: void
+    :return: boolean (False if the file is still locked, the update is retried later)
     """
 
-    # wait for the unlock of file resources
-    while not fileNode.file.syncLock.acquire(blocking=False):
-        time.sleep(0.5)
+    # the scheduler thread doesn't wait for the unlock of file resources
+    if not fileNode.file.syncLock.acquire(blocking=False):
+        return False
 
     # check timestamp validity
     if fileNode.file.timestamp < fileInfo["timestamp"]:
         # update file information
-        fileNode.file.filesize = fileInfo["filesize"]
-        fileNode.file.timestamp = fileInfo["timestamp"]
-        fileNode.file.status = "D"
-        fileNode.file.previousChunks = list()
-
-        # create new syncTask
-        newTask = syncTask(fileNode.file.groupName, fileInfo["treePath"], fileInfo["timestamp"])
-        appendTask(newTask, True)
+        if fileNode.file.updateVersion(fileInfo):
+            # create new syncTask
+            newTask = syncTask(fileNode.file.groupName, fileInfo["treePath"], fileInfo["timestamp"])
+            appendTask(newTask)
 
     fileNode.file.syncLock.release()
+    return True
 
 
@@ -0,0 +1,147 @@
+"""
+Project: myP2PSync
+@author: Francesco Lorenzo Casciaro - Politecnico di Torino - UPC
+
+This code manages the encoding of structured data (lists, dictionaries)
+carried by myP2PSync messages, both between peers and between peers and tracker.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+for more details.
+"""
+
+import json
+
+# compact JSON: no whitespaces, so an encoded payload never contains spaces
+# that could be confused with message fields separators.
+# Non-ASCII characters are escaped, so the payload can be mapped to bytes using latin-1
+encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=True)
+decoder = json.JSONDecoder()
+
+# fields of a file information record, e.g. in ADDED_FILES, UPDATED_FILES and GET_FILES messages,
+# chunksHashes is the list of the digests of the chunks of the file and merkleRoot is the root of the
+# Merkle tree built over them, that identifies the content (both missing in records of older peers).
+# chunksSizes is the list of the sizes of content-defined chunks (null for fixed size chunks)
+FILES_INFO_FIELDS = ("treePath", "filesize", "timestamp", "chunksHashes", "merkleRoot", "chunksSizes")
+
+# fields that every file information record must contain
+REQUIRED_FILES_INFO_FIELDS = ("treePath", "filesize", "timestamp")
+
+# characters of the hex digests of the chunks (lowercase, as produced by hexdigest())
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def encode(data):
+    """
+    Encode structured data into a string.
+    :param data: combination of lists, dictionaries, strings, numbers, booleans and None
+    :return: string
+    """
+    return encoder.encode(data)
+
+
+def decode(string):
+    """
+    Decode a string produced by encode().
+    Unlike eval(), it never executes code contained in the string.
+    :param string: encoded data
+    :return: decoded data (tuples are decoded as lists)
+    :raise ValueError: if the string is not a valid encoding
+    """
+    return decoder.decode(string)
+
+
+def encodeTable(records, fields):
+    """
+    Encode a list of dictionaries sharing the same keys as a table:
+    keys are sent only once, followed by a row of values for each record.
+    Keys missing from a record are encoded as null values.
+    :param records: list of dictionaries
+    :param fields: keys of the dictionaries that will be encoded
+    :return: string
+    """
+    return encoder.encode({"fields": list(fields),
+                           "rows": [[record.get(field) for field in fields] for record in records]})
+
+
+def decodeTable(string):
+    """
+    Decode a string produced by encodeTable().
+    Every row must contain a value for each field.
+    :param string: encoded table
+    :return: list of dictionaries
+    :raise ValueError: if the string is not a valid encoding
+    """
+    table = decoder.decode(string)
+    try:
+        fields = table["fields"]
+        rows = table["rows"]
+        if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields) \
+                or not isinstance(rows, list):
+            raise ValueError("invalid table encoding")
+        records = list()
+        for row in rows:
+            if not isinstance(row, list) or len(row) != len(fields):
+                raise ValueError("invalid table row")
+            records.append(dict(zip(fields, row)))
+        return records
+    except (KeyError, TypeError):
+        raise ValueError("invalid table encoding")
+
+
+def encodeFilesInfo(filesInfo):
+    """
+    Encode a list of file information dictionaries.
+    :param filesInfo: list of dictionaries (treePath, filesize, timestamp, chunksHashes, merkleRoot, chunksSizes)
+    :return: string
+    """
+    return encodeTable(filesInfo, FILES_INFO_FIELDS)
+
+
+def decodeFilesInfo(string):
+    """
+    Decode a list of file information dictionaries.
+    Records lacking a required field (treePath, filesize, timestamp) or with values
+    of the wrong type (chunksHashes must be hex digests, chunksSizes positive sizes) are rejected.
+    :param string: string produced by encodeFilesInfo()
+    :return: list of dictionaries (treePath, filesize, timestamp, chunksHashes, merkleRoot, chunksSizes)
+    :raise ValueError: if the string is not a valid encoding
+    """
+    filesInfo = decodeTable(string)
+    for fileInfo in filesInfo:
+        for field in REQUIRED_FILES_INFO_FIELDS:
+            if field not in fileInfo:
+                raise ValueError("missing field {}".format(field))
+        if not isinstance(fileInfo["treePath"], str) or fileInfo["treePath"] == "":
+            raise ValueError("invalid treePath")
+        for field in ("filesize", "timestamp"):
+            if not isinstance(fileInfo[field], int) or isinstance(fileInfo[field], bool) or fileInfo[field] < 0:
+                raise ValueError("invalid {}".format(field))
+        chunksHashes = fileInfo.get("chunksHashes")
+        if chunksHashes is not None and \
+                (not isinstance(chunksHashes, list) or not all(isDigest(digest) for digest in chunksHashes)):
+            raise ValueError("invalid chunksHashes")
+        merkleRoot = fileInfo.get("merkleRoot")
+        if merkleRoot is not None and not isinstance(merkleRoot, str):
+            raise ValueError("invalid merkleRoot")
+        chunksSizes = fileInfo.get("chunksSizes")
+        if chunksSizes is not None and \
+                (not isinstance(chunksSizes, list) or
+                 not all(isinstance(size, int) and not isinstance(size, bool) and size > 0 for size in chunksSizes)):
+            raise ValueError("invalid chunksSizes")
+    return filesInfo
+
+
+def isDigest(digest):
+    """
+    Check that a value is a hex SHA-256 digest.
+    :param digest: value
+    :return: boolean
+    """
+    return isinstance(digest, str) and len(digest) == 64 and all(c in HEX_DIGITS for c in digest)
@@ -17,6 +17,9 @@ for more details.
 
 import os
 import socket
+import struct
+import time
+from threading import Lock
 
 # ZeroTier myP2PSync network ID
 networkID = "e5cd7a9e1cf88a16"
@@ -32,6 +35,269 @@ TIMEOUT = 5.0
 # type of encoding used in order to map string to bytes
 ENCODING_TYPE = 'latin-1'
 
+# framing modes that can be used on a connection
+# FRAMING_ASCII: size of the message sent as a 16 byte zero-padded string (legacy mode)
+# FRAMING_BINARY: size of the message sent as a fixed-size struct header
+FRAMING_ASCII = 0
+FRAMING_BINARY = 1
+
+# header of a binary frame: payload size as 4 byte unsigned integer in network order
+HEADER_STRUCT = struct.Struct("!I")
+
+# handshake message sent by a client just after the connection in order to select the framing mode
+# the first byte is not an ASCII digit, so it can't be confused with a legacy size string
+HELLO_MAGIC = b"\x00P2PSYNC"
+HELLO_STRUCT = struct.Struct("!8sB")
+
+# seconds a client waits for the answer to the HELLO message: hosts that don't answer
+# (older versions waiting for a 16 byte size string) are contacted again using the legacy framing
+HANDSHAKE_TIMEOUT = 2.0
+# seconds after which a host that didn't answer the HELLO message is asked again for the binary framing
+LEGACY_RETRY_PERIOD = 3600
+
+# hosts that don't support the handshake
+# key: address (IP, port)
+# value: time after which the handshake is tried again
+legacyHosts = dict()
+
+
+# maximum size of a message accepted by a server: bigger messages are considered invalid
+MAX_MESSAGE_SIZE = 64 * 1048576
+
+# maximum number of idle receive buffers kept by the buffer pool
+MAX_POOL_BUFFERS = 16
+
+
+class BufferPool:
+    """
+    Pool of reusable receive buffers.
+    Buffers are preallocated bytearray objects that can be filled using recv_into(),
+    avoiding the allocation of a new object for each received chunk.
+    """
+
+    def __init__(self, maxBuffers=MAX_POOL_BUFFERS):
+        """
+        Initialize an empty pool.
+        :param maxBuffers: maximum number of idle buffers kept in the pool
+        """
+        self.buffers = list()
+        self.maxBuffers = maxBuffers
+        self.lock = Lock()
+
+    def acquire(self, size):
+        """
+        Get a buffer of at least size bytes from the pool.
+        A new buffer is allocated if the pool doesn't contain a suitable one.
+        :param size: minimum size of the buffer
+        :return: bytearray object
+        """
+        with self.lock:
+            for i in range(len(self.buffers) - 1, -1, -1):
+                if len(self.buffers[i]) >= size:
+                    return self.buffers.pop(i)
+        return bytearray(size)
+
+    def release(self, buffer):
+        """
+        Give back a buffer to the pool.
+        :param buffer: bytearray object previously returned by acquire
+        :return: void
+        """
+        with self.lock:
+            if len(self.buffers) < self.maxBuffers:
+                self.buffers.append(buffer)
+
+
+# process-wide pool of buffers used to receive file chunks
+chunkBuffers = BufferPool()
+
+
+# seconds after which an idle connection of the connection pool is closed
+POOL_IDLE_TIMEOUT = 30
+# maximum number of idle connections kept by the connection pool for a single remote host
+POOL_MAX_IDLE = 8
+
+
+class Connection(socket.socket):
+    """
+    Socket object that keeps track of the framing mode agreed with the remote host.
+    It also owns a receive buffer (taken from chunkBuffers) reused by all the chunks
+    received on the connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        socket.socket.__init__(self, *args, **kwargs)
+        self.framing = FRAMING_ASCII
+        self.chunkBuffer = None
+        # address used as key by the ConnectionPool
+        self.poolKey = None
+
+    def getChunkBuffer(self, size):
+        """
+        Return the receive buffer of the connection, making sure it can contain size bytes.
+        :param size: number of bytes that will be received
+        :return: bytearray object
+        """
+        if self.chunkBuffer is None or len(self.chunkBuffer) < size:
+            if self.chunkBuffer is not None:
+                chunkBuffers.release(self.chunkBuffer)
+            self.chunkBuffer = chunkBuffers.acquire(size)
+        return self.chunkBuffer
+
+    def close(self):
+        """
+        Close the socket giving back the receive buffer to the pool.
+        :return: void
+        """
+        if self.chunkBuffer is not None:
+            chunkBuffers.release(self.chunkBuffer)
+            self.chunkBuffer = None
+        socket.socket.close(self)
+
+
+class ConnectionPool:
+    """
+    Pool of keep-alive connections toward remote hosts, keyed by address (IP, port).
+    A connection is taken with getConnection() and used exclusively by a single thread.
+    Then it's given back with releaseConnection() if the request/answer exchange was
+    successfully completed, otherwise it's closed with discardConnection().
+    Idle connections are health-checked before being reused and closed after POOL_IDLE_TIMEOUT seconds.
+    """
+
+    def __init__(self, idleTimeout=POOL_IDLE_TIMEOUT, maxIdle=POOL_MAX_IDLE):
+        """
+        Initialize an empty pool.
+        :param idleTimeout: seconds after which an idle connection is closed
+        :param maxIdle: maximum number of idle connections for a single remote host
+        """
+        # key: (IP, port)
+        # value: list of (Connection object, time of release)
+        self.idle = dict()
+        self.idleTimeout = idleTimeout
+        self.maxIdle = maxIdle
+        self.lock = Lock()
+
+    def getConnection(self, addr):
+        """
+        Return a connection toward a remote host, reusing an idle one if possible.
+        :param addr: address (IP, port) of the remote host
+        :return: Connection object or None
+        """
+
+        key = (addr[0], int(addr[1]))
+
+        with self.lock:
+            self.evictIdle()
+            connections = self.idle.get(key)
+            while connections:
+                s, __ = connections.pop()
+                if isAlive(s):
+                    return s
+                s.close()
+
+        s = createConnection(key)
+        if s is not None:
+            s.poolKey = key
+        return s
+
+    def releaseConnection(self, s):
+        """
+        Give back a healthy connection to the pool.
+        :param s: Connection object returned by getConnection
+        :return: void
+        """
+
+        if s is None:
+            return
+
+        with self.lock:
+            connections = self.idle.setdefault(s.poolKey, list())
+            if len(connections) < self.maxIdle:
+                connections.append((s, time.time()))
+                s = None
+            self.evictIdle()
+
+        if s is not None:
+            # too many idle connections toward the same host
+            s.close()
+
+    def discardConnection(self, s):
+        """
+        Close a connection on which an error occurred: it can't be reused.
+        :param s: Connection object returned by getConnection
+        :return: void
+        """
+
+        if s is not None:
+            s.close()
+
+    def evictIdle(self):
+        """
+        Close connections idle for more than idleTimeout seconds.
+        Must be called holding the pool lock.
+        :return: void
+        """
+
+        limit = time.time() - self.idleTimeout
+        for key in list(self.idle):
+            connections = self.idle[key]
+            while connections and connections[0][1] < limit:
+                s, __ = connections.pop(0)
+                s.close()
+            if not connections:
+                del self.idle[key]
+
+    def closeAll(self):
+        """
+        Close all the idle connections of the pool.
+        :return: void
+        """
+
+        with self.lock:
+            for connections in self.idle.values():
+                for s, __ in connections:
+                    s.close()
+            self.idle = dict()
+
+
+def isAlive(s):
+    """
+    Check if an idle connection can still be used.
+    An idle connection is healthy if there is nothing to read on it:
+    readable means that the remote host closed it (or sent unexpected data).
+    :param s: socket connection object
+    :return: boolean (True if the connection can be used)
+    """
+
+    return not waitReadable(s, 0)
+
+
+def waitReadable(sock, timeout):
+    """
+    Wait until data can be read on the socket (or the remote host closed it), without consuming them.
+    Data are peeked using recv(), that unlike select() works with any file descriptor number.
+    :param sock: socket connection object
+    :param timeout: maximum waiting time (seconds), 0 in order to not wait at all
+    :return: boolean (True if the socket is readable, also in case of error)
+    """
+
+    try:
+        previousTimeout = sock.gettimeout()
+        if timeout > 0:
+            sock.settimeout(timeout)
+        else:
+            sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        finally:
+            sock.settimeout(previousTimeout)
+    except (socket.timeout, BlockingIOError):
+        return False
+    except OSError:
+        # error or closed socket: it will be reported by the next read
+        return True
+    return True
+
 
 def getMyIP():
     """
@@ -94,27 +360,81 @@ def leaveNetwork():
     os.system(cmd)
 
 
-def createConnection(addr):
+def createConnection(addr, framing=FRAMING_BINARY):
     """
     Create a socket connection with a remote host.
+    The framing mode is agreed with the remote host just after the connection:
+    hosts that don't answer the handshake are contacted again using the legacy ASCII framing.
     In case of success return the established socket.
     In case of failure (timeout or connection refused) return None.
     :param addr: address (IP, port) of the remote host.
-    :return: socket object or None
+    :param framing: framing mode requested to the remote host
+    :return: Connection object or None
     """
 
     # cast port number to integer
     addr = (addr[0], int(addr[1]))
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(5)
+    if framing != FRAMING_ASCII and legacyHosts.get(addr, 0) > time.time():
+        # the remote host is an older version that doesn't answer the handshake
+        framing = FRAMING_ASCII
+
+    s = Connection(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(TIMEOUT)
     try:
         s.connect(addr)
-    except (socket.timeout, ConnectionRefusedError):
+    except (socket.timeout, OSError):
+        s.close()
         return None
+
+    if framing != FRAMING_ASCII:
+        try:
+            # ask for the framing mode and read the one accepted by the remote host
+            s.sendall(HELLO_STRUCT.pack(HELLO_MAGIC, framing))
+            s.settimeout(HANDSHAKE_TIMEOUT)
+            s.framing = recvExactly(s, 1)[0]
+            s.settimeout(TIMEOUT)
+        except (socket.timeout, OSError, RuntimeError):
+            # no answer or connection closed: the remote host doesn't know the handshake,
+            # a new connection is created using the legacy framing
+            s.close()
+            legacyHosts[addr] = time.time() + LEGACY_RETRY_PERIOD
+            return createConnection(addr, FRAMING_ASCII)
+
     return s
 
 
+def acceptConnection(sock):
+    """
+    Wrap a socket returned by accept() into a Connection object
+    and detect the framing mode requested by the remote host.
+    Hosts that don't send the HELLO message are served using the legacy ASCII framing.
+    :param sock: socket object returned by accept()
+    :return: Connection object or None in case of failure
+    """
+
+    conn = Connection(sock.family, sock.type, sock.proto, sock.detach())
+    conn.settimeout(TIMEOUT)
+
+    try:
+        # peek the first byte without consuming it: a legacy size string starts with a digit
+        first = conn.recv(1, socket.MSG_PEEK)
+        if first == HELLO_MAGIC[:1]:
+            magic, framing = HELLO_STRUCT.unpack(recvExactly(conn, HELLO_STRUCT.size))
+            if magic != HELLO_MAGIC:
+                raise ValueError("invalid handshake")
+            if framing not in (FRAMING_ASCII, FRAMING_BINARY):
+                # unknown mode: fallback to the legacy one
+                framing = FRAMING_ASCII
+            conn.framing = framing
+            conn.sendall(bytes([framing]))
+    except (socket.timeout, OSError, RuntimeError, ValueError):
+        conn.close()
+        return None
+
+    return conn
+
+
 def closeConnection(s, peerID):
     """
     Wrapper function for socket.close().
@@ -139,11 +459,43 @@ def closeConnection(s, peerID):
     s.close()
 
 
+def recvExactly(sock, size):
+    """
+    Receive exactly size bytes from the socket.
+    Data are written directly into a preallocated buffer using recv_into().
+    :param sock: socket connection object
+    :param size: number of bytes that will be received
+    :return: bytearray containing the data received
+    """
+
+    data = bytearray(size)
+    recvInto(sock, memoryview(data))
+    return data
+
+
+def recvInto(sock, view):
+    """
+    Fill a writable memoryview with data received from the socket.
+    :param sock: socket connection object
+    :param view: memoryview object, it will be completely filled
+    :return: void
+    """
+
+    size = len(view)
+    bytesRec = 0
+
+    while bytesRec < size:
+        n = sock.recv_into(view[bytesRec:], size - bytesRec)
+        if n == 0:
+            raise RuntimeError("sock connection broken")
+        bytesRec += n
+
+
 def mySend(sock, data):
     """
     Send a message on the socket.
     :param sock: socket connection object
-    :param data: data that will be sent
+    :param data: data that will be sent (string or bytes-like object)
     :return: void
     """
 
@@ -154,46 +506,130 @@ def mySend(sock, data):
     # set a timeout
     sock.settimeout(TIMEOUT)
 
-    # data is a string message: it needs to be converted to bytes
-    data = str(data).encode(ENCODING_TYPE)
+    if isinstance(data, str):
+        # data is a string message: it needs to be converted to bytes
+        data = data.encode(ENCODING_TYPE)
+    elif not isinstance(data, (bytes, bytearray, memoryview)):
+        data = str(data).encode(ENCODING_TYPE)
 
     # get size of the message
     size = len(data)
 
-    # put size on a 16 byte string filled with 0s
-    # e.g. size = 123
-    #      strSize = 0000000000000123
-    strSize = str(size).zfill(SIZE_LENGTH)
-    strSize = strSize.encode(ENCODING_TYPE)
+    header = encodeHeader(size, getattr(sock, "framing", FRAMING_ASCII))
 
-    # send the size of the data
-    totalSent = 0
-    while totalSent < SIZE_LENGTH:
-        try:
-            sent = sock.send(strSize[totalSent:])
-        except socket.timeout:
-            raise socket.timeout
-        if sent == 0:
-            raise RuntimeError("sock connection broken")
-        totalSent = totalSent + sent
+    if size <= BUFSIZE:
+        # small message: header and data are sent in a single segment
+        sock.sendall(header + data)
+    else:
+        sock.sendall(header)
+        sock.sendall(data)
 
-    # send data
-    totalSent = 0
-    while totalSent < size:
-        try:
-            sent = sock.send(data[totalSent:])
-        except socket.timeout:
-            raise socket.timeout
-        if sent == 0:
-            raise RuntimeError("sock connection broken")
-        totalSent = totalSent + sent
 
+def encodeHeader(size, framing):
+    """
+    Build the header that precedes a message.
+    :param size: size of the message in bytes
+    :param framing: framing mode of the connection
+    :return: bytes
+    """
 
-def myRecv(sock):
+    if framing == FRAMING_BINARY:
+        return HEADER_STRUCT.pack(size)
+    else:
+        # put size on a 16 byte string filled with 0s
+        # e.g. size = 123
+        #      strSize = 0000000000000123
+        return str(size).zfill(SIZE_LENGTH).encode(ENCODING_TYPE)
+
+
+def encodeFrame(data, framing):
     """
-    Wrapper for the recv function.
+    Build a complete frame (header and message) ready to be written on a non-blocking socket.
+    :param data: message (string or bytes-like object)
+    :param framing: framing mode of the connection
+    :return: bytes
+    """
+
+    if isinstance(data, str):
+        data = data.encode(ENCODING_TYPE)
+
+    return encodeHeader(len(data), framing) + data
+
+
+class FrameReader:
+    """
+    Incremental parser of the data received on a non-blocking connection.
+    Received bytes are accumulated with feed() and complete messages are extracted with getMessage().
+    The first bytes of the connection are used to detect the framing mode, as acceptConnection does.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.framing = None  # unknown until the first byte is received
+        self.handshakeReply = None  # answer to the HELLO message, it must be sent before any other data
+
+    def feed(self, data):
+        """
+        Append received data to the internal buffer.
+        :param data: bytes-like object
+        :return: void
+        """
+        self.buffer += data
+
+    def getMessage(self):
+        """
+        Extract the next complete message from the internal buffer.
+        :return: message (bytes) or None if more data are required
+        :raise ValueError: if invalid data have been received
+        """
+
+        if self.framing is None:
+            if len(self.buffer) == 0:
+                return None
+            if self.buffer[0] == HELLO_MAGIC[0]:
+                if len(self.buffer) < HELLO_STRUCT.size:
+                    return None
+                magic, framing = HELLO_STRUCT.unpack_from(self.buffer)
+                if magic != HELLO_MAGIC:
+                    raise ValueError("invalid handshake")
+                if framing not in (FRAMING_ASCII, FRAMING_BINARY):
+                    # unknown mode: fallback to the legacy one
+                    framing = FRAMING_ASCII
+                del self.buffer[:HELLO_STRUCT.size]
+                self.handshakeReply = bytes([framing])
+                self.framing = framing
+            else:
+                # legacy host: no handshake
+                self.framing = FRAMING_ASCII
+
+        if self.framing == FRAMING_BINARY:
+            headerSize = HEADER_STRUCT.size
+            if len(self.buffer) < headerSize:
+                return None
+            size = HEADER_STRUCT.unpack_from(self.buffer)[0]
+        else:
+            headerSize = SIZE_LENGTH
+            if len(self.buffer) < headerSize:
+                return None
+            size = int(self.buffer[:headerSize])
+
+        if size < 0 or size > MAX_MESSAGE_SIZE:
+            raise ValueError("invalid message size")
+
+        if len(self.buffer) < headerSize + size:
+            return None
+
+        message = bytes(self.buffer[headerSize:headerSize + size])
+        del self.buffer[:headerSize + size]
+
+        return message
+
+
+def myRecvBytes(sock):
+    """
+    Receive a message without decoding it.
     :param sock: socket connection object
-    :return: data received
+    :return: bytearray containing the message
     """
 
     # check socket object validity
@@ -203,50 +639,40 @@ def myRecv(sock):
     # set a timeout
     sock.settimeout(TIMEOUT)
 
-    # read the 16 byte string representing the data size
-    chunks = list()
-    bytesRec = 0
-    while bytesRec < SIZE_LENGTH:
-        try:
-            chunk = sock.recv(min(SIZE_LENGTH - bytesRec, SIZE_LENGTH))
-        except socket.timeout:
-            raise socket.timeout
-        if chunk == '':
-            raise RuntimeError("sock connection broken")
-        bytesRec += len(chunk)
-        chunks.append(chunk.decode(ENCODING_TYPE))
+    if getattr(sock, "framing", FRAMING_ASCII) == FRAMING_BINARY:
+        dataSize = HEADER_STRUCT.unpack(recvExactly(sock, HEADER_STRUCT.size))[0]
+    else:
+        # read the 16 byte string representing the data size
+        # int() raises ValueError in case of an invalid size string
+        dataSize = int(recvExactly(sock, SIZE_LENGTH))
 
-    # eventually join chunks
-    try:
-        dataSize = int(''.join(chunks))
-    except ValueError:
-        raise ValueError
+    if dataSize < 0 or dataSize > MAX_MESSAGE_SIZE:
+        # never allocate a buffer for an announced size bigger than any valid message
+        raise ValueError("invalid message size")
 
     # read data until dataSize bytes have been received
-    chunks = list()
-    bytesRec = 0
-    while bytesRec < dataSize:
-        try:
-            chunk = sock.recv(min(dataSize - bytesRec, BUFSIZE))
-        except socket.timeout:
-            raise socket.timeout
+    return recvExactly(sock, dataSize)
 
-        if chunk == '':
-            raise RuntimeError("sock connection broken")
-        bytesRec += len(chunk)
-        chunks.append(chunk.decode(ENCODING_TYPE))
 
-    # eventually join chunks
-    data = ''.join(chunks)
+def myRecv(sock):
+    """
+    Wrapper for the recv function.
+    :param sock: socket connection object
+    :return: data received (string)
+    """
+
+    data = myRecvBytes(sock)
+    if data is None:
+        return None
 
-    return str(data)
+    return data.decode(ENCODING_TYPE)
 
 
 def sendChunk(sock, chunk, chunkSize):
     """
     Send a file chunk over a socket connection.
     :param sock: socket connection object
-    :param chunk: bytes that will be sent
+    :param chunk: bytes-like object that will be sent
     :param chunkSize: number of bytes that will be sent
     :return: void
     """
@@ -258,46 +684,59 @@ def sendChunk(sock, chunk, chunkSize):
     # set a timeout
     sock.settimeout(TIMEOUT)
 
-    # send data until chunkSize bytes have been sent
-    totalSent = 0
-    while totalSent < chunkSize:
-        try:
-            sent = sock.send(chunk[totalSent:])
-        except socket.timeout:
-            raise socket.timeout
-        if sent == 0:
-            raise RuntimeError("sock connection broken")
-        totalSent = totalSent + sent
+    # sendall() handles partial sends without re-slicing (copying) the chunk
+    sock.sendall(memoryview(chunk)[:chunkSize])
+
+
+def sendFileChunk(sock, f, offset, chunkSize):
+    """
+    Send a byte range of an open file over a socket connection.
+    The kernel sendfile() is used when available, so data are streamed from the page cache
+    without being copied in user space. Otherwise socket.sendfile() falls back to read/send.
+    :param sock: socket connection object
+    :param f: file object opened in binary mode
+    :param offset: position of the first byte that will be sent
+    :param chunkSize: number of bytes that will be sent
+    :return: void
+    """
+
+    # check socket object validity
+    if sock is None:
+        return
+
+    # set a timeout
+    sock.settimeout(TIMEOUT)
+
+    sent = sock.sendfile(f, offset, chunkSize)
+    if sent != chunkSize:
+        # file shorter than expected: the remote host would wait forever
+        raise RuntimeError("file truncated while sending")
 
 
 def recvChunk(sock, chunkSize):
     """
     Receive a file chunk over a socket connection.
+    Data are received directly into the buffer owned by the connection (no copies),
+    so the returned memoryview is valid only until the next recvChunk on the same socket.
     :param sock: socket connection object
     :param chunkSize: number of bytes that will be received
-    :return: data received representing the file chunk
+    :return: memoryview representing the file chunk
     """
 
     # check socket object validity
     if sock is None:
         return
 
-    pieces = list()
-    bytesRec = 0
-
-    # read on the socket until chunkSize bytes have been received
-    while bytesRec < chunkSize:
-        try:
-            piece = sock.recv(min(chunkSize - bytesRec, BUFSIZE))
-        except socket.timeout:
-            raise socket.timeout
+    # set a timeout
+    sock.settimeout(TIMEOUT)
 
-        if piece == b'':
-            raise RuntimeError("sock connection broken")
-        bytesRec += len(piece)
-        pieces.append(piece)
+    if isinstance(sock, Connection):
+        buffer = sock.getChunkBuffer(chunkSize)
+    else:
+        buffer = bytearray(chunkSize)
 
-    # join chunk pieces
-    chunk = b''.join(pieces)
+    # read on the socket until chunkSize bytes have been received
+    chunk = memoryview(buffer)[:chunkSize]
+    recvInto(sock, chunk)
 
     return chunk
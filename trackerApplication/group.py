@@ -91,29 +91,38 @@ class Group:
         self.peersInGroup[peerID].active = False
         self.activePeers -= 1
 
-    def addFile(self, filename, filesize, timestamp):
+    def addFile(self, filename, filesize, timestamp, chunksHashes=None, merkleRoot=None, chunksSizes=None):
         """
         Add a file to a group.
         :param filename: filename string
         :param filesize: filesize value
         :param timestamp: timestamp value
+        :param chunksHashes: list of the digests of the chunks of the file (None if unknown)
+        :param merkleRoot: root of the Merkle tree of the chunks digests (None if unknown)
+        :param chunksSizes: list of the sizes of content-defined chunks (None for fixed size chunks)
         :return: void
         """
-        f = FileInGroup(filename, filesize, timestamp)
+        f = FileInGroup(filename, filesize, timestamp, chunksHashes, merkleRoot, chunksSizes)
         self.filesInGroup[filename] = f
         self.nrFiles += 1
 
-    def updateFile(self, filename, filesize, timestamp):
+    def updateFile(self, filename, filesize, timestamp, chunksHashes=None, merkleRoot=None, chunksSizes=None):
         """
         Update file info.
         :param filename: filename string
         :param filesize: new filesize value
         :param timestamp: new timestamp value
+        :param chunksHashes: new list of the digests of the chunks of the file (None if unknown)
+        :param merkleRoot: new root of the Merkle tree of the chunks digests (None if unknown)
+        :param chunksSizes: new list of the sizes of content-defined chunks (None for fixed size chunks)
         :return: void
         """
         try:
             self.filesInGroup[filename].filesize = filesize
             self.filesInGroup[filename].timestamp = int(timestamp)
+            self.filesInGroup[filename].chunksHashes = chunksHashes
+            self.filesInGroup[filename].merkleRoot = merkleRoot
+            self.filesInGroup[filename].chunksSizes = chunksSizes
         except KeyError:
             pass
 
@@ -164,13 +173,19 @@ class FileInGroup:
     Class describing a file into a group.
     """
 
-    def __init__(self, filename, filesize, timestamp):
+    def __init__(self, filename, filesize, timestamp, chunksHashes=None, merkleRoot=None, chunksSizes=None):
         """
         Initialize file information.
         :param filename: filename string
         :param filesize: filesize value
         :param timestamp: timestamp value
+        :param chunksHashes: list of the digests of the chunks of the file (None if unknown)
+        :param merkleRoot: root of the Merkle tree of the chunks digests (None if unknown)
+        :param chunksSizes: list of the sizes of content-defined chunks (None for fixed size chunks)
         """
         self.filename = filename
         self.filesize = filesize
         self.timestamp = int(timestamp)
+        self.chunksHashes = chunksHashes
+        self.merkleRoot = merkleRoot
+        self.chunksSizes = chunksSizes
@@ -18,15 +18,17 @@ for more details.
 
 import json
 import os
-import select
+import selectors
 import socket
 import sys
-from threading import Thread, Lock
+import time
+from threading import Lock
 
 import reqHandlers
 from group import Group
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shared.codec as codec
 import shared.networking as networking
 
 # Main data structure for groups management.
@@ -50,6 +52,14 @@ groupsFilesFile = scriptPath + 'sessionFiles/groupsFiles.json'
 zeroTierIP = None
 PORT_NUMBER = 45154
 
+# maximum time (seconds) the server event loop waits for events before checking the stop condition
+SELECT_TIMEOUT = 1.0
+
+# seconds after which an idle client connection is closed by the tracker
+CLIENT_IDLE_TIMEOUT = 60
+# seconds between two scans of the connections looking for the idle ones
+IDLE_CHECK_PERIOD = CLIENT_IDLE_TIMEOUT / 4
+
 
 def initTracker():
     """Initialize tracker server data structures
@@ -101,7 +111,9 @@ def initTracker():
                     filename = file["filename"]
                     filesize = file["filesize"]
                     timestamp = file["timestamp"]
-                    groups[groupName].addFile(filename, filesize, timestamp)
+                    groups[groupName].addFile(filename, filesize, timestamp,
+                                              file.get("chunksHashes"), file.get("merkleRoot"),
+                                              file.get("chunksSizes"))
                 del filesJson
             except ValueError:
                 return None
@@ -146,6 +158,9 @@ def saveState():
                 fileInfo["filename"] = file.filename
                 fileInfo["filesize"] = file.filesize
                 fileInfo["timestamp"] = file.timestamp
+                fileInfo["chunksHashes"] = file.chunksHashes
+                fileInfo["merkleRoot"] = file.merkleRoot
+                fileInfo["chunksSizes"] = file.chunksSizes
                 filesJson.append(fileInfo)
         json.dump(filesJson, f, indent=4)
         del filesJson
@@ -153,23 +168,22 @@ def saveState():
 
 class Server:
     """
-    Multithread server class that will manage incoming connections.
-    For each incoming connection it will create a thread.
-    This thread will manage the request and terminate.
+    Event-loop server class that will manage incoming connections.
+    All the connections are multiplexed by a single thread using a selector:
+    each readable connection is parsed, complete requests are served and
+    answers are written as soon as the connection is writable.
     The server runs until the property __stop is equals to False.
-    The port on which the server will listen is choosen among available ports.
     """
 
-    def __init__(self, port, maxClients=5):
+    def __init__(self, port, maxClients=socket.SOMAXCONN):
         """
         Initialize server.
         :param port: port number on which the server will be reachable
-        :param maxClients: maximum number of incoming connections.
+        :param maxClients: maximum number of pending incoming connections.
         :return: void
         """
 
         # Initialize the server with a host and port to listen to.
-        # Provide a list of functions that will be used when receiving specific data
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(("0.0.0.0", port))
@@ -178,42 +192,192 @@ class Server:
         self.port = port
 
         self.sock.listen(maxClients)
-        self.sockThreads = []
-        self.counter = 0  # Will be used to give a number to each thread, can be improved (re-assigning free number)
+        self.sock.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+
+        # active connections
+        # key: socket file descriptor
+        # value: ClientConnection object
+        self.clients = dict()
+        self.counter = 0  # Will be used to give a number to each connection
+        self.idleCheckTime = time.time() + IDLE_CHECK_PERIOD  # time of the next scan of the idle connections
         self.__stop = False
 
-        # Accept an incoming connection.
-        # Start a new SocketServerThread that will handle the communication.
         print('Starting socket server (host {}, port {})'.format(self.host, self.port))
 
         while not self.__stop:
             try:
-                self.sock.settimeout(1)
-                try:
-                    clientSock, clientAddr = self.sock.accept()
-                except socket.timeout:
-                    clientSock = None
-
-                if clientSock:
-                    clientThr = SocketServerThread(clientSock, clientAddr, self.counter)
-                    self.counter += 1
-                    self.sockThreads.append(clientThr)
-                    clientThr.daemon = True
-                    clientThr.start()
+                self.serveEvents()
             except KeyboardInterrupt:
                 self.stopServer()
 
         self.closeServer()
 
+    def serveEvents(self):
+        """
+        Wait for events on the server socket and on the client connections and serve them.
+        :return: void
+        """
+
+        events = self.selector.select(timeout=SELECT_TIMEOUT)
+
+        for key, mask in events:
+            if key.data is None:
+                self.acceptClients()
+            else:
+                client = key.data
+                if mask & selectors.EVENT_READ:
+                    self.readClient(client)
+                if mask & selectors.EVENT_WRITE and not client.closed:
+                    self.writeClient(client)
+
+        # close connections idle for too much time:
+        # the scan costs O(connections), so it's done only every IDLE_CHECK_PERIOD seconds
+        now = time.time()
+        if now >= self.idleCheckTime:
+            limit = now - CLIENT_IDLE_TIMEOUT
+            for client in [c for c in self.clients.values() if c.lastActivity < limit]:
+                self.closeClient(client)
+            self.idleCheckTime = now + IDLE_CHECK_PERIOD
+
+    def acceptClients(self):
+        """
+        Accept all the pending incoming connections.
+        :return: void
+        """
+
+        while True:
+            try:
+                clientSock, clientAddr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. too many open files: retry at next event
+                print("Error while accepting a connection: {}".format(e))
+                return
+
+            clientSock.setblocking(False)
+            client = ClientConnection(clientSock, clientAddr, self.counter)
+            self.counter += 1
+            self.clients[clientSock.fileno()] = client
+            self.selector.register(clientSock, selectors.EVENT_READ, client)
+
+    def readClient(self, client):
+        """
+        Read available data from a connection and serve all the complete requests.
+        :param client: ClientConnection object
+        :return: void
+        """
+
+        try:
+            data = client.sock.recv(networking.BUFSIZE * 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if len(data) == 0:
+            # connection closed by the peer
+            self.closeClient(client)
+            return
+
+        client.lastActivity = time.time()
+        client.reader.feed(data)
+
+        try:
+            while not client.closing:
+                message = client.reader.getMessage()
+
+                if client.reader.handshakeReply is not None:
+                    # answer to the framing handshake before any other answer
+                    client.outBuffer += client.reader.handshakeReply
+                    client.reader.handshakeReply = None
+
+                if message is None:
+                    break
+
+                # Strip newlines just for output clarity
+                message = message.decode(networking.ENCODING_TYPE).rstrip()
+                messageFields = message.split(' ', 1)
+                # divide peerID from the request
+                peerID = messageFields[0]
+                request = messageFields[1]
+
+                try:
+                    answer = manageRequest(client, request, peerID)
+                except Exception as e:
+                    # a request that cannot be served must not stop the event loop
+                    print('[Conn {}] Error while serving a request from {}: {}'
+                          .format(client.number, client.clientAddr, repr(e)))
+                    answer = "ERROR - INVALID REQUEST"
+                client.outBuffer += networking.encodeFrame(answer, client.reader.framing)
+
+        except (IndexError, ValueError):
+            print('[Conn {}] Invalid data received from {}'.format(client.number, client.clientAddr))
+            self.closeClient(client)
+            return
+
+        self.writeClient(client)
+
+    def writeClient(self, client):
+        """
+        Write pending answers on a connection.
+        Until all the answers have been written the connection is not read:
+        this bounds the memory used by each connection.
+        :param client: ClientConnection object
+        :return: void
+        """
+
+        if len(client.outBuffer) > 0:
+            try:
+                sent = client.sock.send(client.outBuffer)
+                del client.outBuffer[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.closeClient(client)
+                return
+
+        if len(client.outBuffer) > 0:
+            events = selectors.EVENT_WRITE
+        elif client.closing:
+            self.closeClient(client)
+            return
+        else:
+            events = selectors.EVENT_READ
+
+        if events != client.events:
+            self.selector.modify(client.sock, events, client)
+            client.events = events
+
+    def closeClient(self, client):
+        """
+        Close a client connection and forget it.
+        :param client: ClientConnection object
+        :return: void
+        """
+
+        if client.closed:
+            return
+
+        client.closed = True
+        self.selector.unregister(client.sock)
+        del self.clients[client.sock.fileno()]
+        client.sock.close()
+
     def closeServer(self):
-        """ Close the client socket threads and server socket if they exists. """
+        """ Close the client connections and server socket if they exists. """
         print('Closing server socket (host {}, port {})'.format(self.host, self.port))
 
-        for thr in self.sockThreads:
-            thr.stop()
+        for client in list(self.clients.values()):
+            self.closeClient(client)
 
         if self.sock:
+            self.selector.unregister(self.sock)
             self.sock.close()
+        self.selector.close()
 
         print("Saving the state of the server")
         saveState()
@@ -227,143 +391,99 @@ class Server:
         self.__stop = True
 
 
-class SocketServerThread(Thread):
-    def __init__(self, clientSock, clientAddr, number):
-        """ Initialize the Thread with a client socket and address """
-        Thread.__init__(self)
-        self.clientSock = clientSock
+class ClientConnection:
+    """
+    State of a connection with a client, handled by the Server event loop.
+    """
+
+    def __init__(self, sock, clientAddr, number):
+        """
+        Initialize the connection state.
+        :param sock: non-blocking socket of the connection
+        :param clientAddr: address of the client
+        :param number: number of the connection
+        """
+        self.sock = sock
         self.clientAddr = clientAddr
         self.number = number
-        self.__stop = False
-
-    def run(self):
-
-        # print("[Thr {}] SocketServerThread starting with client {}".format(self.number, self.clientAddr))
+        self.reader = networking.FrameReader()  # incoming requests
+        self.outBuffer = bytearray()  # answers not written yet
+        self.events = selectors.EVENT_READ  # events currently registered in the selector
+        self.lastActivity = time.time()
+        self.closing = False  # close the connection after writing pending answers
+        self.closed = False
 
-        while not self.__stop:
-            if self.clientSock:
-                # Check if the client is still connected and if data is available:
-                try:
-                    rdyRead, __, __ = select.select([self.clientSock, ], [self.clientSock, ], [], 5)
-                except select.error:
-                    print('[Thr {}] Select() failed on socket with {}'.format(self.number, self.clientAddr))
-                    self.stop()
-                    return
-
-                if len(rdyRead) > 0:
-                    readData = networking.myRecv(self.clientSock)
-
-                    # Check if socket has been closed
-                    if len(readData) == 0:
-                        print('[Thr {}] {} closed the socket.'.format(self.number, self.clientAddr))
-                        self.stop()
-                    else:
-                        # Strip newlines just for output clarity
-                        message = readData.rstrip()
-                        messageFields = message.split(' ', 1)
-                        # divide peerID from the request
-                        peerID = messageFields[0]
-                        request = messageFields[1]
-                        self.manageRequest(request, peerID)
-            else:
-                print("[Thr {}] No client is connected, SocketServer can't receive data".format(self.number))
-                self.stop()
-        self.close()
 
-    def stop(self):
-        """ Stop the socket server thread."""
-        self.__stop = True
+def manageRequest(client, request, peerID):
+    """
+    Serves clients different requests.
+    :param client: ClientConnection object
+    :param request: incoming requested stripped of the peerID
+    :param peerID: id of the peer
+    :return: answer string
+    """
 
-    def close(self):
-        """ Close connection with the client socket. """
-        if self.clientSock:
-            # print('[Thr {}] Closing connection with {}'.format(self.number, self.clientAddr))
-            self.clientSock.close()
+    # all the requests (stripped of the peerID) are identified using the first word
+    # e.g. <action> <parameters>
+    action = request.split()[0]
 
-    def manageRequest(self, request, peerID):
-        """
-        Serves clients different requests.
-        :param request: incoming requested stripped of the peerID
-        :param peerID: id of the peer
-        :return: void
-        """
-
-        # all the requests (stripped of the peerID) are identified using the first word
-        # e.g. <action> <parameters>
-        action = request.split()[0]
+    # don't show common requests in the output of the tracker
+    if action != "PEERS" and action != "BYE" and action != "GROUPS":
+        print('[Conn {}] [Peer: {}] Received {}'.format(client.number, peerID, request))
 
-        # don't show common requests in the output of the tracker
-        if action != "PEERS" and action != "BYE" and action != "GROUPS":
-            print('[Thr {}] [Peer: {}] Received {}'.format(self.number, peerID, request))
+    if action == "INFO":
+        answer = codec.encode((zeroTierIP, PORT_NUMBER))
 
-        if action == "INFO":
-            answer = str((zeroTierIP, PORT_NUMBER))
-            networking.mySend(self.clientSock, answer)
+    elif action == "GROUPS":
+        answer = reqHandlers.sendGroups(groups, peerID)
 
-        if action == "GROUPS":
-            answer = reqHandlers.sendGroups(groups, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "RESTORE":
+        answer = reqHandlers.restoreGroup(request, groups, peerID)
 
-        elif action == "RESTORE":
-            answer = reqHandlers.restoreGroup(request, groups, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "JOIN":
+        answer = reqHandlers.joinGroup(request, groups, peerID)
 
-        elif action == "JOIN":
-            answer = reqHandlers.joinGroup(request, groups, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "CREATE":
+        answer = reqHandlers.createGroup(request, groups, groupsLock, peerID)
 
-        elif action == "CREATE":
-            answer = reqHandlers.createGroup(request, groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "ROLE":
+        answer = reqHandlers.manageRole(request, groups, groupsLock, peerID)
 
-        elif action == "ROLE":
-            answer = reqHandlers.manageRole(request, groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "PEERS":
+        answer = reqHandlers.retrievePeers(request, groups, peers, peerID)
 
-        elif action == "PEERS":
-            answer = reqHandlers.retrievePeers(request, groups, peers, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "ADDED_FILES":
+        answer = reqHandlers.addedFiles(request, groups, groupsLock, peerID)
 
-        elif action == "ADDED_FILES":
-            answer = reqHandlers.addedFiles(request, groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "UPDATED_FILES":
+        answer = reqHandlers.updatedFiles(request, groups, groupsLock, peerID)
 
-        elif action == "UPDATED_FILES":
-            answer = reqHandlers.updatedFiles(request, groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "REMOVED_FILES":
+        answer = reqHandlers.removedFiles(request, groups, groupsLock, peerID)
 
-        elif action == "REMOVED_FILES":
-            answer = reqHandlers.removedFiles(request, groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "GET_FILES":
+        answer = reqHandlers.getFiles(request, groups, peerID)
 
-        elif action == "GET_FILES":
-            answer = reqHandlers.getFiles(request, groups, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "HERE":
+        answer = reqHandlers.imHere(request, peers, peerID, client.clientAddr)
 
-        elif action == "HERE":
-            answer = reqHandlers.imHere(request, peers, peerID, self.clientAddr)
-            networking.mySend(self.clientSock, answer)
+    elif action == "LEAVE":
+        answer = reqHandlers.leaveGroup(request, groups, groupsLock, peerID)
 
-        elif action == "LEAVE":
-            answer = reqHandlers.leaveGroup(request, groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "DISCONNECT":
+        answer = reqHandlers.disconnectGroup(request, groups, groupsLock, peerID)
 
-        elif action == "DISCONNECT":
-            answer = reqHandlers.disconnectGroup(request, groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "EXIT":
+        answer = reqHandlers.peerExit(groups, groupsLock, peerID)
 
-        elif action == "EXIT":
-            answer = reqHandlers.peerExit(groups, groupsLock, peerID)
-            networking.mySend(self.clientSock, answer)
+    elif action == "BYE":
+        answer = "OK - BYE PEER"
+        client.closing = True
 
-        elif action == "BYE":
-            answer = "OK - BYE PEER"
-            networking.mySend(self.clientSock, answer)
-            self.stop()
+    else:
+        answer = "ERROR - UNEXPECTED REQUEST"
 
-        else:
-            answer = "ERROR - UNEXPECTED REQUEST"
-            networking.mySend(self.clientSock, answer)
+    return answer
 
 
 if __name__ == '__main__':
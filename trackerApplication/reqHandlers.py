@@ -15,8 +15,14 @@ or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
 for more details.
 """
 
+import os
+import sys
+
 from group import Group
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shared.codec as codec
+
 
 def imHere(request, peers, peerID, publicAddr):
     """
@@ -59,7 +65,7 @@ def sendGroups(groups, peerID):
             groupsList[g.name]["role"] = ""
             groupsList[g.name]["status"] = "OTHER"
 
-    return "OK - " + str(groupsList)
+    return "OK - " + codec.encode(groupsList)
 
 
 def restoreGroup(request, groups, peerID):
@@ -135,19 +141,19 @@ def createGroup(request, groups, groupsLock, peerID):
     newGroupTokenRO = request.split()[3]
 
     groupsLock.acquire()
+    try:
+        if newGroupName not in groups:
+            # create the new group and insert in the group dictionary
 
-    if newGroupName not in groups:
-        # create the new group and insert in the group dictionary
-
-        newGroup = Group(newGroupName, newGroupTokenRW, newGroupTokenRO)
-        newGroup.addPeer(peerID, True, "Master")
-        groups[newGroupName] = newGroup
-
-        answer = "OK - GROUP {} SUCCESSFULLY CREATED".format(newGroupName)
-    else:
-        answer = "ERROR - IMPOSSIBLE TO CREATE GROUP {} - GROUP ALREADY EXIST".format(newGroupName)
+            newGroup = Group(newGroupName, newGroupTokenRW, newGroupTokenRO)
+            newGroup.addPeer(peerID, True, "Master")
+            groups[newGroupName] = newGroup
 
-    groupsLock.release()
+            answer = "OK - GROUP {} SUCCESSFULLY CREATED".format(newGroupName)
+        else:
+            answer = "ERROR - IMPOSSIBLE TO CREATE GROUP {} - GROUP ALREADY EXIST".format(newGroupName)
+    finally:
+        groupsLock.release()
 
     return answer
 
@@ -174,6 +180,8 @@ def manageRole(request, groups, groupsLock, peerID):
         newRole = "RW"
     elif action == "MAKE_IT_RO":
         newRole = "RO"
+    else:
+        return "ERROR - INVALID REQUEST"
 
     if groupName in groups:
         # check if both peerIDs actually belongs to the group
@@ -182,12 +190,13 @@ def manageRole(request, groups, groupsLock, peerID):
             if groups[groupName].peersInGroup[peerID].role.upper() == "MASTER":
 
                 groupsLock.acquire()
-                groups[groupName].peersInGroup[modPeerID].role = newRole
-
-                if action.upper() == "CHANGE_MASTER":
-                    groups[groupName].peersInGroup[peerID].role = "RW"
+                try:
+                    groups[groupName].peersInGroup[modPeerID].role = newRole
 
-                groupsLock.release()
+                    if action.upper() == "CHANGE_MASTER":
+                        groups[groupName].peersInGroup[peerID].role = "RW"
+                finally:
+                    groupsLock.release()
                 answer = "OK - OPERATION ALLOWED"
 
             else:
@@ -233,7 +242,7 @@ def retrievePeers(request, groups, peers, peerID):
             peerInfo["role"] = groups[groupName].peersInGroup[peer].role
             peersList.append(peerInfo)
 
-        answer = "OK - " + str(peersList)
+        answer = "OK - " + codec.encode(peersList)
     else:
         answer = "ERROR - GROUP {} DOESN'T EXIST".format(groupName)
 
@@ -244,7 +253,7 @@ def addedFiles(request, groups, groupsLock, peerID):
     """
     Add files passed in the request to the specified group.
     Request contains a <filelist> parameter, it's a list of dictionary.
-    Each dictionary contains info treePath, filesize, timestamp of a file.
+    Each dictionary contains info treePath, filesize, timestamp, chunksHashes, merkleRoot, chunksSizes of a file.
     :param request: "ADDED_FILES <groupName> <filelist>"
     :param groups: tracker data structure
     :param groupsLock: lock on the groups data structure
@@ -255,26 +264,28 @@ def addedFiles(request, groups, groupsLock, peerID):
     try:
         requestFields = request.split(" ", 2)
         groupName = requestFields[1]
-        filesInfo = eval(requestFields[2])
+        filesInfo = codec.decodeFilesInfo(requestFields[2])
 
         groupsLock.acquire()
-
-        if groupName in groups:
-            if peerID in groups[groupName].peersInGroup:
-                if groups[groupName].peersInGroup[peerID].role.upper() == "RO":
-                    answer = "ERROR - PEER DOESN'T HAVE ENOUGH PRIVILEGE"
+        try:
+            if groupName in groups:
+                if peerID in groups[groupName].peersInGroup:
+                    if groups[groupName].peersInGroup[peerID].role.upper() == "RO":
+                        answer = "ERROR - PEER DOESN'T HAVE ENOUGH PRIVILEGE"
+                    else:
+                        for fileInfo in filesInfo:
+                            groups[groupName].addFile(fileInfo["treePath"], fileInfo["filesize"],
+                                                      fileInfo["timestamp"], fileInfo.get("chunksHashes"),
+                                                      fileInfo.get("merkleRoot"), fileInfo.get("chunksSizes"))
+                        answer = "OK - FILES SUCCESSFULLY ADDED"
                 else:
-                    for fileInfo in filesInfo:
-                        groups[groupName].addFile(fileInfo["treePath"], fileInfo["filesize"], fileInfo["timestamp"])
-                    answer = "OK - FILES SUCCESSFULLY ADDED"
+                    answer = "ERROR - PEER DOESN'T BELONG TO THE GROUP"
             else:
-                answer = "ERROR - PEER DOESN'T BELONG TO THE GROUP"
-        else:
-            answer = "ERROR - GROUP DOESN'T EXIST"
+                answer = "ERROR - GROUP DOESN'T EXIST"
+        finally:
+            groupsLock.release()
 
-        groupsLock.release()
-
-    except IndexError:
+    except (IndexError, ValueError):
         answer = "ERROR - INVALID REQUEST"
 
     return answer
@@ -294,25 +305,29 @@ def removedFiles(request, groups, groupsLock, peerID):
     try:
         requestFields = request.split(" ", 2)
         groupName = requestFields[1]
-        treePaths = eval(requestFields[2])
+        treePaths = codec.decode(requestFields[2])
 
-        groupsLock.acquire()
+        if not isinstance(treePaths, list) or not all(isinstance(tp, str) for tp in treePaths):
+            raise ValueError("invalid tree paths")
 
-        if groupName in groups:
-            if peerID in groups[groupName].peersInGroup:
-                if groups[groupName].peersInGroup[peerID].role.upper() == "RO":
-                    answer = "ERROR - PEER DOESN'T HAVE ENOUGH PRIVILEGE"
+        groupsLock.acquire()
+        try:
+            if groupName in groups:
+                if peerID in groups[groupName].peersInGroup:
+                    if groups[groupName].peersInGroup[peerID].role.upper() == "RO":
+                        answer = "ERROR - PEER DOESN'T HAVE ENOUGH PRIVILEGE"
+                    else:
+                        for tp in treePaths:
+                            groups[groupName].removeFile(tp)
+                        answer = "OK - FILES REMOVED FROM THE GROUP"
                 else:
-                    for tp in treePaths:
-                        groups[groupName].removeFile(tp)
-                    answer = "OK - FILES REMOVED FROM THE GROUP"
+                    answer = "ERROR - PEER DOESN'T BELONG TO THE GROUP"
             else:
-                answer = "ERROR - PEER DOESN'T BELONG TO THE GROUP"
-        else:
-            answer = "ERROR - GROUP DOESN'T EXIST"
-        groupsLock.release()
+                answer = "ERROR - GROUP DOESN'T EXIST"
+        finally:
+            groupsLock.release()
 
-    except IndexError:
+    except (IndexError, ValueError):
         answer = "ERROR - INVALID REQUEST"
 
     return answer
@@ -322,7 +337,7 @@ def updatedFiles(request, groups, groupsLock, peerID):
     """
     Update files info for files passed in the request in the specified group.
     Request contains a <filesInfo> parameter that is a list of dictionaries.
-    Each dict contains updated info filesize and timestamp of a file.
+    Each dict contains updated info filesize, timestamp, chunksHashes, merkleRoot and chunksSizes of a file.
     :param request: "UPDATED_FILES <groupName> <filesInfo>"
     :param groups: tracker data structure
     :param groupsLock: lock on the groups data structure
@@ -333,25 +348,28 @@ def updatedFiles(request, groups, groupsLock, peerID):
     try:
         requestFields = request.split(" ", 2)
         groupName = requestFields[1]
-        filesInfo = eval(requestFields[2])
+        filesInfo = codec.decodeFilesInfo(requestFields[2])
 
         groupsLock.acquire()
-
-        if groupName in groups:
-            if peerID in groups[groupName].peersInGroup:
-                if groups[groupName].peersInGroup[peerID].role.upper() == "RO":
-                    answer = "ERROR - PEER DOESN'T HAVE ENOUGH PRIVILEGES"
+        try:
+            if groupName in groups:
+                if peerID in groups[groupName].peersInGroup:
+                    if groups[groupName].peersInGroup[peerID].role.upper() == "RO":
+                        answer = "ERROR - PEER DOESN'T HAVE ENOUGH PRIVILEGES"
+                    else:
+                        for fileInfo in filesInfo:
+                            groups[groupName].updateFile(fileInfo["treePath"], fileInfo["filesize"],
+                                                         fileInfo["timestamp"], fileInfo.get("chunksHashes"),
+                                                         fileInfo.get("merkleRoot"), fileInfo.get("chunksSizes"))
+                        answer = "OK - FILES SUCCESSFULLY UPDATED"
                 else:
-                    for fileInfo in filesInfo:
-                        groups[groupName].updateFile(fileInfo["treePath"], fileInfo["filesize"], fileInfo["timestamp"])
-                    answer = "OK - FILES SUCCESSFULLY UPDATED"
+                    answer = "ERROR - PEER DOESN'T BELONG TO THE GROUP"
             else:
-                answer = "ERROR - PEER DOESN'T BELONG TO THE GROUP"
-        else:
-            answer = "ERROR - GROUP DOESN'T EXIST"
-        groupsLock.release()
+                answer = "ERROR - GROUP DOESN'T EXIST"
+        finally:
+            groupsLock.release()
 
-    except IndexError:
+    except (IndexError, ValueError):
         answer = "ERROR - INVALID REQUEST"
 
     return answer
@@ -361,7 +379,7 @@ def getFiles(request, groups, peerID):
     """
     Return the file list of a group by means of a list.
     Each element of the list is a dictionary.
-    Each dictionary contains info treePath, filesize, timestamp of a file.
+    Each dictionary contains info treePath, filesize, timestamp, chunksHashes, merkleRoot, chunksSizes of a file.
     :param request: "GET_FILES <groupName>"
     :param groups: tracker data structure
     :param peerID: id of the peer
@@ -381,16 +399,19 @@ def getFiles(request, groups, peerID):
                     fileDict["treePath"] = file.filename
                     fileDict["filesize"] = file.filesize
                     fileDict["timestamp"] = file.timestamp
+                    fileDict["chunksHashes"] = file.chunksHashes
+                    fileDict["merkleRoot"] = file.merkleRoot
+                    fileDict["chunksSizes"] = file.chunksSizes
                     filesInfo.append(fileDict)
 
-                answer = "OK - " + str(filesInfo)
+                answer = "OK - " + codec.encodeFilesInfo(filesInfo)
 
             else:
                 answer = "ERROR - PEER DOESN'T BELONG TO THE GROUP"
         else:
             answer = "ERROR - GROUP DOESN'T EXIST"
 
-    except IndexError:
+    except (IndexError, ValueError):
         answer = "ERROR - INVALID REQUEST"
 
     return answer
@@ -409,8 +430,12 @@ def leaveGroup(request, groups, groupsLock, peerID):
     groupName = request.split()[1]
 
     groupsLock.acquire()
-    groups[groupName].removePeer(peerID)
-    groupsLock.release()
+    try:
+        if groupName not in groups:
+            return "ERROR - GROUP {} DOESN'T EXIST".format(groupName)
+        groups[groupName].removePeer(peerID)
+    finally:
+        groupsLock.release()
 
     answer = "OK - GROUP LEFT"
     return answer
@@ -429,8 +454,12 @@ def disconnectGroup(request, groups, groupsLock, peerID):
     groupName = request.split()[1]
 
     groupsLock.acquire()
-    groups[groupName].disconnectPeer(peerID)
-    groupsLock.release()
+    try:
+        if groupName not in groups:
+            return "ERROR - GROUP {} DOESN'T EXIST".format(groupName)
+        groups[groupName].disconnectPeer(peerID)
+    finally:
+        groupsLock.release()
 
     answer = "OK - GROUP DISCONNECTED"
     return answer
@@ -446,13 +475,13 @@ def peerExit(groups, groupsLock, peerID):
     """
 
     groupsLock.acquire()
-
-    for group in groups.values():
-        if peerID in group.peersInGroup:
-            if group.peersInGroup[peerID].active:
-                group.disconnectPeer(peerID)
-
-    groupsLock.release()
+    try:
+        for group in groups.values():
+            if peerID in group.peersInGroup:
+                if group.peersInGroup[peerID].active:
+                    group.disconnectPeer(peerID)
+    finally:
+        groupsLock.release()
 
     answer = "OK - PEER DISCONNECTED"
     return answer